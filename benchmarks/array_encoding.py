@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""Compare read throughput of the pickle-based (PX/ZX) and binary (B1) encodings of HaloProperty.data_array
+
+Run as a script, e.g. python array_encoding.py"""
+
+import time
+
+import numpy as np
+
+import tangos.config
+from tangos.core import data_attribute_mapper
+
+SAMPLES = {
+    "dm_density_profile": lambda rng: np.cumsum(rng.random(500))[::-1] * 1e7,
+    "image (300x300)": lambda rng: rng.random((300, 300)).astype(np.float32),
+    "smooth image (300x300)": lambda rng: np.outer(np.arange(300.0), np.ones(300)),
+}
+
+def _pack(data, binary):
+    old_setting = tangos.config.use_binary_array_format
+    tangos.config.use_binary_array_format = binary
+    try:
+        return data_attribute_mapper.pack_data_of_unknown_type(data)[1]
+    finally:
+        tangos.config.use_binary_array_format = old_setting
+
+def _time_unpack(packed, min_time=0.5):
+    mapper = data_attribute_mapper.DataAttributeMapper(data=np.zeros(2))
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        for _ in range(100):
+            mapper.unpack(packed)
+        n += 100
+    return (time.perf_counter() - start)/n
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f"{'array':>20s} {'format':>6s} {'stored bytes':>12s} {'read time':>10s} {'reads/s':>10s}")
+    for name, generator in SAMPLES.items():
+        data = generator(rng)
+        for binary in (False, True):
+            packed = _pack(data, binary)
+            t = _time_unpack(packed)
+            print(f"{name:>20s} {packed[:2].decode():>6s} {len(packed):12d} {t*1e6:8.1f}us {1/t:10.0f}")
+
+if __name__ == "__main__":
+    main()
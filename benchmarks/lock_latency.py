@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Measure the latency of lock grants in the multiprocessing backend, with many processes contending for one lock
+
+Every process repeatedly acquires and immediately releases the same lock, in the way that processes contend for
+the 'insert_list' lock when committing. The time from asking for the lock to being granted it is recorded on each
+process, and the overall grant rate is reported alongside its distribution. The server's own histogram of wait times
+is also written to the log at the end of each run.
+
+Run as a script, e.g. python lock_latency.py [num_processes]"""
+
+import sys
+import time
+
+import numpy as np
+
+from tangos import parallel_tasks as pt
+
+ACQUISITIONS_PER_PROCESS = 200
+MODES = ("exclusive", "shared", "mixed")
+
+def _contend(mode):
+    rank = pt.backend.rank()
+    waits = np.empty(ACQUISITIONS_PER_PROCESS)
+    pt.barrier()
+    start = time.perf_counter()
+    for i in range(ACQUISITIONS_PER_PROCESS):
+        shared = mode=="shared" or (mode=="mixed" and rank%2==0)
+        lock = pt.lock.SharedLock("benchmark") if shared else pt.ExclusiveLock("benchmark", 0)
+        t0 = time.perf_counter()
+        lock.acquire()
+        waits[i] = time.perf_counter() - t0
+        lock.release()
+    elapsed = time.perf_counter() - start
+    pt.barrier()
+
+    grants_per_second = ACQUISITIONS_PER_PROCESS / elapsed
+    # written in one go, so that lines from different processes are not interleaved
+    sys.stdout.write(f"{mode:>10s} {rank:5d} {grants_per_second:11.0f}/s {np.median(waits)*1e3:10.3f}ms "
+                     f"{np.percentile(waits, 99)*1e3:10.3f}ms {waits.max()*1e3:10.3f}ms\n")
+    sys.stdout.flush()
+
+def main():
+    num_processes = int(sys.argv[1]) if len(sys.argv)>1 else 16
+    print(f"{'mode':>10s} {'rank':>5s} {'grant rate':>13s} {'median wait':>12s} {'99% wait':>12s} {'max wait':>12s}")
+    for mode in MODES:
+        pt.use(f"multiprocessing-{num_processes+1}")
+        pt.launch(_contend, args=(mode,))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""Compare the temp table, recursive CTE and in-memory implementations of MultiHopStrategy
+
+A merger tree with the same structure as that in tests/test_big_mergertree.py is generated in a temporary
+sqlite database, then major progenitor, major descendant and all-progenitor searches are timed with each engine.
+
+Run as a script, e.g. python multihop_engines.py [number of timesteps]"""
+
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import tangos
+import tangos.config
+import tangos.relation_finding as relation_finding
+import tangos.testing.simulation_generator as sg
+
+N_HALOS_FINAL = 2
+N_BRANCHES_PER_TIMESTEP = 2
+MAX_HALOS = 10000
+
+def generate_tree(n_timesteps):
+    generator = sg.SimulationGeneratorForTests(max_steps=n_timesteps)
+    n_halos_previous_timestep = None
+    for i in range(n_timesteps):
+        generator.add_timestep()
+        nhalos_this_timestep = min(N_HALOS_FINAL * N_BRANCHES_PER_TIMESTEP ** (n_timesteps - i), MAX_HALOS)
+        generator.add_objects_to_timestep(nhalos_this_timestep, NDM=np.arange(1, nhalos_this_timestep + 1)[::-1])
+        if n_halos_previous_timestep is not None:
+            halomap = {}
+            for j in range(N_BRANCHES_PER_TIMESTEP):
+                halomap.update({i + j * nhalos_this_timestep: i for i in range(1, nhalos_this_timestep + 1)
+                                if i + j * nhalos_this_timestep < n_halos_previous_timestep})
+            generator.link_last_halos_using_mapping(halomap)
+        n_halos_previous_timestep = nhalos_this_timestep
+
+def _time_strategy(engine, strategy_class, halo, min_time=1.0, **kwargs):
+    tangos.config.multihop_engine = engine
+    strategy_class(halo, **kwargs).all() # warm up, e.g. so that the in-memory engine has loaded the link graph
+    n = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < min_time:
+        results = strategy_class(halo, **kwargs).all()
+        n += 1
+    return (time.perf_counter() - start) / n, len(results)
+
+def main():
+    n_timesteps = int(sys.argv[1]) if len(sys.argv) > 1 else 15
+    with tempfile.TemporaryDirectory() as directory:
+        tangos.core.init_db(os.path.join(directory, "multihop_benchmark.db"))
+        print(f"Generating tree with {n_timesteps} timesteps...")
+        generate_tree(n_timesteps)
+
+        final_halo = tangos.get_halo(f"sim/ts{n_timesteps}/1")
+        first_halo = tangos.get_halo("sim/ts1/1")
+        cases = [("major progenitors", relation_finding.MultiHopMajorProgenitorsStrategy, final_halo, {}),
+                 ("major descendants", relation_finding.MultiHopMajorDescendantsStrategy, first_halo, {}),
+                 ("all progenitors", relation_finding.MultiHopAllProgenitorsStrategy, final_halo, {}),
+                 ("all progenitors, all routes", relation_finding.MultiHopAllProgenitorsStrategy, final_halo,
+                  {'combine_routes': False})]
+
+        print(f"{'search':>30s} {'engine':>14s} {'results':>8s} {'time':>10s}")
+        for name, strategy_class, halo, kwargs in cases:
+            for engine in ('temp_table', 'recursive_cte', 'in_memory'):
+                t, n_results = _time_strategy(engine, strategy_class, halo, **kwargs)
+                print(f"{name:>30s} {engine:>14s} {n_results:8d} {t*1e3:8.1f}ms")
+
+        tangos.core.close_db()
+
+if __name__ == "__main__":
+    main()
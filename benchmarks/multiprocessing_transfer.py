@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""Compare the throughput of numpy array transfer in the multiprocessing backend, through pipes and shared memory
+
+One process sends arrays of various sizes to another, which acknowledges each one after reading it through. The pipe
+path is selected by raising config.multiprocessing_shared_memory_min_bytes above the largest array.
+
+Run as a script, e.g. python multiprocessing_transfer.py"""
+
+import time
+
+import numpy as np
+
+import tangos.config
+from tangos.parallel_tasks.backends import multiprocessing as mp_backend
+
+SIZES_IN_BYTES = [2**16, 2**20, 2**24, 2**27]
+MIN_TOTAL_BYTES = 2**30
+
+def _repeats(nbytes):
+    return max(MIN_TOTAL_BYTES // nbytes, 3)
+
+def _sender():
+    for nbytes in SIZES_IN_BYTES:
+        data = np.random.default_rng(0).random(nbytes // 8)
+        for _ in range(_repeats(nbytes)):
+            mp_backend.send_numpy_array(data, 1)
+            mp_backend.receive_numpy_array(1)
+
+def _receiver(label):
+    acknowledgement = np.zeros(1)
+    for nbytes in SIZES_IN_BYTES:
+        n = _repeats(nbytes)
+        start = time.perf_counter()
+        for _ in range(n):
+            received = mp_backend.receive_numpy_array(0)
+            received.sum() # touch all the data
+            del received
+            mp_backend.send_numpy_array(acknowledgement, 0)
+        t = (time.perf_counter() - start) / n
+        print(f"{label:>14s} {nbytes/2**20:10.2f} MiB {t*1e3:9.3f}ms {nbytes/t/2**30:8.2f} GiB/s", flush=True)
+
+def main():
+    print(f"{'path':>14s} {'array size':>14s} {'time':>11s} {'throughput':>13s}")
+    old_threshold = tangos.config.multiprocessing_shared_memory_min_bytes
+    try:
+        for label, threshold in (("pipe", float('inf')), ("shared memory", old_threshold)):
+            tangos.config.multiprocessing_shared_memory_min_bytes = threshold
+            mp_backend.launch_functions([_sender, _receiver], [(), (label,)])
+    finally:
+        tangos.config.multiprocessing_shared_memory_min_bytes = old_threshold
+
+if __name__ == "__main__":
+    main()
@@ -105,6 +105,7 @@ setup(name='tangos',
       long_description_content_type='text/markdown',
       extras_require={'test': tests_require,
                       'rmdbs': ['PyMySQL[rsa]',
-                                'psycopg2-binary']
+                                'psycopg2-binary'],
+                      'compression': ['zstandard']
                       }
       )
@@ -1,4 +1,5 @@
 from . import core
+from .util import proxy_object
 
 
 def create_property(halo, name, prop, session):
@@ -25,11 +26,105 @@ def _insert_list_unlocked(property_list):
     session.commit()
     return number
 
-def insert_list(property_list):
+
+class BulkInserter:
+    """Inserts a list of (halo, name, value) tuples using Core-level executemany statements
+
+    This bypasses the ORM unit-of-work, which becomes the bottleneck when many thousands of properties are
+    committed at once. Dictionary ids and the creator id are resolved once per batch, and values are packed
+    in exactly the same way as when assigning to HaloProperty.data.
+
+    If a TimingMonitor is monitoring the inserter, the stages of the insert are marked and the number of rows
+    written is counted, so that the rows per second can be reported.
+
+    By default the default session and creator are used. Alternatives can be specified, e.g. when inserting
+    from a thread other than the one that owns the default session."""
+
+    _property_data_columns = ('data_float', 'data_int', 'data_array')
+
+    def __init__(self, session=None, creator_id=None):
+        self.timing_monitor = None
+        self._session = session
+        self._creator_id = creator_id
+
+    def _mark(self, label):
+        if self.timing_monitor is not None:
+            self.timing_monitor.mark(label)
+
+    def _get_dictionary_ids(self, session, names):
+        dict_objects = {name: core.dictionary.get_or_create_dictionary_item(session, name) for name in names}
+        session.flush() # ensures any newly-created dictionary items have ids
+        return {name: obj.id for name, obj in dict_objects.items()}
+
+    def _make_property_row(self, halo_id, name_id, creator_id, value):
+        attribute_name, packed = core.data_attribute_mapper.pack_data_of_unknown_type(value)
+        if attribute_name not in self._property_data_columns:
+            raise TypeError("%r object does not have a slot for %r" % (core.halo_data.HaloProperty, attribute_name))
+        row = {'halo_id': halo_id, 'name_id': name_id, 'creator_id': creator_id}
+        for column in self._property_data_columns:
+            row[column] = None
+        row[attribute_name] = packed
+        return row
+
+    @staticmethod
+    def _get_halo_id(halo):
+        if isinstance(halo, (core.halo.SimulationObjectBase, proxy_object.ProxyObjectFromDatabaseId)):
+            return halo.id
+        else:
+            return halo
+
+    def _make_rows(self, property_list, dict_ids, creator_id):
+        property_rows = []
+        link_rows = []
+        for halo, name, value in property_list:
+            if value is None:
+                continue
+            halo_id = self._get_halo_id(halo)
+            if isinstance(value, (core.halo.SimulationObjectBase, proxy_object.ProxyObjectFromDatabaseId)):
+                link_rows.append({'halo_from_id': halo_id, 'halo_to_id': value.id, 'relation_id': dict_ids[name],
+                                  'weight': 1.0, 'creator_id': creator_id})
+            else:
+                property_rows.append(self._make_property_row(halo_id, dict_ids[name], creator_id, value))
+        return property_rows, link_rows
+
+    def __call__(self, property_list):
+        session = self._session or core.get_default_session()
+        self._mark("lock")
+
+        names = {p[1] for p in property_list if p[2] is not None}
+        dict_ids = self._get_dictionary_ids(session, names)
+        creator_id = self._creator_id or core.creator.get_creator(session).id
+        self._mark("dictionary")
+
+        property_rows, link_rows = self._make_rows(property_list, dict_ids, creator_id)
+        self._mark("pack")
+
+        connection = session.connection()
+        if len(property_rows)>0:
+            connection.execute(core.halo_data.HaloProperty.__table__.insert(), property_rows)
+        if len(link_rows)>0:
+            connection.execute(core.halo_data.HaloLink.__table__.insert(), link_rows)
+        session.commit()
+        self._mark("commit")
+
+        number = len(property_rows) + len(link_rows)
+        if self.timing_monitor is not None:
+            self.timing_monitor.count(number, "rows")
+        return number
+
+
+def insert_list(property_list, inserter=None):
+    """Insert a list of (halo, name, value) tuples into the database, holding the insert_list lock if in parallel
+
+    By default, ORM objects are created for each property or link. Alternatively, an inserter such as a
+    BulkInserter may be specified to take care of the actual insertion."""
     from tangos import parallel_tasks as pt
 
+    if inserter is None:
+        inserter = _insert_list_unlocked
+
     if pt.backend!=None:
         with pt.ExclusiveLock("insert_list"):
-            return _insert_list_unlocked(property_list)
+            return inserter(property_list)
     else:
-        return _insert_list_unlocked(property_list)
+        return inserter(property_list)
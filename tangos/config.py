@@ -39,6 +39,18 @@ pynbody_build_kdtree_threshold_count = 2000
 # If the number of regions being queried on a timestep is expected to exceed this number,
 # a KDTree will be built to accelerate the region queries.
 
+kdtree_cache_directory = os.environ.get("TANGOS_KDTREE_CACHE_DIRECTORY", None)
+# If set, KDTrees built for pynbody snapshots are saved in this directory, keyed by the snapshot path, its
+# modification time and the number of particles. Later runs (and other processes, including shared-memory clients of
+# the pynbody server) then memory-map the saved tree rather than building it again. Each tree takes roughly
+# 8 bytes per particle plus a few percent for the nodes.
+
+halo_membership_index_directory = os.environ.get("TANGOS_MEMBERSHIP_INDEX_DIRECTORY", None)
+# If set, the particle membership of every object in a halo catalogue is saved in this directory the first time an
+# object is loaded with load-mode=partial, and later partial loads (in any process) memory-map it rather than reading
+# the halo finder's files. The index is rebuilt if the snapshot, or any file alongside it whose name begins with the
+# snapshot's name, is modified; if a catalogue is kept elsewhere, empty the directory after re-running the halo finder.
+
 pynbody_build_kdtree_all_cpus = True
 # If True, allow the server process to take over all available CPUs when building a
 # KDTree. This is despite the fact that most parallelism takes place across different client
@@ -46,17 +58,43 @@ pynbody_build_kdtree_all_cpus = True
 # to be waiting on the server anyway. If set to False, pynbody determines the number of
 # CPUs for the KDTree build, which on a system well configured for tangos would be 1.
 
+pynbody_server_prefetch_depth = 0
+# The number of queued snapshots that the pynbody server (see --load-mode=server) reads in a background thread
+# while clients are still working on the current snapshot. Arrays that were loaded for the current snapshot, and the
+# halo catalogue, are also read in advance. Prefetching is off by default, since it needs memory for more than one
+# snapshot at a time; it also requires pynbody_server_memory_budget to be set.
+
+pynbody_server_memory_budget = 0
+# The number of bytes of snapshot data that the pynbody server may hold in addition to the snapshot currently in use,
+# i.e. for prefetched snapshots and for recently-released snapshots that may be requested again. A prefetch still
+# being read is counted as the size of the current snapshot. When the budget is exceeded, the least recently used
+# snapshots are closed and no further prefetching takes place. The default of 0 keeps only the current snapshot.
+
+pynbody_server_subsnap_cache_bytes = 1024**3
+# The number of bytes that the pynbody server may use to cache the regions and objects (subsnaps) requested by
+# clients for the current snapshot, including their index lists and any arrays held by them. The least recently
+# used subsnaps are discarded first when the budget is exceeded.
+
 default_backend = 'null'
 # the default paralellism backend. Set e.g. to mpi4py to avoid having to pass --backend mpi4py to all parallel runs.
 
+parallel_job_chunk_seconds = 1.0
+parallel_job_chunk_max = 1000
+# Distributed loops over many short jobs (e.g. the halos processed by tangos write in server mode) hand each process
+# a chunk of jobs at a time, sized so that the chunk takes about parallel_job_chunk_seconds (based on how long that
+# process's previous jobs took), but never more than parallel_job_chunk_max jobs.
+
+multiprocessing_shared_memory_min_bytes = 512*1024
+# Under the multiprocessing backend, numpy arrays of at least this many bytes (e.g. particle arrays sent by the
+# pynbody server) are passed between processes in shared memory segments, rather than being pickled through pipes.
+# Below roughly this size, creating the segment costs more than it saves (see benchmarks/multiprocessing_transfer.py).
+
 enable_async_message_processing = False
-# Async message processing was introduced in an effort to separate out long pynbody operations
-# on the server into a different thread. However, it can lead to subtle race conditions (e.g.
-# when transmitting numpy arrays which get turned into several return messages) and may (?) also
-# be implicated in hangs. It is also not clear whether the performance gains are meaningful in
-# any way. The above flag disables the async processing and makes the server process do everything
-# in a single queue, which should be more reliable. It may be that async processing should be
-# removed from the codebase entirely, but I am leaving it like this for now.
+# If True, the server processes the pynbody server's messages (loading snapshots and sending arrays from them, which
+# can take a long time) in a worker thread, so that lock and job requests from other processes are not held up behind
+# them (see parallel_tasks/async_message.py). Earlier implementations led to race conditions when numpy arrays were
+# returned as several messages, and were suspected of causing hangs, so this remains opt-in; by default the server
+# processes every message in turn in a single thread.
 
 
 
@@ -75,6 +113,15 @@ property_modules = map(str.strip, property_modules)
 
 file_ignore_pattern = []
 
+use_binary_array_format = False
+# If True, numeric arrays are stored in a pickle-free binary format that can be decoded quickly (and without
+# python). Databases containing arrays in this format cannot be read by older versions of tangos, so it is off by
+# default; arrays are then stored using pickle, as previously. Arrays in the binary format are always readable.
+
+binary_array_compression = 'zlib'
+# The compression used for arrays in the binary format: 'zlib', 'zstd' or 'lz4'. zstd and lz4 are faster, but need
+# the zstandard or lz4 package to be installed wherever the database is read, as well as where it is written.
+
 max_traverse_depth = 3
 
 # merger tree thinning criteria (applied at query time, not at time of writing links)
@@ -87,12 +134,39 @@ mergertree_max_hops = 500 # maximum number of timesteps to scan
 # relation finding paremeters for multi hop queries
 num_multihops_max_default = 100     # the maximum number of links to follow when searching for related halos
 max_relative_time_difference = 1e-4     # the maximum fractional difference in time between two contemporaneous timesteps when searching for related halos
+multihop_engine = 'auto' # 'recursive_cte', 'temp_table', 'in_memory' or 'auto'; see below
+
+# Multi hop queries can be performed either by issuing SQL statements for each hop into temporary tables
+# ('temp_table'), or as a single recursive common table expression ('recursive_cte'). The recursive CTE is far faster
+# for long searches but requires SQLite >= 3.8.3, PostgreSQL, MySQL >= 8 or MariaDB >= 10.2. With 'auto', the recursive
+# CTE is used where it reproduces the temp_table results exactly (i.e. for major progenitor/descendant searches and
+# for searches with combine_routes=False). Forcing 'recursive_cte' also uses it for other searches, by enumerating all
+# routes and then keeping the strongest; this differs only in rare edge cases, but can be slow for highly-connected
+# link graphs. Searches that the recursive CTE does not support always fall back to temp tables.
+#
+# With 'in_memory', all links within the simulation are loaded into numpy arrays the first time they are needed, and
+# searches restricted to one simulation (e.g. progenitors and descendants) then run without any per-hop SQL. The
+# arrays are cached for the lifetime of the process, and reloaded if links are added or removed. This is the fastest
+# option when many searches are made in the same simulation, at the cost of memory. Other searches behave as for 'auto'.
+#
+# Independently of the above, if 'tangos build-major-branches' has been run since links were last added or removed,
+# major progenitor and descendant searches with default parameters are answered from the precomputed branches, except
+# with 'temp_table'.
 
 # On some network file systems, concurrency using sqlite is dodgy to say the least. After committing a transaction
-# on one node, and before attempting to open a new transaction on another node, it seems empirically helpful to
-# allow a significant time delay. This variable controls that delay.
-DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK = 1.0
-# number of seconds to sleep after a lock is released before reallocating it
+# on one node, and before attempting to open a new transaction on another node, it can be empirically helpful to
+# allow a significant time delay. This variable controls that delay, i.e. the number of seconds a process waits after
+# acquiring a lock that another process has just released from exclusive use. Since the delay limits the whole run to
+# one exclusive lock per delay, the default (None) applies it only to sqlite databases, with a delay of 1.0, and not
+# to database servers such as PostgreSQL or MySQL. Set it to 0.0 to remove the delay for sqlite on a local disk.
+DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK = None
+
+# The number of parsed live calculation expressions kept by the parser (see live_calculation/parser.py). Later
+# requests for the same expression are copied from the cache instead of being parsed again.
+live_calculation_parse_cache_size = 1000
+
+# Live calculation expressions parsed when the web server starts, e.g. those used by frequently-visited pages
+webview_prewarm_expressions = []
 
 # Default format to use in the webview. Can be either svg or png
 webview_default_image_format = 'svg'
@@ -119,6 +193,15 @@ PROPERTY_WRITER_MAXIMUM_TIME_BETWEEN_COMMITS = 600 # seconds
 # Property writer: don't bother committing even if a timestep is finished if this time hasn't elapsed:
 PROPERTY_WRITER_MINIMUM_TIME_BETWEEN_COMMITS = 300 # seconds
 
+# Property writer: whether to commit using Core-level bulk inserts by default, bypassing the ORM (equivalent to
+# passing --bulk-insert to tangos write)
+PROPERTY_WRITER_BULK_INSERT = False
+
+# Property writer: when using a dedicated writer (--dedicated-writer), the number of results each process accumulates
+# before streaming them to the writer, and the maximum number of rows the writer will queue before making processes wait
+PROPERTY_WRITER_DEDICATED_WRITER_BATCH_SIZE = 1000
+PROPERTY_WRITER_DEDICATED_WRITER_MAX_QUEUED_ROWS = 100000
+
 # Minimum time between providing updates to the user during tangos write, when running in parallel
 # Note that this is a 'polling' interval, for checking whether to update the display. Internally, the
 # statistics are updated whenever a commit is made by any process (and the frequency of such commits
@@ -56,6 +56,7 @@ from .creator import Creator
 from .dictionary import DictionaryItem
 from .halo import SimulationObjectBase
 from .halo_data import HaloLink, HaloProperty
+from .major_branch import MajorBranch, MajorBranchStatus
 from .simulation import Simulation, SimulationProperty
 from .timestep import TimeStep
 from .tracking import TrackData, update_tracker_halos
@@ -70,6 +71,9 @@ Index("haloproperties_creator_index", HaloProperty.__table__.c.creator_id)
 Index("halolink_index", HaloLink.__table__.c.halo_from_id)
 Index("halolink_bidirectional_index", HaloLink.__table__.c.halo_to_id, HaloLink.__table__.c.halo_from_id)
 Index("named_halolink_index", HaloLink.__table__.c.relation_id, HaloLink.__table__.c.halo_from_id)
+Index("majorbranch_halo_index", MajorBranch.__table__.c.halo_id, MajorBranch.__table__.c.direction)
+Index("majorbranch_branch_index", MajorBranch.__table__.c.branch_id, MajorBranch.__table__.c.direction,
+      MajorBranch.__table__.c.depth)
 
 
 
@@ -5,18 +5,32 @@ of different types has to be stored in different attributes.
 import datetime
 import functools
 import pickle
+import struct
 import sys
 import time
 import zlib
 
 import numpy as np
 
+from .. import config
+
 pickle_loads = pickle.loads
 if int(sys.version[0])==3:
     pickle_loads = functools.partial(pickle.loads, encoding='latin1')
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
 
 _THRESHOLD_FOR_COMPRESSION = 1000
+_MAXIMUM_COMPRESSED_FRACTION = 0.8 # binary arrays are stored uncompressed unless compression saves at least 20%
 
 def get_data_of_unknown_type(obj):
     """Starting from the ORM object, extract data which may be stored in a variety of attributes depending on its type"""
@@ -28,6 +42,16 @@ def set_data_of_unknown_type(obj, data):
     mapper = DataAttributeMapper(data=data)
     mapper.set(obj,data)
 
+def pack_data_of_unknown_type(data):
+    """Return (attribute_name, packed_data) describing how the given data would be stored in an ORM object
+
+    This allows rows to be constructed for Core-level inserts without instantiating ORM objects. The
+    attribute_name is None if the data is None."""
+    mapper = DataAttributeMapper(data=data)
+    if mapper._attribute_name is None:
+        return None, None
+    return mapper._attribute_name, mapper.pack(data)
+
 
 class DataAttributeMapper:
     _order = 0
@@ -152,11 +176,129 @@ class IntAttributeMapper(ArrayDowncastingAttributeMapper):
     _handled_types = [int, np.int32, np.int64, np.uint32, np.uint64]
 
 
+class BinaryArrayFormat:
+    """Pickle-free storage of numeric arrays, identified by the prefix B1.
+
+    After the prefix, the layout (all integers little-endian) is:
+
+      uint8 compression (0=none, 1=zlib, 2=zstd, 3=lz4 frame)
+      uint8 ndim, followed by ndim int64 giving the shape
+      uint8 length of dtype string, followed by the dtype string (e.g. '<f8')
+      uint16 length of units string, followed by the utf-8 units string (empty if there are no units)
+      the C-contiguous array buffer, compressed as specified
+
+    The compression is chosen by config.binary_array_compression."""
+
+    prefix = b"B1"
+
+    _NONE, _ZLIB, _ZSTD, _LZ4 = range(4)
+
+    @classmethod
+    def can_pack(cls, data):
+        return isinstance(data, np.ndarray) and data.dtype.kind in "biufc" and \
+               (type(data) is np.ndarray or cls._get_units_string(data) is not None)
+
+    @staticmethod
+    def _get_units_string(data):
+        """Return a string representation of the units of a SimArray, or None if they cannot be round-tripped"""
+        if type(data) is np.ndarray:
+            return ""
+        try:
+            import pynbody
+            if type(data) is not pynbody.array.SimArray:
+                return None
+            if isinstance(data.units, pynbody.units.NoUnit):
+                return ""
+            units_string = str(data.units)
+            if pynbody.units.Unit(units_string) != data.units:
+                return None
+            return units_string
+        except Exception:
+            return None
+
+    @classmethod
+    def _compress(cls, buffer):
+        compression = config.binary_array_compression
+        if compression == 'zlib':
+            return cls._ZLIB, zlib.compress(buffer)
+        elif compression == 'zstd':
+            if zstandard is None:
+                raise ImportError("binary_array_compression is 'zstd'; install the zstandard package to use it")
+            return cls._ZSTD, zstandard.ZstdCompressor().compress(buffer)
+        elif compression == 'lz4':
+            if lz4 is None:
+                raise ImportError("binary_array_compression is 'lz4'; install the lz4 package to use it")
+            return cls._LZ4, lz4.frame.compress(buffer)
+        else:
+            raise ValueError("Unknown binary_array_compression %r" % compression)
+
+    @classmethod
+    def _decompress(cls, compression, payload):
+        if compression == cls._NONE:
+            return payload
+        elif compression == cls._ZLIB:
+            return zlib.decompress(payload)
+        elif compression == cls._ZSTD:
+            if zstandard is None:
+                raise ImportError("This array was compressed with zstd; install the zstandard package to read it")
+            return zstandard.ZstdDecompressor().decompress(payload)
+        elif compression == cls._LZ4:
+            if lz4 is None:
+                raise ImportError("This array was compressed with lz4; install the lz4 package to read it")
+            return lz4.frame.decompress(payload)
+        else:
+            raise ValueError("Unknown compression code %d in binary array" % compression)
+
+    @classmethod
+    def pack(cls, data):
+        units = cls._get_units_string(data).encode('utf-8')
+        dtype = data.dtype.str.encode('ascii')
+        buffer = np.ascontiguousarray(data).view(np.ndarray).tobytes()
+
+        compression = cls._NONE
+        if len(buffer) > _THRESHOLD_FOR_COMPRESSION:
+            compressed_compression, compressed = cls._compress(buffer)
+            if len(compressed) < _MAXIMUM_COMPRESSED_FRACTION * len(buffer):
+                compression, buffer = compressed_compression, compressed
+
+        header = struct.pack("<BB%dq" % data.ndim, compression, data.ndim, *data.shape) + \
+                 struct.pack("<B", len(dtype)) + dtype + struct.pack("<H", len(units)) + units
+        return cls.prefix + header + buffer
+
+    @classmethod
+    def unpack(cls, packed):
+        view = memoryview(packed)
+        offset = len(cls.prefix)
+        compression, ndim = struct.unpack_from("<BB", view, offset)
+        offset += 2
+        shape = struct.unpack_from("<%dq" % ndim, view, offset)
+        offset += 8 * ndim
+        dtype_len, = struct.unpack_from("<B", view, offset)
+        offset += 1
+        dtype = np.dtype(bytes(view[offset:offset + dtype_len]).decode('ascii'))
+        offset += dtype_len
+        units_len, = struct.unpack_from("<H", view, offset)
+        offset += 2
+        units = bytes(view[offset:offset + units_len]).decode('utf-8')
+        offset += units_len
+
+        # decoded into a bytearray so that, like an unpickled array, the result can be modified in place
+        data = np.frombuffer(bytearray(cls._decompress(compression, view[offset:])), dtype=dtype).reshape(shape)
+        if len(units)>0:
+            import pynbody
+            data = data.view(pynbody.array.SimArray)
+            data.units = units
+        return data
+
+
 class ArrayAttributeMapper(DataAttributeMapper):
     _attribute_name = "data_array"
     _handled_types = [list, np.ndarray]
     _order = 1 # must be used only when downcasting mappers have failed
 
+    def _unpack_binary(self, packed):
+        return BinaryArrayFormat.unpack(packed)
+
     def _unpack_compressed(self, packed):
         return pickle_loads(zlib.decompress(packed[2:]))
 
@@ -169,6 +311,8 @@ class ArrayAttributeMapper(DataAttributeMapper):
     def unpack(self, packed):
         if len(packed)==0:
             return None
+        elif packed.startswith(BinaryArrayFormat.prefix):
+            return self._unpack_binary(packed)
         elif packed.startswith(b"ZX"):
             return self._unpack_compressed(packed)
         elif packed.startswith(b"PX"):
@@ -177,6 +321,8 @@ class ArrayAttributeMapper(DataAttributeMapper):
             return self._unpack_old_format(packed)
 
     def pack(self, data):
+        if config.use_binary_array_format and BinaryArrayFormat.can_pack(data):
+            return BinaryArrayFormat.pack(data)
         dumped_st = pickle.dumps(data)
         if len(dumped_st) > _THRESHOLD_FOR_COMPRESSION:
             dumped_st = b"ZX" + zlib.compress(dumped_st)
@@ -198,4 +344,4 @@ class NullAttributeMapper(DataAttributeMapper):
     def get(self, db_object):
         return None
 
-__all__ = ['get_data_of_unknown_type', 'set_data_of_unknown_type']
+__all__ = ['get_data_of_unknown_type', 'set_data_of_unknown_type', 'pack_data_of_unknown_type']
@@ -1,6 +1,7 @@
 """Routines for getting halo properties and links, and data derived from them, starting with a Halo or other object
 """
 
+import numpy as np
 import sqlalchemy
 
 from . import data_attribute_mapper
@@ -18,6 +19,9 @@ class HaloPropertyGetter:
 
     This base class is used to retrieve the actual HaloProperty objects.
     """
+    _cache_collection_name = 'all_properties'
+    _cache_key_name = 'name_id'
+
     def use_fixed_cache(self, halo):
         return 'all_properties' not in sqlalchemy.inspect(halo).unloaded
 
@@ -52,13 +56,42 @@ class HaloPropertyGetter:
         :type halo: SimulationObjectBase
         :type property_id: int"""
 
-        return_vals = []
+        return self.postprocess_data_objects(self._cache_index(halo).get(property_id, []))
+
+    def get_from_cache_for_halos(self, halos, property_id, first_only=False):
+        """Get the specified property for each of the given halos from their existing in-memory caches
+
+        Returns a list with one entry per halo. The entry is None if the halo is None or does not have the
+        property; otherwise it is the list of results (or, if first_only is True, just the first result).
+
+        :type halos: list[SimulationObjectBase]
+        :type property_id: int
+        :type first_only: bool"""
+        objects = [self._cache_index(h).get(property_id) if h is not None else None for h in halos]
+        if first_only:
+            return [self.postprocess_data_objects(o[:1])[0] if o else None for o in objects]
+        else:
+            return [self.postprocess_data_objects(o) if o else None for o in objects]
 
-        for x in halo.all_properties:
-            if x.name_id == property_id:
-                return_vals.append(x)
+    def _cache_index(self, halo):
+        """Return a dictionary mapping each property id to the list of matching objects in the in-memory cache
 
-        return self.postprocess_data_objects(return_vals)
+        The dictionary is built on first use and stored on the halo, so that the linear scan of the cached
+        objects is made only once per halo, however many properties are subsequently extracted. It is rebuilt
+        if objects have since been added to or removed from the cache.
+
+        :type halo: SimulationObjectBase"""
+        collection = getattr(halo, self._cache_collection_name)
+        stored_name = '_tangos_cache_index_' + self._cache_collection_name
+        stored = halo.__dict__.get(stored_name)
+        if stored is not None and stored[0] is collection and stored[1] == len(collection):
+            return stored[2]
+
+        index = {}
+        for x in collection:
+            index.setdefault(getattr(x, self._cache_key_name), []).append(x)
+        halo.__dict__[stored_name] = (collection, len(collection), index)
+        return index
 
 
     def get_from_session(self, halo, property_id, session):
@@ -91,11 +124,7 @@ class HaloPropertyGetter:
         :type halo: SimulationObjectBase
         :type property_id: int"""
 
-        for x in halo.all_properties:
-            if x.name_id == property_id:
-                return True
-
-        return False
+        return property_id in self._cache_index(halo)
 
     def postprocess_data_objects(self, objects):
         """Post-process the ORM data objects to pull out the data in the form required"""
@@ -105,6 +134,8 @@ class HaloPropertyGetter:
 
 class HaloPropertyValueGetter(HaloPropertyGetter):
     """As HaloPropertyGetter, but return the data value (including automatic reassembly of the data if appropriate)"""
+    _scalar_mappers = (data_attribute_mapper.FloatAttributeMapper, data_attribute_mapper.IntAttributeMapper)
+
     def __init__(self):
         self._options = []
         self._providing_class = None
@@ -126,6 +157,45 @@ class HaloPropertyValueGetter(HaloPropertyGetter):
             except NameError:
                 pass
 
+    def get_scalar_column_from_cache(self, halos, property_id):
+        """Get the specified property for the given halos from their in-memory caches, as a typed numpy column
+
+        Returns a tuple of the column of values (for the halos that have the property) and a boolean array
+        indicating which halos have the property. If the property is not a plain scalar (e.g. it is an array,
+        or needs reassembly) None is returned instead, and the caller must use get_from_cache_for_halos.
+
+        :type halos: list[SimulationObjectBase]
+        :type property_id: int"""
+        objects = [self._first_from_cache_index(h, property_id) for h in halos]
+        present = np.array([o is not None for o in objects], dtype=bool)
+        present_objects = [o for o in objects if o is not None]
+        if len(present_objects)==0:
+            return None
+
+        self._infer_property_class(present_objects[0])
+        if hasattr(self._providing_class, 'reassemble'):
+            return None
+        self._setup_data_mapper(present_objects[0])
+        if not isinstance(self._mapper, self._scalar_mappers):
+            return None
+
+        attribute_name = self._mapper._attribute_name
+        values = [getattr(o, attribute_name) for o in present_objects]
+        if any(v is None for v in values):
+            # not all stored with the same type; can't assemble into a single typed column
+            return None
+
+        return np.array(values, dtype=type(values[0])), present
+
+    def _first_from_cache_index(self, halo, property_id):
+        if halo is None:
+            return None
+        objects = self._cache_index(halo).get(property_id)
+        if objects:
+            return objects[0]
+        else:
+            return None
+
     def _postprocess_one_result(self, property_object):
         self._infer_property_class(property_object)
 
@@ -154,13 +224,8 @@ class HaloPropertyRawValueGetter(HaloPropertyValueGetter):
 
 class HaloLinkGetter(HaloPropertyGetter):
     """As HaloPropertyGetter, but retrieve HaloLinks instead of HaloProperties"""
-    def get_from_cache(self, halo, property_id):
-        return_vals = []
-        for x in halo.all_links:
-            if x.relation_id == property_id:
-                return_vals.append(x)
-
-        return self.postprocess_data_objects(return_vals)
+    _cache_collection_name = 'all_links'
+    _cache_key_name = 'relation_id'
 
     def get_from_session(self, halo, property_id, session):
         from . import halo_data
@@ -168,13 +233,6 @@ class HaloLinkGetter(HaloPropertyGetter):
             halo_data.HaloLink.id)
         return self.postprocess_data_objects(query_links.all())
 
-    def cache_contains(self, halo, property_id):
-        for x in halo.all_links:
-            if x.relation_id == property_id:
-                return True
-
-        return False
-
     def keys_from_cache(self, halo):
         """Return a list of keys from an existing in-memory cache"""
         return [x.relation.text for x in halo.all_links]
@@ -0,0 +1,42 @@
+from sqlalchemy import Column, Integer
+
+from ..config import DOUBLE_PRECISION
+from . import Base
+
+# Neither table declares foreign keys, so that the presence of the derived tables never prevents objects or
+# simulations from being removed. Stale rows are instead detected through MajorBranchStatus (see
+# relation_finding.major_branch).
+
+class MajorBranch(Base):
+    """One object on a precomputed major progenitor (direction=-1) or major descendant (direction=+1) branch
+
+    Each object is stored once per direction, along with the next object on its branch (i.e. its major progenitor or
+    major descendant) and the weight of that step. Where several objects share the same next object, only one of them
+    continues the same branch_id; the others end their branch there, so that next_halo_id points into a different
+    branch (a junction). Following the branch from any object on it gives the same results as the corresponding
+    MultiHopMajorProgenitorsStrategy or MultiHopMajorDescendantsStrategy."""
+    __tablename__ = 'majorbranches'
+
+    id = Column(Integer, primary_key=True)
+    halo_id = Column(Integer, nullable=False)
+    next_halo_id = Column(Integer) # the next object along the branch, or None at its end
+    branch_id = Column(Integer, nullable=False) # the halo_id of the first object on the branch
+    depth = Column(Integer, nullable=False) # the position along the branch, starting from zero
+    direction = Column(Integer, nullable=False)
+    weight = Column(DOUBLE_PRECISION) # the aggregated link weight from the first object on the branch to this one
+    next_weight = Column(DOUBLE_PRECISION) # the link weight from this object to next_halo_id
+
+    def __repr__(self):
+        return "<MajorBranch halo_id=%d branch_id=%d depth=%d direction=%+d>"%(self.halo_id, self.branch_id,
+                                                                               self.depth, self.direction)
+
+
+class MajorBranchStatus(Base):
+    """Records when the major branches of a simulation were built, so that out-of-date branches are ignored"""
+    __tablename__ = 'majorbranchstatus'
+
+    id = Column(Integer, primary_key=True)
+    simulation_id = Column(Integer, nullable=False)
+    direction = Column(Integer, nullable=False)
+    max_link_id = Column(Integer) # the highest halolink id at the time the branches were built
+    num_links = Column(Integer) # the number of halolinks at the time the branches were built
@@ -1,6 +1,7 @@
 import os
 import os.path
 
+import numpy as np
 from sqlalchemy import Boolean, Column, ForeignKey, Integer, Text, and_
 from sqlalchemy.orm import Session, aliased, backref, relationship
 
@@ -155,6 +156,14 @@ class TimeStep(Base):
         # objects with incomplete lazy-loaded properties
         session = Session()
         try:
+            if sanitize and isinstance(property_description, live_calculation.MultiCalculation):
+                # if only stored scalar properties are requested, a direct query is far faster than building
+                # ORM objects
+                calculation_results = live_calculation.query_scalar_columns.QueryScalarColumns(
+                    property_description, self, session).calculate(object_typecode, limit, order_by_halo_number)
+                if calculation_results is not None:
+                    return calculation_results
+
             halo_alias = SimulationObjectBase
             raw_query = session.query(SimulationObjectBase).filter_by(timestep_id=self.id)
             if order_by_halo_number:
@@ -182,6 +191,101 @@ class TimeStep(Base):
         """The old alias for calculate_all, retained for compatibility"""
         return self.calculate_all(*args, **kwargs)
 
+    def calculate_for_progenitors_all(self, *plist, **kwargs):
+        """Run the specified calculations on the objects in this timestep and all their major progenitors
+
+        The major progenitor branches of all objects are followed together, which is far faster than calling
+        calculate_for_progenitors on each object in turn.
+
+        The parameters passed name the properties (or live-calculations) to return. The return value is a list with one
+        entry per property, each being a 2D numpy masked array of shape (number of objects, number of timesteps). The
+        first index runs over the objects in this timestep, in the same order as calculate_all. The second index runs
+        over this timestep and then successively earlier timesteps. Entries are masked where there is no progenitor in
+        the corresponding timestep, or where no result could be obtained.
+
+        :param object_type: integer or string representing the particular object type
+                            (e.g. 'halo', 'BH' or 'group'). If None (default), all
+                            types are included.
+
+        :param limit: maximum number of objects to use. If None (default), all are included.
+
+        :param order_by_halo_number: if True, order by halo number; otherwise by database ID (default)
+
+        :param nmax: the maximum number of steps to follow along each branch
+        """
+        from .. import relation_finding
+        return self._calculate_for_branches_all(plist, kwargs,
+                                                relation_finding.multi_source.MultiSourceAllMajorProgenitorsStrategy,
+                                                -1)
+
+    def calculate_for_descendants_all(self, *plist, **kwargs):
+        """Run the specified calculations on the objects in this timestep and all their major descendants
+
+        The second index of the returned arrays runs over this timestep and then successively later timesteps. For
+        more information see calculate_for_progenitors_all."""
+        from .. import relation_finding
+        return self._calculate_for_branches_all(plist, kwargs,
+                                                relation_finding.multi_source.MultiSourceAllMajorDescendantsStrategy,
+                                                +1)
+
+    def _calculate_for_branches_all(self, plist, kwargs, strategy_class, direction):
+        from .. import live_calculation, temporary_halolist as thl
+        from . import Session
+        from .halo import SimulationObjectBase
+
+        object_typetag = kwargs.get('object_type', kwargs.get('object_typetag', None))
+        limit = kwargs.get('limit', None)
+        order_by_halo_number = kwargs.get('order_by_halo_number', False)
+        nmax = kwargs.get('nmax', config.num_multihops_max_default)
+
+        if isinstance(plist[0], live_calculation.Calculation):
+            property_description = plist[0]
+        else:
+            property_description = live_calculation.parser.parse_property_names(*plist)
+
+        # must be performed in its own session as we intentionally load in a lot of
+        # objects with incomplete lazy-loaded properties
+        session = Session()
+        try:
+            sources_query = session.query(SimulationObjectBase).filter_by(timestep_id=self.id)
+            if object_typetag:
+                sources_query = sources_query.filter_by(
+                    object_typecode=SimulationObjectBase.object_typecode_from_tag(object_typetag))
+            if order_by_halo_number:
+                sources_query = sources_query.order_by(SimulationObjectBase.halo_number, SimulationObjectBase.id)
+            else:
+                sources_query = sources_query.order_by(SimulationObjectBase.id)
+            if limit:
+                sources_query = sources_query.limit(limit)
+            sources = sources_query.all()
+
+            if direction>0:
+                later_or_earlier, time_order = TimeStep.time_gyr > self.time_gyr, TimeStep.time_gyr
+            else:
+                later_or_earlier, time_order = TimeStep.time_gyr < self.time_gyr, TimeStep.time_gyr.desc()
+            timestep_ids = [self.id] + [ts_id for ts_id, in session.query(TimeStep.id).filter(
+                TimeStep.simulation_id == self.simulation_id, later_or_earlier, TimeStep.id != self.id).
+                order_by(time_order)]
+            column_for_timestep_id = {ts_id: i for i, ts_id in enumerate(timestep_ids)}
+
+            values = np.empty((property_description.n_columns(), len(sources), len(timestep_ids)), dtype=object)
+
+            if len(sources)>0:
+                strategy = strategy_class(sources, nhops_max=nmax)
+                source_for_each_object = strategy.sources()
+                with strategy.temp_table() as tt:
+                    # the query has to be enumerated to keep any duplicate rows
+                    query = property_description.supplement_halo_query(thl.enumerated_halo_query(tt))
+                    objects = [x[1] for x in query.all()]
+                    values_for_each_object = property_description.values(objects)
+
+                columns = [column_for_timestep_id[obj.timestep_id] for obj in objects]
+                values[:, source_for_each_object, columns] = values_for_each_object
+        finally:
+            session.close()
+
+        return [_masked_array_from_objects(v) for v in values]
+
     @property
     def earliest(self):
         return self.get_final(-1)
@@ -264,3 +368,16 @@ class TimeStep(Base):
             q = q.order_by(TimeStep.time_gyr.desc())
 
         return q.first()
+
+
+def _masked_array_from_objects(values):
+    """Convert an object array with None for missing results into a masked array, with a numeric dtype if possible"""
+    from ..live_calculation import Calculation
+    mask = np.frompyfunc(lambda x: x is None, 1, 1)(values).astype(bool)
+    if (~mask).any():
+        present_values = Calculation._make_numpy_array(values[~mask])
+        if present_values.ndim==1 and present_values.dtype!=object:
+            data = np.zeros(values.shape, dtype=present_values.dtype)
+            data[~mask] = present_values
+            return np.ma.masked_array(data, mask)
+    return np.ma.masked_array(values, mask)
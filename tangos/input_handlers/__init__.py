@@ -7,9 +7,11 @@ overriding the functionality.
 For an introduction, see https://pynbody.github.io/tangos/input_handlers.html
 """
 
+import contextlib
 import importlib
 import os
 import os.path
+import threading
 import warnings
 import weakref
 
@@ -29,6 +31,7 @@ class DummyTimeStep:
 
 
 _loaded_timesteps = weakref.WeakValueDictionary()
+_thread_timesteps = threading.local() # timesteps made visible to load_timestep in one thread only; see timestep_in_this_thread
 
 
 class HandlerBase:
@@ -118,8 +121,10 @@ class HandlerBase:
     def load_timestep(self, ts_extension, mode=None):
         """Returns an object that connects to the data for a timestep on disk -- possibly a version cached in
         memory"""
-        ts_hash = hash((self._extension_to_filename(ts_extension),mode,type(self)))
-        stored_timestep = _loaded_timesteps.get(ts_hash, None)
+        ts_hash = self._timestep_cache_key(ts_extension, mode)
+        stored_timestep = getattr(_thread_timesteps, 'timesteps', {}).get(ts_hash, None)
+        if stored_timestep is None:
+            stored_timestep = _loaded_timesteps.get(ts_hash, None)
         if stored_timestep is not None:
             return stored_timestep
         else:
@@ -127,6 +132,26 @@ class HandlerBase:
             _loaded_timesteps[ts_hash] = data
             return data
 
+    def _timestep_cache_key(self, ts_extension, mode):
+        return hash((self._extension_to_filename(ts_extension),mode,type(self)))
+
+    def cache_timestep(self, ts_extension, data, mode=None):
+        """Make load_timestep return the given data, as previously returned by load_timestep_without_caching, in
+        place of any version already cached"""
+        _loaded_timesteps[self._timestep_cache_key(ts_extension, mode)] = data
+
+    @contextlib.contextmanager
+    def timestep_in_this_thread(self, ts_extension, data, mode=None):
+        """Within the context, make load_timestep return the given data in the calling thread only, without
+        affecting the cache seen by other threads. Methods that call load_timestep (such as get_catalogue) can then
+        be applied to data loaded by load_timestep_without_caching."""
+        timesteps = getattr(_thread_timesteps, 'timesteps', {})
+        _thread_timesteps.timesteps = {**timesteps, self._timestep_cache_key(ts_extension, mode): data}
+        try:
+            yield
+        finally:
+            _thread_timesteps.timesteps = timesteps
+
     def load_region(self, ts_extension, region_specification, mode=None, expected_number_of_queries=None):
         """Returns an object that connects to the data for a timestep on disk, filtered using the
         specified region specification. Acceptable region specifications are output handler dependent.
@@ -169,6 +194,27 @@ class HandlerBase:
         :arg mode - sets a method for loading the tracked region; see load_object mode for more information"""
         raise NotImplementedError
 
+    def load_tracked_regions(self, ts_extension, track_data_list, mode=None):
+        """Returns a list of objects that connect to the on-disk data for each of the specified tracked regions.
+
+        Handlers may override this to resolve the particles of all the tracked regions together; by default it calls
+        load_tracked_region for each one."""
+        return [self.load_tracked_region(ts_extension, track_data, mode) for track_data in track_data_list]
+
+    def match_objects_bidirectional(self, ts1, ts2, halo_min, halo_max, dm_only=False, threshold=0.005,
+                                    object_typetag='halo', output_handler_for_ts2=None):
+        """Match objects between two timesteps in both directions, returning a tuple of catalogues (forward, backward).
+
+        Each catalogue is in the format returned by match_objects. By default this simply calls match_objects once
+        in each direction; handlers that can derive both directions from a single pass over the particle data
+        override it."""
+        output_handler_for_ts2 = output_handler_for_ts2 or self
+        forward = self.match_objects(ts1, ts2, halo_min, halo_max, dm_only, threshold, object_typetag,
+                                     output_handler_for_ts2=output_handler_for_ts2)
+        backward = output_handler_for_ts2.match_objects(ts2, ts1, halo_min, halo_max, dm_only, threshold,
+                                                        object_typetag, output_handler_for_ts2=self)
+        return forward, backward
+
 
     @classmethod
     def handler_class_name(cls):
@@ -11,7 +11,7 @@ from collections import defaultdict
 import numpy as np
 from packaging.version import Version
 
-from ..util import proxy_object
+from ..util import kdtree_cache, membership_index, proxy_object
 
 pynbody = None # deferred import; occurs when a PynbodyInputHandler is constructed
 
@@ -98,7 +98,11 @@ class PynbodyInputHandler(finding.PatternBasedFileDiscovery, HandlerBase):
             raise NotImplementedError("Load mode %r is not implemented"%mode)
 
     def _build_kdtree(self, timestep, mode):
-        timestep.build_tree()
+        if isinstance(timestep, pynbody.snapshot.SimSnap):
+            kdtree_cache.build_tree(timestep)
+        else:
+            # a connection to a remote server, which builds (or loads) the tree itself
+            timestep.build_tree()
 
     def load_region(self, ts_extension, region_specification, mode=None, expected_number_of_queries=None) -> pynbody.snapshot.simsnap.SimSnap:
         timestep = self.load_timestep(ts_extension, mode)
@@ -140,8 +144,13 @@ class PynbodyInputHandler(finding.PatternBasedFileDiscovery, HandlerBase):
 
     def load_object(self, ts_extension, finder_id, finder_offset, object_typetag='halo', mode=None) -> pynbody.snapshot.simsnap.SimSnap:
         if mode=='partial':
-            h = self.get_catalogue(ts_extension, object_typetag)
-            h_file = h.load_copy(finder_id)
+            index = self._get_membership_index(ts_extension, object_typetag)
+            if index is None:
+                h = self.get_catalogue(ts_extension, object_typetag)
+                h_file = h.load_copy(finder_id)
+            else:
+                h_file = pynbody.load(self._extension_to_filename(ts_extension),
+                                      take=index.particle_indices(finder_id))
             h_file.physical_units()
             return h_file
         elif mode=='server' :
@@ -174,9 +183,29 @@ class PynbodyInputHandler(finding.PatternBasedFileDiscovery, HandlerBase):
         else:
             raise NotImplementedError("Load mode %r is not implemented"%mode)
 
+    def _get_membership_index(self, ts_extension, object_typetag):
+        """Return the saved membership of the objects in the timestep, building it from the catalogue if necessary,
+        or None if membership is not being indexed (see util.membership_index)"""
+        files = membership_index.index_files(self._extension_to_filename(ts_extension), type(self).__name__,
+                                             object_typetag)
+        if files is None:
+            return None
+        index = membership_index.load_index(files)
+        if index is None:
+            index = membership_index.build_index(lambda: self.get_catalogue(ts_extension, object_typetag), files)
+        return index
+
     def load_tracked_region(self, ts_extension, track_data, mode=None) -> pynbody.snapshot.simsnap.SimSnap:
         f = self.load_timestep(ts_extension, mode)
         indices = self._get_indices_for_snapshot(f, track_data)
+        return self._tracked_region_from_indices(f, indices, mode)
+
+    def load_tracked_regions(self, ts_extension, track_data_list, mode=None) -> list[pynbody.snapshot.simsnap.SimSnap]:
+        f = self.load_timestep(ts_extension, mode)
+        indices_list = self._get_indices_for_snapshot_batch(f, track_data_list)
+        return [self._tracked_region_from_indices(f, indices, mode) for indices in indices_list]
+
+    def _tracked_region_from_indices(self, f, indices, mode):
         if mode=='partial':
             return pynbody.load(f.filename, take=indices)
         elif mode is None:
@@ -184,33 +213,49 @@ class PynbodyInputHandler(finding.PatternBasedFileDiscovery, HandlerBase):
         else:
             raise NotImplementedError("Load mode %r is not implemented"%mode)
 
-
     def _get_indices_for_snapshot(self, f, track_data):
-        pt = track_data.particles
-        if track_data.use_iord is True:
-
-            dm_part = f.dm[np.in1d(f.dm['iord'], pt)]
-
-            try:
-                star_part = f.star[np.in1d(f.star['iord'], pt)]
-            except KeyError:
-                star_part = f[0:0]
+        return self._get_indices_for_snapshot_batch(f, [track_data])[0]
+
+    def _get_indices_for_snapshot_batch(self, f, track_data_list):
+        """Return the sorted snapshot indices of the particles in each TrackData, resolving all iords in one pass"""
+        results = [track_data.particles for track_data in track_data_list]
+        uses_iord = [i for i, track_data in enumerate(track_data_list) if track_data.use_iord is True]
+        if len(uses_iord)==0:
+            return results
+
+        sorted_iord, sorted_index = self._get_sorted_iord(f)
+        all_iord = np.concatenate([results[i] for i in uses_iord])
+        position = np.searchsorted(sorted_iord, all_iord)
+        found = position<len(sorted_iord)
+        found[found] = sorted_iord[position[found]] == all_iord[found]
+        all_index = np.full(len(all_iord), -1, dtype=np.int64)
+        all_index[found] = sorted_index[position[found]]
+
+        split_points = np.cumsum([len(results[i]) for i in uses_iord])[:-1]
+        for i, index in zip(uses_iord, np.split(all_index, split_points)):
+            results[i] = np.unique(index[index>=0]) # sorted, and without duplicates, as selecting with in1d would be
+        return results
 
-            try:
-                gas_part = f.gas[np.in1d(f.gas['iord'], pt)]
-            except KeyError:
-                gas_part = f[0:0]
-
-            # fx = dm_part.union(star_part)
-            # fx = fx.union(gas_part)
-            # return fx
-            ilist = np.hstack((dm_part.get_index_list(f),
-                               star_part.get_index_list(f),
-                               gas_part.get_index_list(f)))
-            ilist = np.sort(ilist)
-            return ilist
-        else:
-            return pt
+    @staticmethod
+    def _get_sorted_iord(f):
+        """Return the iords of the dm, star and gas particles in the snapshot, sorted, along with their indices.
+
+        The arrays are cached alongside the cached regions (see load_region), so that each tracked particle can
+        be found by binary search rather than scanning the whole snapshot for every tracker."""
+        if getattr(f, '_tangos_cached_sorted_iord', None) is None:
+            iords, indices = [], []
+            for family in (pynbody.family.dm, pynbody.family.star, pynbody.family.gas):
+                try:
+                    family_iord = f[family]['iord']
+                except KeyError:
+                    continue
+                iords.append(np.asarray(family_iord))
+                indices.append(f[family].get_index_list(f))
+            iord = np.concatenate(iords) if len(iords)>0 else np.zeros(0, dtype=np.int64)
+            index = np.concatenate(indices) if len(indices)>0 else np.zeros(0, dtype=np.int64)
+            order = np.argsort(iord, kind='stable')
+            f._tangos_cached_sorted_iord = (iord[order], index[order])
+        return f._tangos_cached_sorted_iord
 
 
 
@@ -270,6 +315,82 @@ class PynbodyInputHandler(finding.PatternBasedFileDiscovery, HandlerBase):
 
         return matches
 
+    def match_objects_bidirectional(self, ts1, ts2, halo_min, halo_max, dm_only=False, threshold=0.005,
+                                    object_typetag='halo', output_handler_for_ts2=None):
+        """Match objects in both directions from one sparse count of the particles shared by each pair of objects.
+
+        The particles common to both timesteps are identified from their sorted iords, and the shared particle
+        counts are accumulated only for pairs of objects that actually share particles. Normalising the counts by
+        row gives the same forward catalogue as match_objects, and by column the same backward catalogue, without
+        computing the dense transfer matrix twice. Falls back to two calls to match_objects where that is not
+        possible."""
+        output_handler_for_ts2 = output_handler_for_ts2 or self
+        if not (self._uses_generic_matching() and isinstance(output_handler_for_ts2, PynbodyInputHandler)
+                and output_handler_for_ts2._uses_generic_matching()):
+            return super().match_objects_bidirectional(ts1, ts2, halo_min, halo_max, dm_only, threshold,
+                                                       object_typetag, output_handler_for_ts2)
+
+        only_family = pynbody.family.dm if dm_only else None
+
+        f1 = self.load_timestep(ts1)
+        h1 = self.get_catalogue(ts1, object_typetag)
+        f2 = output_handler_for_ts2.load_timestep(ts2)
+        h2 = output_handler_for_ts2.get_catalogue(ts2, object_typetag)
+
+        try:
+            iord1, group1 = self._sorted_iord_and_group_index(f1, h1, object_typetag, only_family)
+            iord2, group2 = output_handler_for_ts2._sorted_iord_and_group_index(f2, h2, object_typetag, only_family)
+        except KeyError:
+            logger.warning("No particle iords available for single-pass matching; falling back to match_objects")
+            return super().match_objects_bidirectional(ts1, ts2, halo_min, halo_max, dm_only, threshold,
+                                                       object_typetag, output_handler_for_ts2)
+
+        # both iord arrays are sorted, so the particles in common are found by binary search
+        position_in_2 = np.minimum(np.searchsorted(iord2, iord1), len(iord2)-1)
+        common1 = np.where(iord2[position_in_2] == iord1)[0] if len(iord2)>0 else np.zeros(0, dtype=np.intp)
+        group1 = group1[common1]
+        group2 = group2[position_in_2[common1]]
+        in_both = (group1 >= 0) & (group2 >= 0)
+
+        n1, n2 = len(h1), len(h2)
+        pair_keys, counts = np.unique(group1[in_both] * n2 + group2[in_both], return_counts=True)
+        index1, index2 = np.divmod(pair_keys, n2)
+
+        forward = _fractional_matches(index1, index2, counts, n1, threshold,
+                                      h1.number_mapper.index_to_number, h2.number_mapper.index_to_number)
+        backward = _fractional_matches(index2, index1, counts, n2, threshold,
+                                       h2.number_mapper.index_to_number, h1.number_mapper.index_to_number)
+
+        if halo_max is None:
+            halo_max = max(n1, n2)
+        for matches in forward, backward:
+            for k in [k for k in matches if k < halo_min or k > halo_max]:
+                del matches[k]
+
+        return forward, backward
+
+    def _uses_generic_matching(self):
+        """Return True if this handler matches objects purely by shared particles through an iord-ordered bridge"""
+        return type(self).match_objects is PynbodyInputHandler.match_objects and \
+            type(self).create_bridge is PynbodyInputHandler.create_bridge
+
+    @staticmethod
+    def _sorted_iord_and_group_index(f, h, object_typetag, only_family):
+        """Return the sorted iords of particles (optionally in one family only) and the index of the object each
+        belongs to.
+
+        The result is stored on the snapshot, so that when the snapshot is kept alive between successive matches
+        (see the linker's --contiguous option) the particle-to-object mapping is only computed once."""
+        if not hasattr(f, '_db_sorted_iord_and_group_index'):
+            f._db_sorted_iord_and_group_index = {}
+        key = (object_typetag, only_family)
+        if key not in f._db_sorted_iord_and_group_index:
+            iord = np.asarray((f[only_family] if only_family else f)['iord'])
+            group = np.asarray(h.get_group_array(family=only_family, use_index=True), dtype=np.int64)
+            order = np.argsort(iord, kind='stable')
+            f._db_sorted_iord_and_group_index[key] = iord[order], group[order]
+        return f._db_sorted_iord_and_group_index[key]
+
 
     @classmethod
     def create_bridge(cls, f1, f2):
@@ -361,6 +482,23 @@ class PynbodyInputHandler(finding.PatternBasedFileDiscovery, HandlerBase):
         return estimated_part_mass
 
 
+def _fractional_matches(index_from, index_to, counts, n_from, threshold, from_index_to_number, to_index_to_number):
+    """Convert sparse shared-particle counts into a match_objects catalogue, normalising over each source object
+
+    Every source object has an entry, listing the objects with which it shares more than the threshold fraction of its
+    shared particles, in descending order of that fraction."""
+    totals = np.bincount(index_from, weights=counts, minlength=n_from)
+    fraction = counts / totals[index_from]
+    keep = fraction > threshold
+    index_from, index_to, fraction = index_from[keep], index_to[keep], fraction[keep]
+    order = np.lexsort((-fraction, index_from))
+
+    matches = {from_index_to_number(i): [] for i in range(n_from)}
+    for i, j, frac in zip(index_from[order], index_to[order], fraction[order]):
+        matches[from_index_to_number(i)].append((to_index_to_number(j), frac))
+    return matches
+
+
 class GadgetSubfindInputHandler(PynbodyInputHandler):
     patterns = ["snapshot_???"]
     auxiliary_file_patterns =["groups_???"]
@@ -13,6 +13,7 @@ from sqlalchemy.orm import (
     joinedload,
     undefer,
 )
+from sqlalchemy.orm.util import identity_key
 
 import tangos.core.dictionary
 import tangos.core.halo
@@ -22,7 +23,7 @@ from tangos.live_calculation.query_masking import QueryMask
 from tangos.live_calculation.query_multivalue_folding import QueryMultivalueFolding
 from tangos.util import consistent_collection
 
-from .. import core, temporary_halolist as thl
+from .. import core
 
 
 class UnknownValue:
@@ -129,6 +130,14 @@ class Calculation:
         properties of these values (if possible)"""
         raise NotImplementedError
 
+    def masked_column_and_description(self, halos):
+        """Return the values of this calculation as a numpy masked array, and a PropertyCalculation object (if available)
+
+        The array has one entry per halo, masked where the calculation has no result. This is only possible where
+        every result is a numeric scalar; otherwise (None, None) is returned and values_and_description must be
+        used instead."""
+        return None, None
+
     def values_sanitized_and_description(self, halos, load_into_session=None):
         """Return the 'sanitized' values of this calculation, as well as a PropertyCalculation object (if available).
 
@@ -188,25 +197,30 @@ class Calculation:
 
         return [self._make_numpy_array(x) for x in output_values]
 
-    def _refetch_halos_from_original_session(self, unsanitized_values, session):
-        output_halo_ids = []
-        halo_id_to_list_index = {}
+    _refetch_chunk_size = 500
 
+    def _refetch_halos_from_original_session(self, unsanitized_values, session):
+        output_halo_ids = {item.id for item in unsanitized_values.flat if isinstance(item, core.SimulationObjectBase)}
+        if len(output_halo_ids) == 0:
+            return
+
+        # Halos already in the session are taken from its identity map; the rest are fetched in bulk by id
+        halo_class = core.SimulationObjectBase
+        halo_from_id = {}
+        for halo_id in output_halo_ids:
+            halo = session.identity_map.get(identity_key(halo_class, halo_id))
+            if halo is not None:
+                halo_from_id[halo_id] = halo
+        ids_to_fetch = sorted(output_halo_ids.difference(halo_from_id.keys()))
+        for start in range(0, len(ids_to_fetch), self._refetch_chunk_size):
+            chunk = ids_to_fetch[start:start+self._refetch_chunk_size]
+            halo_from_id.update((h.id, h) for h in session.query(halo_class).filter(halo_class.id.in_(chunk)))
+
+        # Now work through the original output and replace all SimulationObjectBase instances with the
+        # new ones
         for i, item in enumerate(unsanitized_values.flat):
             if isinstance(item, core.SimulationObjectBase):
-                output_halo_ids.append(item.id)
-                halo_id_to_list_index[item.id] = i
-        if len(output_halo_ids) > 0:
-            with thl.temporary_halolist_table(session, output_halo_ids) as tab:
-                results = thl.enumerated_halo_query(tab).all() # must be enumerated to keep duplicates
-
-            # Now work through the original output and replace all SimulationObjectBase instances with the
-            # new ones
-            j = 0
-            for i, item in enumerate(unsanitized_values.flat):
-                if isinstance(item, core.SimulationObjectBase):
-                    unsanitized_values.flat[i] = results[j][1]
-                    j+=1
+                unsanitized_values.flat[i] = halo_from_id.get(item.id)
 
 
 
@@ -334,20 +348,51 @@ class MultiCalculation(Calculation):
         halos = np.asarray(halos, dtype=object)
         mask = QueryMask()
         mask.mark_nones_as_masked(halos)
-        for c in self.calculations:
-            values, description = c.values_and_description(mask.mask(halos))
-            results[c_column:c_column+c.n_columns()] = mask.unmask(values)
-            # TODO: in principle this masking should _not_ occur unless we know the user has called values_sanitized
-            # - other calls should not cross-contaminate columns in this way
-            mask.mark_nones_as_masked(values)
-            c_column+=c.n_columns()
+        with query_link_targets.QueryLinkTargets.active():
+            # any links in the calculations share one temporary table
+            for c in self.calculations:
+                values, description = c.values_and_description(mask.mask(halos))
+                results[c_column:c_column+c.n_columns()] = mask.unmask(values)
+                # TODO: in principle this masking should _not_ occur unless we know the user has called values_sanitized
+                # - other calls should not cross-contaminate columns in this way
+                mask.mark_nones_as_masked(values)
+                c_column+=c.n_columns()
 
         # TODO - problem: there is no good description of multiple properties
         return results, description
 
+    def values_sanitized(self, halos, load_into_session=None):
+        columns = self._scalar_columns_sanitized(halos)
+        if columns is None:
+            return super().values_sanitized(halos, load_into_session)
+        else:
+            return columns
+
+    def _scalar_columns_sanitized(self, halos):
+        """Assemble the sanitized values directly from typed numpy columns, if all calculations give numeric scalars
+
+        Returns None if any of the calculations cannot be evaluated as a masked column (see
+        masked_column_and_description), in which case the general (object array) route must be taken"""
+        if any(h is None for h in halos):
+            return None
+        columns = []
+        keep_rows = np.ones(len(halos), dtype=bool)
+        for c in self.calculations:
+            column, _ = c.masked_column_and_description(halos)
+            if column is None:
+                return None
+            columns.append(column)
+            keep_rows &= ~np.ma.getmaskarray(column)
+        # select the halos for which all calculations have a result
+        return [column.data[keep_rows] for column in columns]
+
     def n_columns(self):
         return sum(c.n_columns() for c in self.calculations)
 
+    def retrieves_only_stored_values(self):
+        """Return True if every sub-calculation just retrieves stored values, with no live calculation or links"""
+        return all(isinstance(c, StoredProperty) and c.retrieves_only_stored_values() for c in self.calculations)
+
 
 class FixedInput(Calculation):
     """Represents a calculation that returns a fixed value"""
@@ -385,9 +430,15 @@ class FixedNumericInput(FixedInput):
     def __str__(self):
         return str(self.value)
 
+    def masked_column_and_description(self, halos):
+        return np.ma.array(np.full(len(halos), self.value)), self.value
+
 class LiveProperty(Calculation):
     """Represents a calculation that is achieved by executing the live_calculate method of a Properties instance"""
     def __new__(cls, *tokens):
+        if not tokens:
+            # being copied or unpickled; the class is already known
+            return object.__new__(cls)
         if BuiltinFunction.has_function(str(tokens[0])):
             return object.__new__(BuiltinFunction)
         else:
@@ -469,6 +520,12 @@ class LiveProperty(Calculation):
         results_array[0, :] = results
         return results_array
 
+    @classmethod
+    def _masked_column_as_1xn_array(cls, column):
+        results_array = cls._as_1xn_array(list(column.data)) # list of numpy scalars, as from the per-halo route
+        results_array[0, np.ma.getmaskarray(column)] = None
+        return results_array
+
     def proxy_value(self):
         return UnknownValue(self)
 
@@ -497,6 +554,7 @@ class BuiltinFunction(LiveProperty):
         cls.__registered_functions[func.__name__] = {'function': func}
         func.set_input_options = lambda arg_id, **kwargs: cls.set_input_options(func, arg_id, **kwargs)
         func.set_initialisation = lambda init_fn: cls.set_initialisation(func, init_fn)
+        func.set_columnar = lambda columnar_fn: cls.set_columnar(func, columnar_fn)
         return func
 
     @classmethod
@@ -518,12 +576,36 @@ class BuiltinFunction(LiveProperty):
         """For the registered function, add an initialisation function that receives the input objects"""
         cls.__registered_functions[func.__name__]['initialisation'] = initialisation_func
 
+    @classmethod
+    def set_columnar(cls, func, columnar_func):
+        """For the registered function, add a version that operates on whole columns at once.
+
+        The columnar version receives the list of halos and then a numpy masked array for each argument, masked
+        for halos without a value. It must return a masked array of results. It is used whenever all the
+        inputs can be evaluated as masked columns of numeric scalars (see Calculation.masked_column_and_description);
+        otherwise the registered function is called as normal."""
+        cls.__registered_functions[func.__name__]['columnar'] = columnar_func
+
     @classmethod
     def has_function(cls, func_name):
         return func_name in list(cls.__registered_functions.keys())
 
     def __init__(self, *tokens):
         super().__init__(*tokens)
+        self._initialise()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_func'], state['_info']
+        return state
+
+    def __setstate__(self, state):
+        # the function returned by an initialisation may refer to objects belonging to this calculation (e.g. the
+        # Link built by link()), so is regenerated for the copy rather than shared with the original
+        self.__dict__.update(state)
+        self._initialise()
+
+    def _initialise(self):
         self._func = self.__registered_functions[self._name]['function']
         self._info = self.__registered_functions[self._name]
         for i in range(len(self._inputs)):
@@ -543,6 +625,34 @@ class BuiltinFunction(LiveProperty):
         else:
             return default
 
+    def values_and_description(self, halos):
+        column, description = self.masked_column_and_description(halos)
+        if column is None:
+            return super().values_and_description(halos)
+        else:
+            return self._masked_column_as_1xn_array(column), description
+
+    def masked_column_and_description(self, halos):
+        columnar_func = self._info.get('columnar')
+        if columnar_func is None or len(halos)==0:
+            return None, None
+        input_columns = []
+        input_descriptions = []
+        for input_id, input in enumerate(self._inputs):
+            if self._get_input_option(input_id, 'provide_proxy'):
+                return None, None
+            column, description = input.masked_column_and_description(halos)
+            if column is None:
+                return None, None
+            input_columns.append(column)
+            input_descriptions.append(description)
+
+        if len(input_descriptions)>0:
+            inherited_description = input_descriptions[0]
+        else:
+            inherited_description = None
+        return columnar_func(halos, *input_columns), inherited_description
+
     def _input_value_and_description(self, input_id, halos):
         if self._get_input_option(input_id, 'provide_proxy'):
             return self._inputs[input_id].proxy_value(), None
@@ -650,23 +760,17 @@ class Link(Calculation):
         return results, description
 
     def _get_values_and_description_from_halo_id_list(self, target_halo_ids):
+        # the targets are loaded into a new session (see QueryLinkTargets), because we might have cached copies
+        # of objects where a different set of properties has been loaded into all_properties
+        with query_link_targets.QueryLinkTargets.active() as link_targets:
+            target_halos_supplemented = link_targets.supplemented_halos(self.property, target_halo_ids)
 
-        new_session = core.Session()
-        # need a new session for the subqueries, because we might have cached copies of objects where
-        # a different set of properties has been loaded into all_properties
+            # sqlalchemy's deduplication means we are now missing any halos that appear more than once in
+            # target_halo_ids. But we actually want the duplication.
+            target_halos_supplemented_with_duplicates = \
+                self._add_entries_for_duplicates(target_halos_supplemented, target_halo_ids)
 
-        try:
-            with thl.temporary_halolist_table(new_session, target_halo_ids) as tab:
-                target_halos_supplemented = self.property.supplement_halo_query(thl.halo_query(tab)).all()
-
-                # sqlalchemy's deduplication means we are now missing any halos that appear more than once in
-                # target_halo_ids. But we actually want the duplication.
-                target_halos_supplemented_with_duplicates = \
-                    self._add_entries_for_duplicates(target_halos_supplemented, target_halo_ids)
-
-                values, description = self.property.values_and_description(target_halos_supplemented_with_duplicates)
-        finally:
-            new_session.connection().close()
+            values, description = self.property.values_and_description(target_halos_supplemented_with_duplicates)
         return values, description
 
     def _get_target_halos(self, source_halos):
@@ -714,24 +818,56 @@ class StoredProperty(Calculation):
     def values(self, halos):
         self._name_id = tangos.core.dictionary.get_dict_id(self._name)
         ret = np.empty((1,len(halos)),dtype=object)
-        for i, h in enumerate(halos):
-            if self._extraction_pattern.cache_contains(h, self._name_id):
-                if self._multivalued:
-                    ret[0,i]=self._extraction_pattern.get_from_cache(h, self._name_id)
-                else:
-                    ret[0, i] = self._extraction_pattern.get_from_cache(h, self._name_id)[0]
+        results = self._extraction_pattern.get_from_cache_for_halos(halos, self._name_id,
+                                                                    first_only=not self._multivalued)
+        for i, r in enumerate(results):
+            ret[0, i] = r
         return ret
 
+    def scalar_column_and_description(self, halos):
+        """Return the values of this property as a typed numpy column if it is a scalar, and a description
+
+        The column is a tuple of the values (for the halos that have the property) and a boolean array indicating
+        which halos have the property, or None if the values cannot be represented in this way."""
+        if not self.retrieves_only_stored_values():
+            return None, None
+        self._name_id = tangos.core.dictionary.get_dict_id(self._name)
+        column = self._extraction_pattern.get_scalar_column_from_cache(halos, self._name_id)
+        if column is None:
+            return None, None
+        return column, self._description(halos)
+
+    def masked_column_and_description(self, halos):
+        column, description = self.scalar_column_and_description(halos)
+        if column is None:
+            return None, None
+        values, present = column
+        if values.dtype.kind not in "biuf":
+            return None, None
+        data = np.zeros(len(halos), dtype=values.dtype)
+        data[present] = values
+        return np.ma.array(data, mask=~present), description
+
     def values_and_description(self, halos):
-        from .. import properties
         values = self.values(halos)
         if len(halos)==0:
             # cannot build a meaningful property description as we don't have any halos, therefore don't know
             # anything about the simulation or which property calculations are relevant for it
             return values, None
+        return values, self._description(halos)
 
+    def _description(self, halos):
         sim = consistent_collection.consistent_simulation_from_halos(halos)
-        description_class = properties.providing_class(self._name, sim.output_handler_class, silent_fail=True)
+        return self.description_for_simulation(sim)
+
+    def providing_class(self, sim):
+        """Return the PropertyCalculation class that provides this property for the given simulation, if any"""
+        from .. import properties
+        return properties.providing_class(self._name, sim.output_handler_class, silent_fail=True)
+
+    def description_for_simulation(self, sim):
+        """Return an instance of the PropertyCalculation class that provides this property, if possible"""
+        description_class = self.providing_class(sim)
         description = None
         if description_class is not None:
             try:
@@ -740,7 +876,12 @@ class StoredProperty(Calculation):
                 warnings.warn("%r occurred while trying to produce a property description from class %r"%
                               (e,description_class),
                               RuntimeWarning)
-        return values, description
+        return description
+
+    def retrieves_only_stored_values(self):
+        """Return True if this calculation just retrieves the first stored value of the property for each halo"""
+        return (not self._multivalued) and \
+            type(self._extraction_pattern) is extraction_patterns.HaloPropertyValueGetter
 
     def proxy_value(self):
         """Return a placeholder value for this calculation"""
@@ -750,4 +891,4 @@ class StoredProperty(Calculation):
 
 
 
-from . import builtin_functions, parser
+from . import builtin_functions, parser, query_link_targets, query_scalar_columns
@@ -5,76 +5,105 @@ import numpy as np
 from .. import BuiltinFunction, FixedNumericInput
 
 
+def columnar_op(op):
+    """Return a columnar version of an arithmetic operation (see BuiltinFunction.set_columnar)
+
+    As for the per-halo versions below, values are converted to floats before applying op, and the result
+    is masked wherever any of the inputs is masked."""
+    def columnar_version(halos, *columns):
+        mask = functools.reduce(np.logical_or, [np.ma.getmaskarray(c) for c in columns])
+        # masked entries are filled with a harmless value, so that they do not generate floating point warnings
+        result = op(*[np.ma.filled(c, 1).astype(float) for c in columns])
+        return np.ma.array(result, mask=mask)
+    return columnar_version
+
 @BuiltinFunction.register
 def abs(halos, vals):
     if not hasattr(vals[0], '__len__'):    # Avoid norm failing if abs is called on a single number (issue 110)
         return arithmetic_unary_op(vals, np.abs)
     else:
         return arithmetic_unary_op(vals, functools.partial(np.linalg.norm, axis=-1))
+abs.set_columnar(columnar_op(np.abs))
 
 @BuiltinFunction.register
 def sqrt(halos, vals):
     return arithmetic_unary_op(vals, np.sqrt)
+sqrt.set_columnar(columnar_op(np.sqrt))
 
 @BuiltinFunction.register
 def log(halos, vals):
     return arithmetic_unary_op(vals, np.log)
+log.set_columnar(columnar_op(np.log))
 
 @BuiltinFunction.register
 def log10(halos, vals):
     return arithmetic_unary_op(vals, np.log10)
+log10.set_columnar(columnar_op(np.log10))
 
 @BuiltinFunction.register
 def subtract(halos, vals1, vals2):
     return arithmetic_binary_op(vals1, vals2, np.subtract)
+subtract.set_columnar(columnar_op(np.subtract))
 
 @BuiltinFunction.register
 def add(halos, vals1, vals2):
     return arithmetic_binary_op(vals1, vals2, np.add)
+add.set_columnar(columnar_op(np.add))
 
 @BuiltinFunction.register
 def divide(halos, vals1, vals2):
     return arithmetic_binary_op(vals1, vals2, np.divide)
+divide.set_columnar(columnar_op(np.divide))
 
 @BuiltinFunction.register
 def multiply(halos, vals1, vals2):
     return arithmetic_binary_op(vals1, vals2, np.multiply)
+multiply.set_columnar(columnar_op(np.multiply))
 
 @BuiltinFunction.register
 def greater(halos, vals1, vals2):
     return arithmetic_binary_op(vals1, vals2, np.greater)
+greater.set_columnar(columnar_op(np.greater))
 
 @BuiltinFunction.register
 def less(halos, vals1, vals2):
     return arithmetic_binary_op(vals1, vals2, np.less)
+less.set_columnar(columnar_op(np.less))
 
 @BuiltinFunction.register
 def equal(halos, vals1, vals2):
     return arithmetic_binary_op(vals1, vals2, np.equal)
+equal.set_columnar(columnar_op(np.equal))
 
 @BuiltinFunction.register
 def greater_equal(halos, vals1, vals2):
     return arithmetic_binary_op(vals1, vals2, np.greater_equal)
+greater_equal.set_columnar(columnar_op(np.greater_equal))
 
 @BuiltinFunction.register
 def less_equal(halos, vals1, vals2):
     return arithmetic_binary_op(vals1, vals2, np.less_equal)
+less_equal.set_columnar(columnar_op(np.less_equal))
 
 @BuiltinFunction.register
 def logical_and(halos, vals1, vals2):
     return arithmetic_binary_op(vals1, vals2, np.logical_and)
+logical_and.set_columnar(columnar_op(np.logical_and))
 
 @BuiltinFunction.register
 def logical_or(halos, vals1, vals2):
     return arithmetic_binary_op(vals1, vals2, np.logical_or)
+logical_or.set_columnar(columnar_op(np.logical_or))
 
 @BuiltinFunction.register
 def logical_not(halos, vals):
     return arithmetic_unary_op(vals, np.logical_not)
+logical_not.set_columnar(columnar_op(np.logical_not))
 
 @BuiltinFunction.register
 def power(halos, vals1, vals2):
     return arithmetic_binary_op(vals1, vals2, np.power)
+power.set_columnar(columnar_op(np.power))
 
 def arithmetic_binary_op(vals1, vals2, op):
     results = []
@@ -1,8 +1,12 @@
+import collections
+import copy
 import functools
 import threading
 
 import pyparsing as pp
 
+from .. import config
+
 _parsing_lock = threading.Lock() # pyparsing is NOT thread safe
 
 from . import (
@@ -95,9 +99,76 @@ array_element << ((live_calculation_property | stored_property) + element_identi
 property_complete = pp.stringStart()+value_or_property_name+pp.stringEnd()
 
 
+class ParsedExpressionCache:
+    """A bounded cache of parsed Calculation trees, keyed by the expression string.
+
+    Calculation trees carry state that is changed as they are used (e.g. extraction patterns and cached dictionary
+    ids), so the cache keeps a pristine copy of each tree and hands out deep copies of it. Copying is typically
+    a hundred times faster than parsing, and does not need the parsing lock."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._trees = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name):
+        with self._lock:
+            tree = self._trees.get(name)
+            if tree is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._trees.move_to_end(name)
+        if tree is None:
+            with _parsing_lock:
+                tree = property_complete.parseString(name)[0]
+            self._add(name, tree)
+        return copy.deepcopy(tree)
+
+    def _add(self, name, tree):
+        # tree is copied before anyone else sees it, so that the stored version is never altered
+        tree = copy.deepcopy(tree)
+        with self._lock:
+            self._trees[name] = tree
+            self._trees.move_to_end(name)
+            while len(self._trees) > self.max_size:
+                self._trees.popitem(last=False)
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._trees
+
+    def __len__(self):
+        with self._lock:
+            return len(self._trees)
+
+    def clear(self):
+        with self._lock:
+            self._trees.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+_cache = ParsedExpressionCache(config.live_calculation_parse_cache_size)
+
 def parse_property_name( name):
-    with _parsing_lock:
-        return property_complete.parseString(name)[0]
+    return _cache.get(name)
+
+def prewarm(names):
+    """Parse the given expressions into the cache, so that the first request for each is as fast as later ones.
+
+    Expressions that cannot be parsed are skipped, with a warning."""
+    from ..log import logger
+    for name in names:
+        try:
+            _cache.get(name)
+        except pp.ParseException as e:
+            logger.warning("Unable to pre-parse live calculation %r: %s", name, e)
+
+def clear_cache():
+    _cache.clear()
 
 def parse_property_name_if_required(name):
     if isinstance(name, Calculation):
@@ -108,4 +179,4 @@ def parse_property_name_if_required(name):
 def parse_property_names(*names):
     return MultiCalculation(*[parse_property_name(n) for n in names])
 
-__all__ = ["parse_property_name", "parse_property_name_if_required", "parse_property_names"]
+__all__ = ["parse_property_name", "parse_property_name_if_required", "parse_property_names", "prewarm", "clear_cache"]
@@ -0,0 +1,59 @@
+import contextlib
+import threading
+
+from .. import core, temporary_halolist as thl
+
+_active = threading.local()
+
+
+class QueryLinkTargets:
+    """Fetches the halos targeted by Links, using a single connection and temporary table for a whole calculation
+
+    The target halos of a Link are queried afresh, with the properties and links that the rest of the calculation
+    needs. Each set of targets is loaded into a new session, since other sessions may already hold copies of the same
+    halos with a different set of properties loaded. However, all these sessions share one connection, so that the
+    same temporary table is refilled for every level of a nested link (e.g. BH.host_halo.Mvir) and for every link
+    within a MultiCalculation, rather than a table being created and dropped for each.
+
+    Links use the instance that is active in the current thread (see active). The connection and table are only
+    created if a Link needs them. As before, the sessions cannot issue further queries once the instance is closed."""
+
+    def __init__(self):
+        self._exit_stack = contextlib.ExitStack()
+        self._connection = None
+        self._table = None
+
+    @classmethod
+    @contextlib.contextmanager
+    def active(cls):
+        """Return the instance in use by the current thread, or create one that lasts until the context exits"""
+        current = getattr(_active, 'instance', None)
+        if current is not None:
+            yield current
+            return
+
+        _active.instance = cls()
+        try:
+            yield _active.instance
+        finally:
+            _active.instance.close()
+            _active.instance = None
+
+    def supplemented_halos(self, calculation, halo_ids):
+        """Return the halos with the given ids, with the data needed by calculation already loaded
+
+        As with thl.halo_query, duplicates are removed from the results."""
+        if self._table is None:
+            self._open()
+        session = core.Session(bind=self._connection)
+        thl.replace_halo_ids(self._table, halo_ids)
+        return calculation.supplement_halo_query(thl.halo_query(self._table, session)).all()
+
+    def _open(self):
+        session = core.Session()
+        self._connection = session.connection()
+        self._exit_stack.callback(self._connection.close)
+        self._table = self._exit_stack.enter_context(thl.temporary_halolist_table(session))
+
+    def close(self):
+        self._exit_stack.close()
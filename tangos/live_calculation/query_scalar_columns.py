@@ -0,0 +1,122 @@
+import numpy as np
+from sqlalchemy import select
+
+from .. import core
+
+
+class QueryScalarColumns:
+    """Evaluates a MultiCalculation of stored scalar properties over a timestep using a single Core select
+
+    When every requested property is stored in data_float or data_int, there is no need to construct ORM halo
+    objects with eager-loaded properties: the rows can be pulled straight out of the haloproperties table and
+    pivoted into typed numpy columns. The results are the same as those returned by values_sanitized on the
+    ORM objects (i.e. only halos that have all the properties are included).
+
+    If it turns out that any property is not a plain scalar (e.g. it is an array, needs reassembly, or is stored
+    with inconsistent types), calculate returns None and the caller must fall back to the general route."""
+
+    def __init__(self, calculation, timestep, session):
+        """
+        :type calculation: tangos.live_calculation.MultiCalculation
+        :type timestep: tangos.core.TimeStep
+        :type session: sqlalchemy.orm.Session
+        """
+        self.calculation = calculation
+        self.timestep = timestep
+        self.session = session
+
+    def calculate(self, object_typecode=None, limit=None, order_by_halo_number=False):
+        """Return the list of typed numpy columns, or None if this route cannot be used for the calculation
+
+        The arguments have the same meaning as for TimeStep.calculate_all"""
+        if not self.calculation.retrieves_only_stored_values():
+            return None
+
+        sim = self.timestep.simulation
+        for c in self.calculation.calculations:
+            if hasattr(c.providing_class(sim), 'reassemble'):
+                return None
+
+        name_ids = [core.dictionary.get_dict_id(c.name(), -1, session=self.session)
+                    for c in self.calculation.calculations]
+        if -1 in name_ids:
+            return None
+
+        halo_ids = self._get_halo_ids(object_typecode, limit, order_by_halo_number)
+        rows = self._get_property_rows(name_ids)
+
+        columns = []
+        keep_rows = np.ones(len(halo_ids), dtype=bool)
+        for name_id in name_ids:
+            column = self._make_column(rows, name_id, halo_ids)
+            if column is None:
+                return None
+            columns.append(column)
+            keep_rows &= column[1]
+
+        for c in self.calculation.calculations:
+            c.description_for_simulation(sim) # generates the same warnings as the general route, if any
+
+        return [values[keep_rows[present]] for values, present in columns]
+
+    def _get_halo_ids(self, object_typecode, limit, order_by_halo_number):
+        halo = core.halo.SimulationObjectBase
+        halo_select = select(halo.id).where(halo.timestep_id == self.timestep.id)
+        if object_typecode is not None:
+            halo_select = halo_select.where(halo.object_typecode == object_typecode)
+        if order_by_halo_number:
+            halo_select = halo_select.order_by(halo.halo_number, halo.id)
+        else:
+            halo_select = halo_select.order_by(halo.id)
+        if limit:
+            halo_select = halo_select.limit(limit)
+        return np.array(self.session.execute(halo_select).scalars().all(), dtype=np.int64)
+
+    def _get_property_rows(self, name_ids):
+        halo = core.halo.SimulationObjectBase
+        prop = core.halo_data.HaloProperty
+        property_select = select(prop.halo_id, prop.name_id, prop.data_float, prop.data_int,
+                                 prop.data_array.is_(None)).\
+            join(halo, halo.id == prop.halo_id).\
+            where(halo.timestep_id == self.timestep.id, prop.name_id.in_(name_ids)).\
+            order_by(prop.id)
+        rows = self.session.execute(property_select).all()
+        if len(rows)==0:
+            return None
+        halo_id, name_id, data_float, data_int, not_array = zip(*rows)
+        return {'halo_id': np.array(halo_id, dtype=np.int64),
+                'name_id': np.array(name_id, dtype=np.int64),
+                'data_float': np.array(data_float, dtype=object),
+                'data_int': np.array(data_int, dtype=object),
+                'not_array': np.array(not_array, dtype=bool)}
+
+    @staticmethod
+    def _make_column(rows, name_id, halo_ids):
+        """Return the values for name_id (for halos that have it), and a boolean array of which halos have it
+
+        Where a halo has more than one row for the property, the first (lowest id) is taken, as for the ORM route."""
+        if rows is None:
+            return None
+        selected = rows['name_id'] == name_id
+        unique_halo_ids, first_index = np.unique(rows['halo_id'][selected], return_index=True)
+        if len(unique_halo_ids)==0:
+            return None
+
+        if not rows['not_array'][selected][first_index].all():
+            return None
+
+        data_float = rows['data_float'][selected][first_index]
+        data_int = rows['data_int'][selected][first_index]
+        if all(x is not None for x in data_float):
+            values = data_float
+        elif all(x is not None for x in data_int):
+            values = data_int
+        else:
+            return None
+
+        present = np.isin(halo_ids, unique_halo_ids)
+        indices = np.searchsorted(unique_halo_ids, halo_ids[present])
+        values = list(values[indices])
+        if len(values)==0:
+            return None
+        return np.array(values, dtype=type(values[0])), present
@@ -84,13 +84,20 @@ def launch(function, args=None, backend_kwargs=None):
 
     return result
 
-def distributed(items, allow_resume=False, resumption_id=None):
+def distributed(items, allow_resume=False, resumption_id=None, contiguous=False, chunked=False):
     """Return an iterator that consumes the items, distributed across all processors
     (i.e. each item is consumed by only one processor, in a dynamic way).
 
     Optionally, if allow_resume is True, then the iterator will resume from the last point it reached
     provided argv and the stack trace are unchanged. If resumption_id is not None, then
-    the stack trace is ignored and only resumption_id needs to match."""
+    the stack trace is ignored and only resumption_id needs to match.
+
+    If contiguous is True, each processor is given runs of consecutive items wherever possible, which
+    is useful when neighbouring items share data that can be kept in memory.
+
+    If chunked is True, each processor is given several items at a time, with the number depending on how long its
+    previous items took. This greatly reduces the load on the server when there are many short items, but an
+    interrupted run resumes from the start of each processor's chunk."""
 
     if type(items) == set:
         items = list(items)
@@ -99,7 +106,7 @@ def distributed(items, allow_resume=False, resumption_id=None):
         return items
     else:
         from . import jobs
-        return jobs.distributed_iterate(items, allow_resume, resumption_id)
+        return jobs.distributed_iterate(items, allow_resume, resumption_id, contiguous, chunked)
 
 def synchronized(items, allow_resume=False, resumption_id=None):
     """Return an iterator that consumes all items on all processors.
@@ -140,13 +147,16 @@ class MessageExit(message.Message):
 
 def _server_thread():
 
-    from .async_message import init_async_processing_thread
-    init_async_processing_thread() # uses on_exit_parallelism to ensure thread is cleared up
+    from .async_message import init_async_processing
+    init_async_processing() # uses on_exit_parallelism to ensure threads are cleared up
 
     alive = [True for i in range(backend.size())]
 
     while any(alive[1:]):
-        obj = message.Message.receive()
+        obj = message.Message.receive(timeout=lock.time_to_next_deadline())
+        lock.expire_overdue_requests()
+        if obj is None:
+            continue
         if isinstance(obj, MessageExit):
             alive[obj.source]=False
         else:
@@ -172,6 +182,6 @@ def _shutdown_parallelism():
 
 
 
-from . import async_message, remote_import, shared_set
+from . import async_message, lock, remote_import, shared_set
 from .barrier import barrier
 from .lock import ExclusiveLock
@@ -1,45 +1,90 @@
+"""Processing of messages on the server in worker threads, so that slow requests do not hold up others
+
+Messages are normally processed one by one by the server's main loop. An AsyncProcessedMessage is instead placed on
+the worker queue named by its processing_queue attribute, and processed there by process_async. Each queue has a
+single worker thread, so messages on the same queue are processed one at a time in the order they were received,
+while the main loop carries on handling everything else (in particular lock and job requests, which are quick but
+which every process waits on). All the pynbody server's messages use the default queue, so that requests to load
+and release snapshots are never reordered with respect to the requests for data from them.
+
+If processing a message raises an exception, the exception is sent to the process that sent the message, provided
+that the message expects a response (see expects_response); otherwise the process would receive the exception in
+place of some unrelated message. Exceptions from other messages are only logged.
+
+Async processing is switched on with config.enable_async_message_processing; otherwise process_async is called from
+the main loop. It is also switched off if the backend cannot send messages from several threads at once
+(see backend_supports_threads)."""
+
 import queue
-from threading import Thread
+from threading import Lock, Thread
 
 from .. import config
 from ..log import logger
 from . import on_exit_parallelism
-from .message import Message
+from .message import ExceptionMessage, Message
+
+_workers = {} # queue name -> (queue.Queue, Thread)
+_workers_mutex = Lock()
+_accepting_messages = False
 
 
 class AsyncProcessedMessage(Message):
-    _async_task_queue = queue.Queue()
+    processing_queue = 'default'
+    expects_response = True # set to False in subclasses for which the sender does not wait for a reply
+
     def process_async(self):
         """Override to provide the processing/response mechanism, that will be performed in a separate thread"""
         raise NotImplementedError()
 
     def process(self):
-        if config.enable_async_message_processing:
-            self._async_task_queue.put(self)
+        if _accepting_messages:
+            _get_worker_queue(self.processing_queue).put(self)
         else:
             self.process_async()
 
-def init_async_processing_thread():
-    if not config.enable_async_message_processing:
+def _process_queue(task_queue):
+    while True:
+        msg = task_queue.get()
+        if msg is None:
+            break
+        try:
+            msg.process_async()
+        except Exception as e:
+            if msg.expects_response:
+                logger.error(f"Error processing async message {msg}: {e!r}")
+                ExceptionMessage(e).send(msg.source)
+            else:
+                logger.exception(f"Error processing async message {msg}")
+
+def _get_worker_queue(name):
+    with _workers_mutex:
+        if name not in _workers:
+            task_queue = queue.Queue()
+            thread = Thread(target=_process_queue, args=(task_queue,), name=f"tangos-async-{name}", daemon=True)
+            thread.start()
+            _workers[name] = (task_queue, thread)
+        return _workers[name][0]
+
+def backend_supports_threads():
+    from . import backend
+    return getattr(backend, 'supports_threaded_sends', True)
+
+def init_async_processing():
+    """Start passing AsyncProcessedMessages to worker threads. Called by the server when it starts."""
+    global _accepting_messages
+    if not config.enable_async_message_processing or not backend_supports_threads():
         return
-    def async_processing_thread():
-        while True:
-            msg = AsyncProcessedMessage._async_task_queue.get()
-            if msg is None:
-                break
-            try:
-                msg.process_async()
-            except Exception as e:
-                print(f"Error processing async message {msg}: {e}")
-                logger.error(f"Error processing async message {msg}: {e}")
-
-    t = Thread(target=async_processing_thread)
-    t.daemon = True
-    t.start()
-
-    def exit_async_processing_thread():
-        AsyncProcessedMessage._async_task_queue.empty()
-        AsyncProcessedMessage._async_task_queue.put(None)
-        t.join()
-
-    on_exit_parallelism(exit_async_processing_thread)
+    _accepting_messages = True
+    on_exit_parallelism(_exit_async_processing)
+
+def _exit_async_processing():
+    """Finish processing all queued messages, then stop the worker threads"""
+    global _accepting_messages
+    _accepting_messages = False
+    with _workers_mutex:
+        workers = list(_workers.values())
+        _workers.clear()
+    for task_queue, _ in workers:
+        task_queue.put(None)
+    for _, thread in workers:
+        thread.join()
@@ -1,3 +1,4 @@
+import time
 import warnings
 
 import numpy as np
@@ -5,16 +6,31 @@ from mpi4py import MPI
 
 comm = MPI.COMM_WORLD
 
+# the server can only send from worker threads (see async_message) if MPI was initialised with full thread support
+supports_threaded_sends = MPI.Query_thread() == MPI.THREAD_MULTIPLE
+
 def send(data, destination, tag=0):
     comm.send(data, dest=destination, tag = tag)
 
-def receive_any(source=None):
+def receive_any(source=None, timeout=None):
+    """Receive a message from any source; if timeout is not None and no message arrives within that many seconds,
+    return None"""
     status = MPI.Status()
     if source is None:
         source = MPI.ANY_SOURCE
+    if timeout is not None and not _wait_for_message(source, timeout):
+        return None
     data = comm.recv(source=source, tag=MPI.ANY_TAG, status=status)
     return data, status.source, status.tag
 
+def _wait_for_message(source, timeout):
+    deadline = time.monotonic() + timeout
+    while not comm.Iprobe(source=source, tag=MPI.ANY_TAG):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(1e-3)
+    return True
+
 def receive(source=None, tag=0):
     if source is None:
         source = MPI.ANY_SOURCE
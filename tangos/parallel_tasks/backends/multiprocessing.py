@@ -1,5 +1,6 @@
 import multiprocessing
 import multiprocessing.resource_tracker
+import multiprocessing.shared_memory
 import os
 import select
 import signal
@@ -8,8 +9,10 @@ import threading
 import time
 from typing import Optional
 
+import numpy as np
 import tblib.pickling_support
 
+from ... import config
 from ...log import logger
 
 _slave = False
@@ -39,11 +42,14 @@ def send(data, destination, tag=0):
     with send_lock:
         _pipe.send((data, destination, tag))
 
-def receive_any(source=None):
-    return receive(source,None,True)
+def receive_any(source=None, timeout=None):
+    return receive(source,None,True,timeout)
 
 
-def receive(source=None, tag=0, return_tag=False):
+def receive(source=None, tag=0, return_tag=False, timeout=None):
+    """Receive a message; if timeout is not None and no matching message arrives within that many seconds,
+    return None"""
+    deadline = None if timeout is None else time.monotonic()+timeout
     with receive_lock:
         while True:
             try:
@@ -53,16 +59,64 @@ def receive(source=None, tag=0, return_tag=False):
                 else:
                     return item[0]
             except NoMatchingItem:
+                if deadline is not None and not _pipe.poll(max(0.0, deadline-time.monotonic())):
+                    return None
                 _receive_item_into_buffer()
 
 
 NUMPY_SPECIAL_TAG = 1515
 
+class _SharedArrayReference:
+    """Sent through the pipe in place of a numpy array that has been copied into a shared memory segment"""
+    __slots__ = ('name', 'shape', 'dtype')
+
+    def __init__(self, name, shape, dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+    def __getstate__(self):
+        return self.name, self.shape, self.dtype
+
+    def __setstate__(self, state):
+        self.name, self.shape, self.dtype = state
+
+class _SegmentArray(np.ndarray):
+    """The base of an array received through shared memory, holding the segment open for as long as it is referenced
+
+    Views of the received array (which is a plain ndarray) keep this base alive, since numpy does not collapse view
+    chains across different array types. Once all are gone, the segment is garbage collected, which unmaps it."""
+    pass
+
 def send_numpy_array(data, destination):
-    send(data,destination,tag=NUMPY_SPECIAL_TAG)
+    if data.nbytes < config.multiprocessing_shared_memory_min_bytes or data.dtype.hasobject:
+        send(data,destination,tag=NUMPY_SPECIAL_TAG)
+        return
+
+    # Rather than being pickled through the pipe (and then again by the parent process, which routes all messages),
+    # the array is copied once into a new segment, which the receiving process maps and then unlinks
+    segment = multiprocessing.shared_memory.SharedMemory(create=True, size=data.nbytes)
+    try:
+        shared_view = np.ndarray(data.shape, dtype=data.dtype, buffer=segment.buf)
+        shared_view[...] = data
+        del shared_view
+        send(_SharedArrayReference(segment.name, data.shape, data.dtype), destination, tag=NUMPY_SPECIAL_TAG)
+    except:
+        segment.unlink()
+        raise
+    finally:
+        segment.close()
 
 def receive_numpy_array(source):
-    return receive(source,tag=NUMPY_SPECIAL_TAG)
+    data = receive(source,tag=NUMPY_SPECIAL_TAG)
+    if not isinstance(data, _SharedArrayReference):
+        return data
+
+    segment = multiprocessing.shared_memory.SharedMemory(name=data.name)
+    segment.unlink() # the memory remains available until it is no longer mapped by any process
+    base = _SegmentArray(data.shape, dtype=data.dtype, buffer=segment.buf)
+    base.segment = segment
+    return base.view(np.ndarray)
 
 def _pop_first_match_from_reception_buffer(source, tag):
     for item in _recv_buffer:
@@ -6,11 +6,14 @@ import pypar.mpiext
 
 from ..message import Message
 
+supports_threaded_sends = False
+
 
 def send(data, destination, tag=0):
     pypar.send(data, destination=destination, tag = tag)
 
-def receive_any(source=None):
+def receive_any(source=None, timeout=None):
+    # pypar offers no way to wait for a message with a timeout, so timeout is ignored and the call always blocks
     if source is None:
         source = pypar.any_source
     data, status = pypar.receive(source=source, return_status=True, tag=pypar.any_tag)
@@ -1,7 +1,10 @@
+import queue
 import sys
+import threading
 
-from .. import core
-from . import message, remote_import
+from .. import config, core
+from ..util import proxy_object
+from . import log, message, on_exit_parallelism, remote_import
 
 
 class MessageRequestCreatorId(message.MessageWithResponse):
@@ -27,3 +30,160 @@ def synchronize_creator_object(session=None):
     remote_import.ImportRequestMessage(__name__).send(0)
     id = MessageRequestCreatorId().send_and_get_response(0)
     core.creator.set_creator(session.query(core.creator.Creator).filter_by(id=id).first())
+
+
+class MessageQueueForDedicatedWriter(message.MessageWithResponse):
+    """Passes a list of (halo_id, name, value) tuples to the dedicated writer running on the server.
+
+    The server acknowledges receipt immediately unless the writer's queue has grown too long, in which case
+    the acknowledgement is held back until the queue has drained (providing backpressure). If the writer has failed,
+    the acknowledgement carries the exception, and the rows are discarded."""
+    def process(self):
+        _get_dedicated_writer().enqueue_rows(self)
+
+class MessageFlushDedicatedWriter(message.MessageWithResponse):
+    """Requests that the server responds once all previously-queued rows have been committed"""
+    def process(self):
+        _get_dedicated_writer().enqueue_flush(self)
+
+
+class DedicatedWriter:
+    """Runs on the server, committing rows streamed from worker processes in a background thread"""
+
+    def __init__(self, max_queued_rows=None):
+        from ..cached_writer import BulkInserter
+        from ..util import timing_monitor
+        from .async_message import backend_supports_threads
+
+        if not backend_supports_threads():
+            raise RuntimeError("The dedicated writer sends responses from a background thread, which this "
+                               "parallel backend does not support")
+
+        if max_queued_rows is None:
+            max_queued_rows = config.PROPERTY_WRITER_DEDICATED_WRITER_MAX_QUEUED_ROWS
+        self._max_queued_rows = max_queued_rows
+        self._num_queued_rows = 0
+        self._held_acknowledgements = []
+        self._error = None
+        self._state_lock = threading.Lock()
+
+        self._session = core.Session()
+        self._inserter = BulkInserter(self._session, core.creator.get_creator_id())
+        self.timing_monitor = timing_monitor.TimingMonitor(label="dedicated writer")
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def enqueue_rows(self, msg):
+        with self._state_lock:
+            if self._error is not None:
+                msg.respond(self._error)
+                return
+            self._num_queued_rows += len(msg.contents)
+            if self._num_queued_rows > self._max_queued_rows:
+                log.logger.debug("Dedicated writer has %d queued rows; holding back acknowledgement to proc %d",
+                                 self._num_queued_rows, msg.source)
+                self._held_acknowledgements.append(msg)
+            else:
+                msg.respond(None)
+        self._queue.put(msg)
+
+    def enqueue_flush(self, msg):
+        self._queue.put(msg)
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.timing_monitor.report_to_log(log.logger)
+        self._session.close()
+
+    def _get_available_messages(self):
+        messages = [self._queue.get()]
+        while True:
+            try:
+                messages.append(self._queue.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def _commit(self, rows):
+        from ..cached_writer import insert_list
+        try:
+            with self.timing_monitor(self._inserter):
+                insert_list(rows, self._inserter)
+        except Exception as e:
+            log.logger.exception("Error in dedicated writer while committing %d rows", len(rows))
+            self._session.rollback()
+            with self._state_lock:
+                self._error = e
+
+    def _release_held_acknowledgements(self, num_committed_rows):
+        with self._state_lock:
+            self._num_queued_rows -= num_committed_rows
+            while len(self._held_acknowledgements)>0 and \
+                    (self._num_queued_rows <= self._max_queued_rows or self._error is not None):
+                self._held_acknowledgements.pop(0).respond(self._error)
+
+    def _run(self):
+        running = True
+        while running:
+            messages = self._get_available_messages()
+            rows = []
+            flushes = []
+            for msg in messages:
+                if msg is None:
+                    running = False
+                elif isinstance(msg, MessageFlushDedicatedWriter):
+                    flushes.append(msg)
+                else:
+                    rows.extend(msg.contents)
+
+            if len(rows)>0 and self._error is None:
+                self._commit(rows)
+
+            self._release_held_acknowledgements(len(rows))
+
+            for msg in flushes:
+                msg.respond(self._error)
+
+
+_dedicated_writer = None
+
+def _get_dedicated_writer():
+    global _dedicated_writer
+    if _dedicated_writer is None:
+        _dedicated_writer = DedicatedWriter()
+        on_exit_parallelism(_stop_dedicated_writer)
+    return _dedicated_writer
+
+def _stop_dedicated_writer():
+    global _dedicated_writer
+    if _dedicated_writer is not None:
+        _dedicated_writer.stop()
+        _dedicated_writer = None
+
+
+def queue_for_dedicated_writer(property_list):
+    """Send (halo, name, value) tuples to the dedicated writer on the server, to be committed asynchronously
+
+    Halos and links are sent by database id, so that no ORM objects need to be transferred. This call
+    only blocks if the writer has fallen too far behind. If the writer has failed to commit earlier rows, the
+    exception is raised here, so that the calling process stops rather than calculating results that will be lost."""
+    rows = []
+    for halo, name, value in property_list:
+        if value is None:
+            continue
+        if isinstance(value, core.halo.SimulationObjectBase):
+            value = proxy_object.ProxyObjectFromDatabaseId(value.id)
+        rows.append((halo.id, name, value))
+    if len(rows)>0:
+        error = MessageQueueForDedicatedWriter(rows).send_and_get_response(0)
+        if error is not None:
+            raise error
+
+def flush_dedicated_writer():
+    """Block until everything sent to the dedicated writer has been committed"""
+    error = MessageFlushDedicatedWriter().send_and_get_response(0)
+    if error is not None:
+        raise error
@@ -1,14 +1,14 @@
 import base64
 import hashlib
-import pathlib
 import pickle
 import shlex
 import sys
+import time
 import traceback
 import zlib
 
-from .. import log
-from . import message
+from .. import config, log
+from . import message, resume_journal
 
 
 class InconsistentJobList(RuntimeError):
@@ -18,12 +18,12 @@ class InconsistentContext(RuntimeError):
     pass
 
 class IterationState:
-    _this_run_iteration_states = {}
     def __init__(self, context, jobs_complete, /, backend_size=None):
         from . import backend
         self._context = context
         self._jobs_complete = jobs_complete
         self._rank_running_job = {i: None for i in range(1,backend_size or backend.size())}
+        self._next_unclaimed = 0 # no job before this one is unclaimed, so that finding the next job is O(1) amortized
 
     def __len__(self):
         return len(self._jobs_complete)
@@ -48,9 +48,9 @@ class IterationState:
     def from_context(cls, num_jobs, argv=None, stack_hash=None, allow_resume=None, backend_size=None):
         context = (argv, stack_hash, num_jobs)
         if allow_resume:
-            cmap = cls._get_stored_completion_map_from_context(context)
-            if cmap is not None:
-                r = cls.from_string(cmap, context)
+            jobs_complete = cls._get_stored_completion_map_from_context(context)
+            if jobs_complete is not None:
+                r = cls(context, jobs_complete, backend_size=backend_size)
                 log.logger.info(
                     f"Resuming from previous run. {r.count_complete()} of {len(r)} jobs are already complete.")
                 log.logger.info(
@@ -61,76 +61,57 @@ class IterationState:
 
     @classmethod
     def _resume_state_folder_path(cls):
-        path = pathlib.Path("~").expanduser() / ".tangos_resume_state"
-        path.mkdir(exist_ok=True)
-        return path
-
-    @staticmethod
-    def _resume_state_path():
-        if not hasattr(IterationState, "_resume_state_path_this_run"):
-            path = IterationState._resume_state_folder_path()
-            all_state_files = sorted(list(path.iterdir()))
-            if len(all_state_files)==0:
-                i = 0
-            else:
-                i = int(all_state_files[-1].name.split("_")[-1].split(".")[0])+1
-            candidate = path / f"tangos_resume_state_{i:06d}.pickle"
-            assert not candidate.exists()
-            IterationState._resume_state_path_this_run = candidate
-        return IterationState._resume_state_path_this_run
+        return resume_journal.journal_folder()
 
     @classmethod
-    def _get_stored_completion_maps(cls):
-        maps = {}
-
-        resume_path = cls._resume_state_folder_path()
-
-        for filename in sorted(list(resume_path.iterdir())):
-            if str(filename).endswith(".pickle"):
-                try:
-                    with filename.open('rb') as f:
-                        maps.update(pickle.load(f))
-                except (OSError, EOFError):
-                    log.logger.warn(f"Error reading resume state from {str(filename):s}. Skipped.")
-                    pass
-
-        return maps
-    @classmethod
     def _get_stored_completion_map_from_context(cls, context):
-        maps = cls._get_stored_completion_maps()
-        return maps.get(context, None)
+        return resume_journal.read_all_journals().get(context, None)
 
     @classmethod
     def clear_resume_state(cls):
-        for f in cls._resume_state_folder_path().iterdir():
-            f.unlink()
+        resume_journal.clear_journals()
+        resume_journal.clear_legacy_states()
+
+    def _store_completion(self, jobs):
+        resume_journal.get_journal().record_complete(self._context, self._jobs_complete, jobs)
 
-    def _store_completion_map(self):
-        self._this_run_iteration_states[self._context] = self.to_string()
-        with open(self._resume_state_path(), "wb") as f:
-            pickle.dump(self._this_run_iteration_states, f)
+    def store_finished(self):
+        resume_journal.get_journal().record_finished(self._context, self._jobs_complete)
 
     def mark_complete(self, job):
         if job is None:
             return
         self._jobs_complete[job] = True
-        self._store_completion_map()
+        self._store_completion([job])
+
+    def _claim_next_job(self):
+        while self._next_unclaimed<len(self._jobs_complete) and self._jobs_complete[self._next_unclaimed]:
+            self._next_unclaimed += 1
+        if self._next_unclaimed==len(self._jobs_complete):
+            return None
+        self._next_unclaimed += 1
+        return self._next_unclaimed-1
 
     def next_job(self, for_rank):
         if for_rank in self._rank_running_job:
             self.mark_complete(self._rank_running_job[for_rank])
             del self._rank_running_job[for_rank]
 
-        for i in range(len(self._jobs_complete)):
-            if not self._jobs_complete[i] and i not in self._rank_running_job.values():
-                self._rank_running_job[for_rank] = i
-                return i
-        return None
+        job = self._claim_next_job()
+        if job is not None:
+            self._rank_running_job[for_rank] = job
+        return job
+
+    def next_jobs(self, for_rank, mean_job_duration=None):
+        """Return a list of jobs for the rank to run, or None if there are none left. By default, jobs are handed out
+        singly (see ChunkedIterationState)."""
+        job = self.next_job(for_rank)
+        return None if job is None else [job]
 
     def finished(self):
         # not enough for all jobs to be complete, must also have notified all ranks (this matters
         # if some ranks never did any work at all)
-        return all(self._jobs_complete) and len(self._rank_running_job)==0
+        return len(self._rank_running_job)==0 and all(self._jobs_complete)
 
     def count_complete(self):
         return sum(self._jobs_complete)
@@ -170,6 +151,103 @@ class SynchronizedIterationState(IterationState):
 
         return my_next_job
 
+class ContiguousIterationState(IterationState):
+    """An iteration state that, wherever possible, hands each rank the job following the one it just completed
+
+    This allows consecutive jobs that share data (e.g. the timestep pairs processed by the linker) to reuse it. When a
+    rank's successor job is unavailable, it starts a new run from the middle of the longest stretch of unclaimed jobs,
+    so that the ranks still share out the work dynamically."""
+
+    def _is_available(self, job):
+        return not self._jobs_complete[job] and job not in self._rank_running_job.values()
+
+    def _start_of_new_run(self):
+        best_start, best_length = None, 0
+        run_start = None
+        for i in range(len(self._jobs_complete)+1):
+            if i<len(self._jobs_complete) and self._is_available(i):
+                if run_start is None:
+                    run_start = i
+            elif run_start is not None:
+                if i-run_start > best_length:
+                    best_start, best_length = run_start, i-run_start
+                run_start = None
+
+        if best_start is None:
+            return None
+        if best_start == 0 or self._jobs_complete[best_start-1]:
+            # no rank is working up to this stretch, so start from its beginning
+            return best_start
+        else:
+            return best_start + best_length//2
+
+    def next_job(self, for_rank):
+        previous_job = self._rank_running_job.get(for_rank, None)
+        if for_rank in self._rank_running_job:
+            self.mark_complete(previous_job)
+            del self._rank_running_job[for_rank]
+
+        if previous_job is not None and previous_job+1 < len(self._jobs_complete) \
+                and self._is_available(previous_job+1):
+            job = previous_job+1
+        else:
+            job = self._start_of_new_run()
+
+        if job is not None:
+            self._rank_running_job[for_rank] = job
+        return job
+
+
+class ChunkedIterationState(IterationState):
+    """An iteration state that hands out jobs in chunks, so that the server is not contacted for every short job
+
+    The chunk size is tuned to the duration of each rank's previous jobs (see _chunk_size). Jobs in a chunk are
+    marked complete only when the rank asks for more work, so that on resumption the whole of any interrupted chunk
+    is run again."""
+
+    def __init__(self, context, jobs_complete, /, backend_size=None):
+        super().__init__(context, jobs_complete, backend_size=backend_size)
+        self._num_ranks = max(len(self._rank_running_job), 1)
+        self._num_unclaimed = len(jobs_complete) - sum(jobs_complete)
+
+    def _chunk_size(self, mean_job_duration):
+        """Return the number of jobs to send in one go, given the mean duration of a rank's previous jobs
+
+        Chunks are sized to take about config.parallel_job_chunk_seconds. However, no rank is given more than its
+        share of half the jobs that remain, so that chunks shrink as the loop nears its end and no rank is left with
+        a long tail of work while the others are idle."""
+        if mean_job_duration is None:
+            return 1 # nothing is yet known about how long the jobs take
+        target = config.parallel_job_chunk_seconds / max(mean_job_duration, 1e-9)
+        fair_share = self._num_unclaimed // (2*self._num_ranks)
+        return int(max(1, min(target, fair_share, config.parallel_job_chunk_max)))
+
+    def next_jobs(self, for_rank, mean_job_duration=None):
+        if for_rank in self._rank_running_job:
+            previous_chunk = self._rank_running_job.pop(for_rank)
+            if previous_chunk is not None:
+                for job in previous_chunk:
+                    self._jobs_complete[job] = True
+                self._store_completion(previous_chunk)
+
+        chunk = []
+        for i in range(self._chunk_size(mean_job_duration)):
+            job = self._claim_next_job()
+            if job is None:
+                break
+            chunk.append(job)
+
+        if len(chunk)==0:
+            return None
+        self._num_unclaimed -= len(chunk)
+        self._rank_running_job[for_rank] = chunk
+        return chunk
+
+    def next_job(self, for_rank):
+        chunk = self.next_jobs(for_rank)
+        return None if chunk is None else chunk[0]
+
+
 _next_iteration_state_id = 0
 _iteration_states = {}
 
@@ -177,11 +255,18 @@ _iteration_states = {}
 class MessageStartIteration(message.BarrierMessageWithResponse):
     def process_global(self):
         global _next_iteration_state_id, _iteration_states
-        req_jobs, req_hash, allow_resume, synchronized = self.contents
+        req_jobs, req_hash, allow_resume, synchronized, contiguous, chunked = self.contents
 
         argv_string = shlex.join(sys.argv)
 
-        IteratorClass = SynchronizedIterationState if synchronized else IterationState
+        if synchronized:
+            IteratorClass = SynchronizedIterationState
+        elif contiguous:
+            IteratorClass = ContiguousIterationState
+        elif chunked:
+            IteratorClass = ChunkedIterationState
+        else:
+            IteratorClass = IterationState
 
         my_id = _next_iteration_state_id
         _iteration_states[my_id] = IteratorClass.from_context(req_jobs, argv=argv_string,
@@ -212,46 +297,57 @@ class MessageDistributeJobList(message.Message):
 
 class MessageRequestJob(message.MessageWithResponse):
     def process(self):
-        iterator_id = self.contents
+        iterator_id, mean_job_duration = self.contents
         current_iteration_state = _iteration_states.get(iterator_id, None)
         source = self.source
 
         assert current_iteration_state is not None # should not be requesting jobs if we are not in a loop
 
-        job = current_iteration_state.next_job(source)
+        jobs = current_iteration_state.next_jobs(source, mean_job_duration)
 
-        if job is not None:
-            log.logger.debug("Send job %d of %d to node %d", job, len(current_iteration_state), source)
+        if jobs is not None:
+            log.logger.debug("Send %d job(s) from %d of %d to node %d", len(jobs), jobs[0],
+                             len(current_iteration_state), source)
         else:
             log.logger.debug("Finished jobs; notify node %d", source)
 
         if current_iteration_state.finished():
+            current_iteration_state.store_finished()
             del _iteration_states[iterator_id]
 
-        self.respond(job)
+        self.respond(jobs)
 
-def distributed_iterate(task_list, allow_resume=False, resumption_id=None):
+def distributed_iterate(task_list, allow_resume=False, resumption_id=None, contiguous=False, chunked=False):
     """Sets up an iterator returning items of task_list.
 
     If allow_resume is True, then the iterator will resume from the last point it reached
     provided argv and the stack trace are unchanged. If resumption_id is not None, then
     the stack trace is ignored and only resumption_id needs to match.
+
+    If contiguous is True, each process is given runs of consecutive items wherever possible
+    (see ContiguousIterationState). If chunked is True, items are handed out several at a time, depending
+    on how long the previous items took (see ChunkedIterationState).
     """
     from . import backend, barrier
 
     resumption_id = resumption_id or _autogenerate_resume_id()
 
     assert backend is not None, "Parallelism is not initialised"
-    iteration_id = MessageStartIteration((len(task_list), resumption_id, allow_resume, False)).send_and_get_response(0)
+    iteration_id = MessageStartIteration((len(task_list), resumption_id, allow_resume, False,
+                                          contiguous, chunked)).send_and_get_response(0)
     barrier()
 
+    mean_job_duration = None
     while True:
-        job = MessageRequestJob(iteration_id).send_and_get_response(0)
-        if job is None:
+        jobs = MessageRequestJob((iteration_id, mean_job_duration)).send_and_get_response(0)
+        if jobs is None:
             barrier()
             return
-        else:
+
+        chunk_start = time.perf_counter()
+        for job in jobs:
             yield task_list[job]
+        mean_job_duration = (time.perf_counter() - chunk_start) / len(jobs)
 
 
 def _autogenerate_resume_id():
@@ -271,16 +367,17 @@ def synchronized_iterate(task_list, allow_resume=False, resumption_id=None):
 
     assert backend is not None, "Parallelism is not initialised"
 
-    iteration_id = MessageStartIteration((len(task_list), resumption_id, allow_resume, True)).send_and_get_response(0)
+    iteration_id = MessageStartIteration((len(task_list), resumption_id, allow_resume, True,
+                                          False, False)).send_and_get_response(0)
     barrier()
 
     while True:
-        job = MessageRequestJob(iteration_id).send_and_get_response(0)
+        jobs = MessageRequestJob((iteration_id, None)).send_and_get_response(0)
         barrier() # this is crucial to keep things in sync (see comment in SynchronizedIterationState.next_job)
-        if job is None:
+        if jobs is None:
             return
 
-        yield task_list[job]
+        yield task_list[jobs[0]]
 
 
 
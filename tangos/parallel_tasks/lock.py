@@ -1,13 +1,46 @@
+"""Named locks shared between all processes, managed by the server (rank 0)
+
+The server keeps, for each lock, the processes currently holding it and a first-in, first-out queue of those waiting.
+A lock is granted the moment it becomes available. Waiting requests are served in order of arrival, except that:
+
+* when a shared request reaches the front of the queue, the shared requests queued directly behind it are granted
+  along with it, so that sharers are admitted in batches; a shared request queued behind an exclusive one still waits
+  for that request to be granted and released;
+* a shared request is not granted alongside existing sharers if anything is queued, so that a stream of shared
+  requests cannot keep an exclusive request waiting indefinitely;
+* a request to upgrade a shared lock to an exclusive one goes to the front of the queue, since the process already
+  holds the lock.
+
+Requests may specify a timeout, after which the server withdraws them and the process raises LockTimeout. Timeouts
+are applied by the server's main loop (see expire_overdue_requests), so that all messages to other processes are sent
+from that thread. The time each request waited is recorded in a histogram per lock, which is written to the log when parallelism ends."""
+
+import bisect
+import collections
+import threading
 import time
 
-from ..config import DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK
-from . import log, message, parallelism_is_active
+from .. import config
+from . import accumulative_statistics, log, message, parallelism_is_active
+
+GRANTED = 'granted'
+TIMED_OUT = 'timed out'
+UPGRADE_CONFLICT = 'upgrade conflict'
+
+
+class LockTimeout(RuntimeError):
+    pass
+
+class LockUpgradeConflict(RuntimeError):
+    pass
 
 
 class MessageRequestLock(message.Message):
-    def __init__(self, name, shared=False):
+    def __init__(self, name, shared=False, upgrade=False, timeout=None):
         self.name = name
         self.shared = shared
+        self.upgrade = upgrade
+        self.timeout = timeout
 
     @classmethod
     def deserialize(cls, source, message):
@@ -16,28 +49,14 @@ class MessageRequestLock(message.Message):
         return obj
 
     def serialize(self):
-        return (self.name, self.shared)
+        return (self.name, self.shared, self.upgrade, self.timeout)
 
     def process(self):
-        lock_id = self.name
-        log.logger.debug("Received request for lock %r for proc %d, shared=%r", lock_id, self.source, self.shared)
-        queue = _get_lock_queue(lock_id)
-        queue.append((self.source, self.shared))
-        if len(queue) == 1:
-            _issue_next_lock(lock_id)
-        elif _lock_in_shared_mode(lock_id) and self.shared:
-            log.logger.debug("Issue shared lock %r to proc %d", lock_id, self.source)
-            MessageGrantLock((lock_id, False)).send(self.source)
-            _increment_lock_num_shared(lock_id,1)
+        _request_lock(self.name, self.source, self.shared, self.upgrade, self.timeout)
 
 class MessageRelinquishLock(message.Message):
     def process(self):
-        lock_id = self.contents
-        proc = self.source
-        if _lock_in_shared_mode(lock_id):
-            _release_lock_shared(lock_id, proc)
-        else:
-            _release_lock_exclusive(lock_id, proc)
+        _relinquish_lock(self.contents, self.source)
 
 
 
@@ -46,102 +65,305 @@ class MessageGrantLock(message.Message):
     pass
 
 
-_lock_queues = {}
-_lock_num_sharers = {}
+class LockWaitStatistics(accumulative_statistics.StatisticsAccumulatorBase):
+    """Histograms of the time for which requests for each lock waited before being granted"""
+
+    BIN_EDGES = (1e-3, 1e-2, 1e-1, 1.0, 10.0, 100.0)
+    BIN_LABELS = ("<1ms", "<10ms", "<0.1s", "<1s", "<10s", "<100s", ">100s")
 
-def _get_lock_queue(lock_id):
-    lock_queue = _lock_queues.get(lock_id,[])
-    _lock_queues[lock_id] = lock_queue
-    return lock_queue
+    def __init__(self):
+        self.reset()
+        super().__init__(allow_parallel=False)
 
-def _get_lock_num_sharers(lock_id):
-    return _lock_num_sharers.get(lock_id, 0)
+    def reset(self):
+        self.counts = {} # lock name -> number of grants in each bin
+        self.total_wait = {}
+        self.max_wait = {}
+        self.timeouts = {}
 
-def _set_lock_num_sharers(lock_id, number):
-    _lock_num_sharers[lock_id] = number
+    def record(self, lock_id, wait):
+        counts = self.counts.setdefault(lock_id, [0]*len(self.BIN_LABELS))
+        counts[bisect.bisect_right(self.BIN_EDGES, wait)] += 1
+        self.total_wait[lock_id] = self.total_wait.get(lock_id, 0.0) + wait
+        self.max_wait[lock_id] = max(self.max_wait.get(lock_id, 0.0), wait)
 
-def _increment_lock_num_shared(lock_id, increment_by):
-    _set_lock_num_sharers(lock_id, _get_lock_num_sharers(lock_id)+increment_by)
+    def record_timeout(self, lock_id):
+        self.timeouts[lock_id] = self.timeouts.get(lock_id, 0) + 1
 
-def _lock_in_shared_mode(lock_id):
-    return _get_lock_num_sharers(lock_id)>0
+    def add(self, other):
+        for lock_id, counts in other.counts.items():
+            own_counts = self.counts.setdefault(lock_id, [0]*len(self.BIN_LABELS))
+            self.counts[lock_id] = [a+b for a, b in zip(own_counts, counts)]
+            self.total_wait[lock_id] = self.total_wait.get(lock_id, 0.0) + other.total_wait[lock_id]
+            self.max_wait[lock_id] = max(self.max_wait.get(lock_id, 0.0), other.max_wait[lock_id])
+        for lock_id, timeouts in other.timeouts.items():
+            self.timeouts[lock_id] = self.timeouts.get(lock_id, 0) + timeouts
 
-def _issue_next_lock(lock_id, impose_filesystem_delay=False):
-    queue = _get_lock_queue(lock_id)
-    if len(queue)>0:
-        proc = queue[0][0]
-        shared = queue[0][1]
-        if shared:
-            _issue_shared_locks(lock_id, impose_filesystem_delay)
+    def report_to_log(self, logger):
+        if len(self.counts) == 0 and len(self.timeouts) == 0:
+            return
+        logger.info("")
+        logger.info("LOCK WAIT TIMES, summed over all processes")
+        logger.info(" %20s %8s %8s %8s | %s" % ("lock", "grants", "mean", "max",
+                                                " ".join("%7s" % label for label in self.BIN_LABELS)))
+        for lock_id in sorted(set(self.counts) | set(self.timeouts)):
+            counts = self.counts.get(lock_id, [0]*len(self.BIN_LABELS))
+            num_grants = sum(counts)
+            mean_wait = self.total_wait.get(lock_id, 0.0) / max(num_grants, 1)
+            line = " %20s %8d %7.3fs %7.3fs | %s" % (str(lock_id)[-20:], num_grants, mean_wait,
+                                                   self.max_wait.get(lock_id, 0.0),
+                                                   " ".join("%7d" % c for c in counts))
+            if lock_id in self.timeouts:
+                line += " | %d timed out" % self.timeouts[lock_id]
+            logger.info(line)
+        logger.info("")
+
+    def __eq__(self, other):
+        if type(other) != type(self):
+            return False
+        return self.counts == other.counts and self.timeouts == other.timeouts
+
+
+class _LockRequest:
+    def __init__(self, proc, shared, upgrade):
+        self.proc = proc
+        self.shared = shared
+        self.upgrade = upgrade
+        self.time_requested = time.time()
+        self.deadline = None
+
+class _LockState:
+    def __init__(self):
+        self.holders = {} # proc -> True if held in shared mode, False if exclusive
+        self.hold_counts = {} # proc -> number of times held, since a process may hold a shared lock more than once
+        self.queue = collections.deque()
+        self.impose_filesystem_delay = False # set when an exclusive holder has just released the lock
+
+    def held_exclusively(self):
+        return any(not shared for shared in self.holders.values())
+
+
+_lock_states = {}
+_wait_statistics = None
+
+# The lock state is normally only manipulated by the server's message-processing thread, but other threads
+# on the server (e.g. the dedicated database writer) also use it, so access is guarded by a mutex.
+_lock_state_mutex = threading.RLock()
+_server_lock_grants = {} # lock_id -> [threading.Event, outcome, impose_filesystem_delay] for requests from the server
+
+def _get_lock_state(lock_id):
+    state = _lock_states.get(lock_id, None)
+    if state is None:
+        state = _lock_states[lock_id] = _LockState()
+    return state
+
+def get_wait_statistics():
+    """Return the LockWaitStatistics for this run (meaningful only on the server)"""
+    global _wait_statistics
+    if _wait_statistics is None:
+        from . import on_exit_parallelism
+        _wait_statistics = LockWaitStatistics()
+        on_exit_parallelism(_report_wait_statistics)
+    return _wait_statistics
+
+def _report_wait_statistics():
+    global _wait_statistics
+    if _wait_statistics is not None:
+        _wait_statistics.report_to_log_if_needed(log.logger)
+        _wait_statistics = None
+
+def _request_lock(lock_id, proc, shared, upgrade=False, timeout=None):
+    with _lock_state_mutex:
+        log.logger.debug("Received request for lock %r for proc %d, shared=%r, upgrade=%r", lock_id, proc, shared,
+                         upgrade)
+        state = _get_lock_state(lock_id)
+        request = _LockRequest(proc, shared, upgrade)
+        if upgrade:
+            assert state.holders.get(proc, False), "Only a process holding a shared lock can upgrade it"
+            if len(state.queue)>0 and state.queue[0].upgrade:
+                # both processes would wait for the other to release its shared lock
+                _send_outcome(lock_id, request, UPGRADE_CONFLICT)
+                return
+            state.queue.appendleft(request)
+        elif proc in state.holders:
+            # the same process can share the lock more than once (e.g. through separate SharedLock objects); it must
+            # not be queued, since any exclusive request ahead of it is waiting for this process to release the lock
+            assert shared and state.holders[proc], "Lock %r is already held by proc %d"%(lock_id, proc)
+            state.hold_counts[proc] += 1
+            _send_outcome(lock_id, request, GRANTED)
+            return
+        else:
+            state.queue.append(request)
+
+        if timeout is not None:
+            request.deadline = request.time_requested + timeout
+
+        _grant_waiting(lock_id)
+
+def time_to_next_deadline():
+    """Return the number of seconds until the next waiting request times out, or None if none can time out"""
+    with _lock_state_mutex:
+        deadlines = [request.deadline for state in _lock_states.values() for request in state.queue
+                     if request.deadline is not None]
+    if len(deadlines)==0:
+        return None
+    return max(0.0, min(deadlines)-time.time())
+
+def expire_overdue_requests():
+    """Withdraw any waiting requests whose timeout has passed. Called by the server's main loop."""
+    with _lock_state_mutex:
+        now = time.time()
+        for lock_id, state in _lock_states.items():
+            overdue = [request for request in state.queue if request.deadline is not None and request.deadline<=now]
+            for request in overdue:
+                state.queue.remove(request)
+                log.logger.debug("Request for lock %r for proc %d timed out", lock_id, request.proc)
+                get_wait_statistics().record_timeout(lock_id)
+                _send_outcome(lock_id, request, TIMED_OUT)
+            if len(overdue)>0:
+                _grant_waiting(lock_id) # the expired requests may have been holding up others
+
+def _relinquish_lock(lock_id, proc):
+    with _lock_state_mutex:
+        state = _get_lock_state(lock_id)
+        assert proc in state.holders, "Consistency error in locking: can't find a record of the lock being released"
+        state.hold_counts[proc] -= 1
+        if state.hold_counts[proc]>0:
+            return
+        del state.hold_counts[proc]
+        if not state.holders.pop(proc):
+            state.impose_filesystem_delay = True
+        log.logger.debug("Finished with lock %r for proc %d", lock_id, proc)
+        _grant_waiting(lock_id)
+
+def _grant_waiting(lock_id):
+    """Grant the lock to waiting requests that are now able to hold it"""
+    state = _get_lock_state(lock_id)
+    while len(state.queue)>0:
+        request = state.queue[0]
+        if request.upgrade:
+            if state.holders.keys() == {request.proc}:
+                state.queue.popleft()
+                _grant(lock_id, request)
+            return
+        elif request.shared:
+            if state.held_exclusively():
+                return
+            while len(state.queue)>0 and state.queue[0].shared:
+                _grant(lock_id, state.queue.popleft())
+            return
         else:
-            log.logger.debug("Issue lock %r to proc %d", lock_id, proc)
-            MessageGrantLock((lock_id, impose_filesystem_delay)).send(proc)
-
-def _issue_shared_locks(lock_id, impose_filesystem_delay=False):
-    queue = _get_lock_queue(lock_id)
-    sharers_notified = 0
-    for proc, shared in queue:
-        if shared:
-            log.logger.debug("Issue shared lock %r to proc %d",lock_id, proc)
-            MessageGrantLock((lock_id, impose_filesystem_delay)).send(proc)
-            sharers_notified += 1
-    _increment_lock_num_shared(lock_id,sharers_notified)
-    log.logger.debug("Lock %r is currently in shared mode, with %d process(es) sharing it",
-                     lock_id, _get_lock_num_sharers(lock_id))
-
-def _release_lock_exclusive(lock_id, proc):
-    queue = _get_lock_queue(lock_id)
-    assert queue[0] == (proc, False)
-    queue.pop(0)
-    log.logger.debug("Finished with lock %r for proc %d", lock_id, proc)
-    if len(queue) > 0:
-        _issue_next_lock(lock_id, True)
-
-def _release_lock_shared(lock_id, proc):
-    queue = _get_lock_queue(lock_id)
-    assert (proc,True) in queue, "Conistency error in locking: can't find a record of the shared lock being released"
-    index = queue.index((proc, True))
-    del queue[index]
-    _increment_lock_num_shared(lock_id, -1)
-    log.logger.debug("Finished with shared lock %r for proc %d", lock_id, proc)
-    if not _lock_in_shared_mode(lock_id):
-        log.logger.debug("Lock %r exiting shared mode", lock_id)
-        _issue_next_lock(lock_id)
+            if len(state.holders)==0:
+                state.queue.popleft()
+                _grant(lock_id, request)
+            return
 
+def _grant(lock_id, request):
+    state = _get_lock_state(lock_id)
+    state.holders[request.proc] = request.shared
+    if not request.upgrade:
+        state.hold_counts[request.proc] = 1
+    get_wait_statistics().record(lock_id, time.time()-request.time_requested)
+    log.logger.debug("Issue %s lock %r to proc %d", "shared" if request.shared else "exclusive", lock_id,
+                     request.proc)
+    _send_outcome(lock_id, request, GRANTED, state.impose_filesystem_delay)
+    state.impose_filesystem_delay = False
+
+def _send_outcome(lock_id, request, outcome, impose_filesystem_delay=False):
+    if request.proc == 0:
+        grant = _server_lock_grants[lock_id]
+        grant[1] = outcome
+        grant[2] = impose_filesystem_delay
+        grant[0].set()
+    else:
+        MessageGrantLock((lock_id, outcome, impose_filesystem_delay)).send(request.proc)
+
+
+def _is_server():
+    from . import backend
+    return backend.rank()==0
 
 def _any_locks_alive():
-    return any([len(v)>0 for v in _lock_queues.values()])
+    return any(len(state.holders)>0 or len(state.queue)>0 for state in _lock_states.values())
+
+
+def _default_delay():
+    """Return config.DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK or, if that is None, the delay suitable for the database"""
+    if config.DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK is not None:
+        return config.DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK
+    from .. import core
+    engine = core._engine
+    if engine is not None and engine.url.get_backend_name() == 'sqlite':
+        # the sqlite file may be on a network file system, where writes can take a while to become visible elsewhere
+        return 1.0
+    return 0.0
 
 
 class ExclusiveLock:
-    """Named, exclusive, re-entrant lock - only one MPI process can hold a lock of a given name at once"""
+    """Named, exclusive, re-entrant lock - only one MPI process can hold a lock of a given name at once
+
+    :param name: the name of the lock
+    :param delay_before_release: seconds to wait after acquiring the lock from a process that held it exclusively;
+                                 by default, see config.DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK
+    :param timeout: if not None, the number of seconds after which acquire gives up and raises LockTimeout
+    """
     _shared=False
 
-    def __init__(self, name, delay_before_release=DEFAULT_SLEEP_BEFORE_ALLOWING_NEXT_LOCK):
+    def __init__(self, name, delay_before_release=None, timeout=None):
         self.name = name
         self._delay = delay_before_release
+        self._timeout = timeout
         self._count = 0
 
     def acquire(self):
         if not parallelism_is_active():
             return
         if self._count==0:
-            MessageRequestLock(self.name, self._shared).send(0)
             start = time.time()
-            granted = MessageGrantLock.receive(0)
-            lock_id, delay = granted.contents
-            assert lock_id==self.name, "Received a lock that was not requested. The implementation of ExclusiveLock is not locally thread-safe; are you using multiple threads in one process?"
-            if delay:
-                time.sleep(self._delay)
+            self._request(self._shared, False)
             log.logger.debug("Lock %r acquired in %.1fs",self.name, time.time()-start)
         self._count+=1
 
+    def _request(self, shared, upgrade):
+        if _is_server():
+            outcome, delay = self._request_on_server(shared, upgrade)
+        else:
+            MessageRequestLock(self.name, shared, upgrade, self._timeout).send(0)
+            granted = MessageGrantLock.receive(0)
+            lock_id, outcome, delay = granted.contents
+            assert lock_id==self.name, "Received a lock that was not requested. The implementation of ExclusiveLock is not locally thread-safe; are you using multiple threads in one process?"
+
+        if outcome == TIMED_OUT:
+            raise LockTimeout(f"Timed out after {self._timeout}s waiting for lock {self.name!r}")
+        elif outcome == UPGRADE_CONFLICT:
+            raise LockUpgradeConflict(f"Another process is already waiting to upgrade lock {self.name!r}")
+        if delay:
+            delay_seconds = _default_delay() if self._delay is None else self._delay
+            if delay_seconds>0:
+                time.sleep(delay_seconds)
+
+    def _request_on_server(self, shared, upgrade):
+        with _lock_state_mutex:
+            assert self.name not in _server_lock_grants, "Only one thread on the server can wait for a given lock"
+            grant = _server_lock_grants[self.name] = [threading.Event(), None, False]
+            _request_lock(self.name, 0, shared, upgrade, self._timeout)
+        while not grant[0].wait(self._timeout):
+            # the main loop may be blocked in a receive that began before this request was made, so expire it here;
+            # server-side requests only come from async worker threads, which exist only if the backend can send
+            expire_overdue_requests()
+        with _lock_state_mutex:
+            del _server_lock_grants[self.name]
+        return grant[1], grant[2]
+
     def release(self):
         if not parallelism_is_active():
             return
         self._count-=1
         if self._count==0:
-            MessageRelinquishLock(self.name).send(0)
+            if _is_server():
+                _relinquish_lock(self.name, 0)
+            else:
+                MessageRelinquishLock(self.name).send(0)
 
     def __enter__(self):
         self.acquire()
@@ -154,3 +376,13 @@ class SharedLock(ExclusiveLock):
     """Named, shared, re-entrant lock - multiple MPI processes can hold a lock of a given name at once, but not while an
     ExclusiveLock of the same name is also held"""
     _shared=True
+
+    def upgrade(self):
+        """Convert the shared lock, which must be held, into an exclusive one, waiting until no other process shares it.
+
+        The lock remains exclusive until it is released. If another process is already waiting to upgrade the same
+        lock, LockUpgradeConflict is raised, since neither could proceed; the shared lock is then still held."""
+        if not parallelism_is_active():
+            return
+        assert self._count>0, "Cannot upgrade a lock that is not held"
+        self._request(False, True)
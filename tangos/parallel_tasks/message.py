@@ -91,15 +91,21 @@ class Message(metaclass=MessageMetaClass):
         backend.send(self.serialize(), destination=destination, tag=self._tag)
 
     @classmethod
-    def receive(cls, source=None):
+    def receive(cls, source=None, timeout=None):
+        """Receive a message of this class. If timeout is not None, return None if nothing arrives in that many
+        seconds (except with backends that cannot time out, which wait indefinitely)"""
         from . import backend
         global reception_timing_monitor
 
         if reception_timing_monitor is not None:
             with reception_timing_monitor(cls):
-                msg, source, tag = backend.receive_any(source=None)
+                received = backend.receive_any(source=None, timeout=timeout)
         else:
-            msg, source, tag = backend.receive_any(source=None)
+            received = backend.receive_any(source=None, timeout=timeout)
+
+        if received is None:
+            return None
+        msg, source, tag = received
 
         obj = Message.interpret_and_deserialize(tag, source, msg)
 
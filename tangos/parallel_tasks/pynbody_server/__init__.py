@@ -8,6 +8,7 @@ import pynbody.snapshot.copy_on_access
 
 import tangos.parallel_tasks.pynbody_server.snapshot_queue
 
+from ...util import kdtree_cache
 from .. import log, remote_import
 from ..async_message import AsyncProcessedMessage
 from ..message import ExceptionMessage, Message
@@ -60,6 +61,8 @@ class ReturnPynbodyArray(Message):
         transfer_array.send_array(self.contents, destination, use_shared_memory=self.shared_mem)
 
 class BuildRemoteTree(AsyncProcessedMessage):
+    expects_response = False
+
     def process_async(self):
         log.logger.debug("Processing tree build request from %d", self.source)
         start = time.time()
@@ -67,30 +70,37 @@ class BuildRemoteTree(AsyncProcessedMessage):
         log.logger.debug("Tree built after %.2fs", time.time()-start)
 
 class ReturnSharedTree(Message):
-    def __init__(self, leafsize, boxsize, kdnodes, offsets, kernel_id):
+    def __init__(self, leafsize, boxsize, kdnodes, offsets, kernel_id, cache_files=None):
+        """The tree to be attached to a shared memory view; if cache_files is not None, the tree is instead
+        memory-mapped by the client from those files (see util.kdtree_cache) and the arrays are not transmitted"""
         super().__init__()
         self.leafsize = leafsize
         self.boxsize = boxsize
         self.kdnodes = kdnodes
         self.offsets = offsets
         self.kernel_id = kernel_id
+        self.cache_files = cache_files
 
     def serialize(self):
-        return self.leafsize, self.boxsize, self.kernel_id
+        return self.leafsize, self.boxsize, self.kernel_id, self.cache_files
 
     @classmethod
     def deserialize(cls, source, message):
-        leafsize, boxsize, kernel_id = message
-        kdnodes = transfer_array.receive_array(source, use_shared_memory=True)
-        offsets = transfer_array.receive_array(source, use_shared_memory=True)
-        obj = cls(leafsize, boxsize, kdnodes, offsets, kernel_id)
+        leafsize, boxsize, kernel_id, cache_files = message
+        if cache_files is None:
+            kdnodes = transfer_array.receive_array(source, use_shared_memory=True)
+            offsets = transfer_array.receive_array(source, use_shared_memory=True)
+        else:
+            _, _, kdnodes, offsets, _ = kdtree_cache.load_tree_arrays(cache_files)
+        obj = cls(leafsize, boxsize, kdnodes, offsets, kernel_id, cache_files)
         obj.source = source
         return obj
 
     def send(self, destination):
         super().send(destination)
-        transfer_array.send_array(self.kdnodes, destination, use_shared_memory=True)
-        transfer_array.send_array(self.offsets, destination, use_shared_memory=True)
+        if self.cache_files is None:
+            transfer_array.send_array(self.kdnodes, destination, use_shared_memory=True)
+            transfer_array.send_array(self.offsets, destination, use_shared_memory=True)
 
     def import_tree_into_local_view(self, sim):
         sim.import_tree((self.leafsize, self.boxsize, self.kdnodes, self.offsets, self.kernel_id))
@@ -101,7 +111,8 @@ class GetSharedTree(AsyncProcessedMessage):
         assert _server_queue.current_shared_mem_flag
         assert hasattr(_server_queue.current_snapshot, "kdtree")
         serialized_tree = _server_queue.current_snapshot.kdtree.serialize()
-        ReturnSharedTree(*serialized_tree).send(self.source)
+        cache_files = kdtree_cache.saved_tree_files(_server_queue.current_snapshot)
+        ReturnSharedTree(*serialized_tree, cache_files=cache_files).send(self.source)
 
 class RequestPynbodyArray(AsyncProcessedMessage):
     _time_to_start_processing = []
@@ -158,13 +169,7 @@ class RequestPynbodyArray(AsyncProcessedMessage):
             log.logger.debug("Receive request for array %r from %d",self.array,self.source)
             subsnap = _server_queue.get_subsnap(self.filter_or_object_spec, self.fam)
             transfer_via_shared_mem = _server_queue.current_shared_mem_flag
-
-            with subsnap.immediate_mode, subsnap.lazy_derive_off:
-                if subsnap._array_name_implies_ND_slice(self.array):
-                    raise KeyError("Not transferring a single slice %r of a ND array"%self.array)
-                subarray = subsnap[self.array]
-                assert isinstance(subarray, pynbody.array.SimArray)
-                array_result = ReturnPynbodyArray(subarray, transfer_via_shared_mem)
+            array_result = ReturnPynbodyArray(_get_array_to_transfer(subsnap, self.array), transfer_via_shared_mem)
 
         except Exception as e:
             array_result = ExceptionMessage(e)
@@ -174,6 +179,84 @@ class RequestPynbodyArray(AsyncProcessedMessage):
         gc.collect()
         log.logger.debug("Array sent after %.2fs"%(time.time()-start_time))
 
+def _get_array_to_transfer(subsnap, array_name):
+    with subsnap.immediate_mode, subsnap.lazy_derive_off:
+        if subsnap._array_name_implies_ND_slice(array_name):
+            raise KeyError("Not transferring a single slice %r of a ND array"%array_name)
+        subarray = subsnap[array_name]
+        assert isinstance(subarray, pynbody.array.SimArray)
+        return subarray
+
+
+class ReturnPynbodyArrays(Message):
+    """The response to RequestPynbodyArrays: a list of arrays, any of which may instead be an exception"""
+
+    def __init__(self, contents, shared_mem=False):
+        self.shared_mem = shared_mem
+        super().__init__(contents)
+
+    def serialize(self):
+        header = []
+        for result in self.contents:
+            if isinstance(result, Exception):
+                header.append(('error', result))
+            else:
+                header.append(('array', getattr(result, 'units', None)))
+        return pickle.dumps((header, self.shared_mem))
+
+    @classmethod
+    def deserialize(cls, source, message):
+        header, shared_mem = pickle.loads(message)
+        contents = []
+        for kind, info in header:
+            if kind == 'error':
+                contents.append(info)
+            else:
+                array = transfer_array.receive_array(source, use_shared_memory=shared_mem)
+                if info is not None:
+                    if not isinstance(array, pynbody.array.SimArray):
+                        array = array.view(pynbody.array.SimArray)
+                    array.units = info
+                contents.append(array)
+        obj = cls(contents, shared_mem=shared_mem)
+        obj.source = source
+        return obj
+
+    def send(self, destination):
+        super().send(destination)
+        for result in self.contents:
+            if not isinstance(result, Exception):
+                transfer_array.send_array(result, destination, use_shared_memory=self.shared_mem)
+
+
+class RequestPynbodyArrays(RequestPynbodyArray):
+    """Request several arrays in one round trip; arrays is a list of (array_name, family) pairs"""
+
+    def __init__(self, filter_or_object_spec, arrays, request_sent_time=None):
+        super().__init__(filter_or_object_spec, arrays, None, request_sent_time)
+
+    def serialize(self):
+        return self.filter_or_object_spec, self.array, time.time()
+
+    def process_async(self):
+        start_time = time.time()
+        self._time_to_start_processing.append(start_time - self.request_sent_time)
+        log.logger.debug("Receive request for arrays %r from %d", self.array, self.source)
+
+        results = []
+        for array_name, fam in self.array:
+            try:
+                subsnap = _server_queue.get_subsnap(self.filter_or_object_spec, fam)
+                results.append(_get_array_to_transfer(subsnap, array_name))
+            except Exception as e:
+                results.append(e)
+
+        ReturnPynbodyArrays(results, _server_queue.current_shared_mem_flag).send(self.source)
+        del results
+        gc.collect()
+        log.logger.debug("%d arrays sent after %.2fs", len(self.array), time.time()-start_time)
+
+
 class RequestIndexList(RequestPynbodyArray):
     def __init__(self, filter_or_object_spec, request_sent_time=None):
         super().__init__(filter_or_object_spec, 'remote-index-list', None, request_sent_time)
@@ -302,6 +385,41 @@ class RemoteSnap(pynbody.snapshot.copy_on_access.UnderlyingClassMixin, pynbody.s
         except KeyError:
             self._unavailable_arrays.append((array_name, fam))
             raise OSError("No such array %r available from the remote"%array_name)
+        self._import_array(array_name, fam, data)
+
+    def prefetch_arrays(self, array_names):
+        """Fetch all the named arrays that are not yet present, for all families, in a single round trip
+
+        Arrays that can be loaded for the whole snapshot are fetched in one piece; otherwise they are fetched for each
+        family in which they can be loaded. Names that are not loadable (e.g. derived arrays) are ignored, and will be
+        derived locally as usual when accessed."""
+        requests = []
+        for array_name in array_names:
+            if array_name in self._loadable_keys:
+                if array_name not in self.keys():
+                    requests.append((array_name, None))
+            else:
+                for fam in self.families():
+                    if array_name in self._fam_loadable_keys.get(fam, []) and array_name not in self[fam].keys():
+                        requests.append((array_name, fam))
+
+        requests = [r for r in requests if r not in self._unavailable_arrays]
+        if len(requests)==0:
+            return
+
+        start_time = time.time()
+        RequestPynbodyArrays(self._filter_or_object_spec, requests).send(self._server_id)
+        results = ReturnPynbodyArrays.receive(self._server_id).contents
+        log.logger.debug("%d arrays received in one batch; waited %.2fs", len(requests), time.time()-start_time)
+
+        for (array_name, fam), data in zip(requests, results):
+            if isinstance(data, KeyError):
+                self._unavailable_arrays.append((array_name, fam))
+            elif not isinstance(data, Exception):
+                self._import_array(array_name, fam, data)
+            # other errors are left to be raised if and when the array is actually accessed
+
+    def _import_array(self, array_name, fam, data):
         with self.auto_propagate_off:
             if len(data.shape)==1:
                 ndim = 1
@@ -1,9 +1,14 @@
 import multiprocessing
+import threading
+from collections import OrderedDict
 
+import numpy as np
 import pynbody
+import pynbody.array.shared
 
 from ...parallel_tasks.async_message import AsyncProcessedMessage
 from ...parallel_tasks.message import Message
+from ...util import kdtree_cache
 from ...util.check_deleted import check_deleted
 from .. import config, log
 
@@ -13,6 +18,168 @@ class ConfirmLoadPynbodySnapshot(Message):
 
 
 
+def _snapshot_key(handler, filename, shared_mem):
+    # handlers arrive pickled from each client, so are identified by their class and simulation
+    return type(handler), handler.basename, filename, shared_mem
+
+def _loaded_array_names(snapshot):
+    """Return (family, name) for each array loaded from disk into the snapshot; family is None for full arrays"""
+    names = [(None, name) for name in snapshot.keys() if name in snapshot.loadable_keys()]
+    for name, family_arrays in snapshot._family_arrays.items():
+        names += [(fam, name) for fam in family_arrays if name in snapshot.loadable_keys(fam)]
+    return names
+
+def _load_snapshot(handler, filename, shared_mem):
+    """Load a new copy of the snapshot, which is not shared with any other user of the handler's cache"""
+    snapshot = handler.load_timestep_without_caching(filename)
+    if shared_mem:
+        snapshot._shared_arrays = True
+    snapshot.physical_units()
+    return snapshot
+
+def _snapshot_nbytes(snapshot):
+    nbytes = sum(array.nbytes for array in snapshot._arrays.values())
+    for family_arrays in snapshot._family_arrays.values():
+        nbytes += sum(array.nbytes for array in family_arrays.values())
+    return nbytes
+
+
+def _subsnap_nbytes(subsnap):
+    """Return the number of bytes held by a subsnap itself (its index list and own arrays), not by its ancestor"""
+    nbytes = 0
+    index = getattr(subsnap, '_slice', None)
+    if isinstance(index, np.ndarray):
+        nbytes += index.nbytes
+    if subsnap.ancestor is subsnap or isinstance(subsnap, pynbody.halo.Halo):
+        # NB halos (and snapshots loaded as copies) hold arrays of their own
+        nbytes += sum(array.nbytes for array in getattr(subsnap, '_arrays', {}).values())
+        for family_arrays in getattr(subsnap, '_family_arrays', {}).values():
+            nbytes += sum(array.nbytes for array in family_arrays.values())
+    return nbytes
+
+
+class SubsnapCache:
+    """A least-recently-used cache of subsnaps, bounded by the number of bytes they hold
+
+    The size of each subsnap is measured again whenever it is used, since arrays may have been derived or loaded
+    into it. The hit, miss and eviction counts are reported by the server when each snapshot is closed."""
+
+    def __init__(self, max_bytes=None):
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict() # key -> (subsnap, nbytes), least recently used first
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def max_bytes(self):
+        return config.pynbody_server_subsnap_cache_bytes if self._max_bytes is None else self._max_bytes
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, create):
+        """Return the cached subsnap for key, or call create() to generate it and add it to the cache"""
+        if key in self._entries:
+            self.hits += 1
+            subsnap, _ = self._entries[key]
+            self._entries.move_to_end(key)
+        else:
+            self.misses += 1
+            subsnap = create()
+        self._store(key, subsnap)
+        return subsnap
+
+    def _store(self, key, subsnap):
+        if key in self._entries:
+            self.nbytes -= self._entries[key][1]
+        nbytes = _subsnap_nbytes(subsnap)
+        self._entries[key] = (subsnap, nbytes)
+        self.nbytes += nbytes
+        self._evict()
+
+    def _evict(self):
+        # the most recently used subsnap (which is about to be returned) is always kept
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+    def reset_statistics(self):
+        self.hits = self.misses = self.evictions = 0
+
+    def statistics_summary(self):
+        return "%d subsnap cache hits, %d misses, %d evictions; %d subsnaps (%.1f MB) cached" % (
+            self.hits, self.misses, self.evictions, len(self._entries), self.nbytes/1e6)
+
+
+class PrefetchedSnapshot:
+    """A snapshot that is read from disk in a background thread, for use once clients request it"""
+
+    def __init__(self, handler, filename, shared_mem, array_names=(), estimated_nbytes=0):
+        self.handler = handler
+        self.filename = filename
+        self.shared_mem = shared_mem
+        self._array_names = list(array_names)
+        self._estimated_nbytes = estimated_nbytes
+        self._snapshot = None
+        self._exception = None
+        self._thread = threading.Thread(target=self._load, daemon=True)
+        self._thread.start()
+
+    def _load(self):
+        try:
+            snapshot = _load_snapshot(self.handler, self.filename, self.shared_mem)
+        except Exception as e:
+            # re-raised when the snapshot is actually required, as though it were being loaded at that point
+            self._exception = e
+            return
+
+        for fam, name in self._array_names:
+            try:
+                (snapshot if fam is None else snapshot[fam])[name]
+            except (OSError, KeyError, ValueError):
+                pass
+
+        try:
+            # the catalogue is kept alive by the snapshot, and found again once the snapshot is in use
+            with self.handler.timestep_in_this_thread(self.filename, snapshot):
+                self.handler.get_catalogue(self.filename, 'halo')
+        except Exception:
+            # the catalogue will be generated (or the error reported) when a client actually requires it
+            pass
+
+        self._snapshot = snapshot
+        log.logger.info("Pynbody server: prefetched %r", self.filename)
+
+    def is_ready(self):
+        return not self._thread.is_alive()
+
+    def result(self):
+        """Wait for the snapshot to be read, then return it"""
+        self._thread.join()
+        if self._exception is not None:
+            raise self._exception
+        return self._snapshot
+
+    def nbytes(self):
+        """Return the bytes held by the snapshot, or the estimate given on construction while it is still being read"""
+        if not self.is_ready():
+            return self._estimated_nbytes
+        elif self._snapshot is not None:
+            return _snapshot_nbytes(self._snapshot)
+        else:
+            return 0
+
+
 class PynbodySnapshotQueue:
     def __init__(self):
         self.timestep_queue = []
@@ -21,11 +188,14 @@ class PynbodySnapshotQueue:
         self.load_requester_queue = []
         self.current_timestep = None
         self.current_snapshot = None
-        self.current_subsnap_cache = {}
+        self.current_subsnap_cache = SubsnapCache()
         self.current_handler = None
         self.current_portable_catalogues = {}
         self.in_use_by = []
 
+        self.prefetched = {} # snapshot key -> PrefetchedSnapshot
+        self.retained = OrderedDict() # snapshot key -> released snapshot, least recently used first
+
 
     def add(self, requester, handler, filename, shared_mem=False):
         log.logger.debug("Pynbody server: client %d requests access to %r", requester, filename)
@@ -37,8 +207,8 @@ class PynbodySnapshotQueue:
         elif filename in self.timestep_queue:
             queue_position = self.timestep_queue.index(filename)
             self.load_requester_queue[queue_position].append(requester)
-            assert self.handler_queue[queue_position] == handler
-            assert self.shared_mem_queue[queue_position] == shared_mem
+            assert _snapshot_key(self.handler_queue[queue_position], filename, self.shared_mem_queue[queue_position]) \
+                   == _snapshot_key(handler, filename, shared_mem)
         else:
             self.timestep_queue.append(filename)
             self.handler_queue.append(handler)
@@ -57,18 +227,10 @@ class PynbodySnapshotQueue:
             if fam is None:
                 return self.current_snapshot
             else:
-                if fam not in self.current_subsnap_cache.keys():
-                    self.current_subsnap_cache[fam] = self.current_snapshot[fam]
-                return self.current_subsnap_cache[fam]
-
-        elif (filter_or_object_spec, fam) in self.current_subsnap_cache:
-            log.logger.debug("Pynbody server: cache hit for %r (fam %r)",filter_or_object_spec, fam)
-            return self.current_subsnap_cache[(filter_or_object_spec, fam)]
+                return self.current_subsnap_cache.get(fam, lambda: self.current_snapshot[fam])
         else:
-            log.logger.debug("Pynbody server: cache miss for %r (fam %r)",filter_or_object_spec, fam)
-            subsnap = self.get_subsnap_uncached(filter_or_object_spec, fam)
-            self.current_subsnap_cache[(filter_or_object_spec, fam)] = subsnap
-            return subsnap
+            return self.current_subsnap_cache.get((filter_or_object_spec, fam),
+                                                  lambda: self.get_subsnap_uncached(filter_or_object_spec, fam))
 
     def get_subsnap_uncached(self, filter_or_object_spec, fam):
 
@@ -108,8 +270,8 @@ class PynbodySnapshotQueue:
                 num_threads = multiprocessing.cpu_count()
             else:
                 num_threads = None
-            self.current_snapshot.build_tree(num_threads=num_threads,
-                                             shared_mem=self.current_shared_mem_flag)
+            kdtree_cache.build_tree(self.current_snapshot, num_threads=num_threads,
+                                    shared_mem=self.current_shared_mem_flag)
 
     def _free_if_unused(self):
         if len(self.in_use_by)==0:
@@ -120,14 +282,73 @@ class PynbodySnapshotQueue:
             if RequestPynbodyArray.get_num_requests() > 0:
                 log.logger.info("    Summed process waiting time: %.1fs", RequestPynbodyArray.get_total_wait_time())
                 RequestPynbodyArray.reset_performance_stats()
+            log.logger.info("    %s", self.current_subsnap_cache.statistics_summary())
+
+            if self.current_snapshot is not None and config.pynbody_server_memory_budget > 0:
+                key = _snapshot_key(self.current_handler, self.current_timestep, self.current_shared_mem_flag)
+                self.retained[key] = self.current_snapshot
+                self.current_snapshot = None
 
             with check_deleted(self.current_snapshot):
                 self.current_snapshot = None
                 self.current_timestep = None
-                self.current_subsnap_cache = {}
+                self.current_subsnap_cache = SubsnapCache()
                 self.current_portable_catalogues = {}
                 self.current_handler = None
 
+            self._evict_to_memory_budget()
+
+    def _memory_in_reserve(self):
+        return sum(_snapshot_nbytes(s) for s in self.retained.values()) + \
+            sum(p.nbytes() for p in self.prefetched.values())
+
+    def _evict_to_memory_budget(self):
+        while len(self.retained) > 0 and self._memory_in_reserve() > config.pynbody_server_memory_budget:
+            key, snapshot = self.retained.popitem(last=False)
+            log.logger.info("Pynbody server: closing retained snapshot %r to stay within memory budget", key[2])
+            with check_deleted(snapshot):
+                del snapshot
+
+    def _start_prefetching(self):
+        """Start reading the first few queued snapshots in the background, within the memory budget"""
+        if config.pynbody_server_prefetch_depth <= 0 or config.pynbody_server_memory_budget <= 0:
+            return
+
+        if self.current_snapshot is not None:
+            array_names = _loaded_array_names(self.current_snapshot)
+            # successive snapshots of a simulation are of similar size, so the current one estimates what a prefetch
+            # will occupy while it is still being read
+            estimated_nbytes = _snapshot_nbytes(self.current_snapshot)
+        else:
+            array_names = []
+            estimated_nbytes = 0
+
+        for handler, filename, shared_mem in list(zip(self.handler_queue, self.timestep_queue,
+                                                      self.shared_mem_queue))[:config.pynbody_server_prefetch_depth]:
+            key = _snapshot_key(handler, filename, shared_mem)
+            if key in self.prefetched or key in self.retained:
+                continue
+            if self._memory_in_reserve() + estimated_nbytes > config.pynbody_server_memory_budget:
+                break
+            log.logger.info("Pynbody server: prefetching %r", filename)
+            self.prefetched[key] = PrefetchedSnapshot(handler, filename, shared_mem, array_names, estimated_nbytes)
+
+    def _take_loaded_snapshot(self, handler, filename, shared_mem):
+        """Return the snapshot, using a retained or prefetched copy if one exists, else loading it now"""
+        key = _snapshot_key(handler, filename, shared_mem)
+        if key in self.retained:
+            log.logger.info("Pynbody server: reusing retained snapshot %r", filename)
+            snapshot = self.retained.pop(key)
+        elif key in self.prefetched:
+            if not self.prefetched[key].is_ready():
+                log.logger.info("Pynbody server: waiting for prefetch of %r to complete", filename)
+            snapshot = self.prefetched.pop(key).result()
+        else:
+            snapshot = _load_snapshot(handler, filename, shared_mem)
+        # snapshots with and without shared memory are distinct, so the handler's cache must refer to this one
+        handler.cache_timestep(filename, snapshot)
+        return snapshot
+
     def _notify_available(self, node):
         log.logger.debug("Pynbody server: notify %d that snapshot is now available", node)
         ConfirmLoadPynbodySnapshot(type(self.current_snapshot)).send(node)
@@ -148,12 +369,11 @@ class PynbodySnapshotQueue:
             notify = self.load_requester_queue.pop(0)
 
             try:
-                self.current_snapshot = self.current_handler.load_timestep(self.current_timestep)
+                self.current_snapshot = self._take_loaded_snapshot(self.current_handler, self.current_timestep,
+                                                                   self.current_shared_mem_flag)
                 log.logger.info("Pynbody server: loaded %r", self.current_timestep)
                 if self.current_shared_mem_flag:
                     log.logger.info("                (shared memory mode)")
-                    self.current_snapshot._shared_arrays = True
-                self.current_snapshot.physical_units()
                 success = True
             except OSError:
                 success = False
@@ -162,6 +382,7 @@ class PynbodySnapshotQueue:
                 self.in_use_by = notify
                 for n in notify:
                     self._notify_available(n)
+                self._start_prefetching()
             else:
                 self.current_timestep = None
                 self.current_handler = None
@@ -172,6 +393,7 @@ class PynbodySnapshotQueue:
                 self._load_next_if_free()
 
         else:
+            self._start_prefetching()
             log.logger.info("The currently loaded snapshot is still required and so other clients will have to wait")
             log.logger.info("(Currently %d snapshots are in the queue to be loaded later)", len(self.timestep_queue))
 
@@ -180,12 +402,23 @@ _server_queue = PynbodySnapshotQueue()
 
 
 class RequestLoadPynbodySnapshot(AsyncProcessedMessage):
+    expects_response = False # the confirmation is sent once the snapshot becomes available, which may be much later
+
     def process(self):
+        if len(self.contents)>2 and self.contents[2]:
+            # pynbody registers a signal handler when it first creates shared memory, which is only possible from the
+            # main thread, whereas the snapshot will be loaded by a worker thread (see async_message)
+            pynbody.array.shared._register_sigterm_handler()
+        super().process()
+
+    def process_async(self):
         _server_queue.add(self.source, *self.contents)
 
 
 class ReleasePynbodySnapshot(AsyncProcessedMessage):
-    def process(self):
+    expects_response = False
+
+    def process_async(self):
         _server_queue.free(self.source)
 
 
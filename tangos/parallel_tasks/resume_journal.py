@@ -0,0 +1,234 @@
+"""Append-only journals of the jobs completed in distributed loops, from which interrupted runs resume
+
+Each run of tangos (strictly, each server process) appends to its own journal file. When an iteration first
+completes jobs, a 'state' record is written holding its context (see jobs.IterationState) and full completion state;
+after that, each completion appends a 'complete' record listing only the newly-completed jobs. When the iteration
+finishes, a 'finished' record is appended and the iteration is forgotten by the process. Once the completion records
+outgrow the state records, the journal is rewritten (via a temporary file, so that it is never seen half-written) to
+hold a single state record per unfinished iteration and a 'finished' record per finished one. The total I/O per job is
+therefore O(1) however long the loop is, and the journal stays a few times smaller than the completion state of the
+iterations still running.
+
+Journals are kept per database, in a folder under ~/.tangos_resume_state named after a hash of the database URL.
+Reading all the journals in the folder in order of creation recovers the most recent state of every iteration run
+against the database. Any incomplete record at the end of a journal (e.g. if the process was killed while writing) is
+ignored. Earlier versions of tangos instead wrote tangos_resume_state_*.pickle files directly into
+~/.tangos_resume_state, shared between all databases; these are still read (see read_legacy_states) so that runs
+interrupted before upgrading can resume."""
+
+import hashlib
+import os
+import pathlib
+import pickle
+
+from .. import log
+
+_journals = {} # folder -> ResumeJournal being written by this process
+_legacy_states = None # states read from the files written by earlier versions, once per process
+
+STATE = 'state'
+COMPLETE = 'complete'
+FINISHED = 'finished'
+
+
+def _root_folder():
+    return pathlib.Path("~").expanduser() / ".tangos_resume_state"
+
+def journal_folder():
+    """Return the folder holding the resume journals for the current database, creating it if necessary"""
+    from .. import core
+    engine = core._engine
+    path = _root_folder()
+    if engine is not None:
+        url = engine.url
+        if url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:'):
+            # the same file may be reached through different relative paths
+            url = url.set(database=os.path.abspath(url.database))
+        url = url.render_as_string(hide_password=True)
+        path /= hashlib.sha256(url.encode('utf-8')).hexdigest()[:16]
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+def legacy_files():
+    return sorted(_root_folder().glob("tangos_resume_state_*.pickle"))
+
+def read_legacy_states():
+    """Return the completion states stored by earlier versions of tangos, which are not specific to any database
+
+    The files are read only once per process, and a warning is issued if any are found."""
+    global _legacy_states
+    if _legacy_states is None:
+        from .jobs import IterationState
+        _legacy_states = {}
+        paths = legacy_files()
+        for path in paths:
+            try:
+                with open(path, 'rb') as f:
+                    stored = pickle.load(f)
+                for context, string in stored.items():
+                    _legacy_states[context] = IterationState.from_string(string, backend_size=1)._jobs_complete
+            except (OSError, EOFError, pickle.UnpicklingError):
+                log.logger.warning(f"Error reading resume state from {str(path):s}. Skipped.")
+        if len(paths) > 0:
+            log.logger.warning(f"Found resume state written by an earlier version of tangos in "
+                               f"{str(_root_folder()):s}. It is used if a loop matches, but is not specific to a "
+                               f"database; delete the tangos_resume_state_*.pickle files once any interrupted runs "
+                               f"have been resumed.")
+    return _legacy_states
+
+def journal_files(folder):
+    return sorted(folder.glob("tangos_resume_journal_*.journal"))
+
+def get_journal():
+    """Return the journal to which this process records completions against the current database"""
+    folder = journal_folder()
+    journal = _journals.get(folder, None)
+    if journal is None:
+        journal = _journals[folder] = ResumeJournal(folder)
+    return journal
+
+def read_journal(path):
+    """Replay the records in a journal, returning a dictionary mapping each iteration context to its list of
+    completed jobs"""
+    states = {}
+    keys = {}
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                record = pickle.load(f)
+            except EOFError:
+                break
+            except (pickle.UnpicklingError, ValueError, AttributeError, IndexError):
+                log.logger.warning(f"Incomplete record at the end of resume journal {str(path):s}. Ignored.")
+                break
+            if record[0] == STATE:
+                _, key, context, jobs_complete = record
+                keys[key] = context
+                states[context] = jobs_complete
+            elif record[0] == COMPLETE:
+                _, key, jobs = record
+                jobs_complete = states[keys[key]]
+                for job in jobs:
+                    jobs_complete[job] = True
+            elif record[0] == FINISHED:
+                _, context, num_jobs = record
+                states[context] = [True]*num_jobs
+    return states
+
+def read_all_journals(folder=None):
+    """Return the most recent completion state of every iteration recorded in the journals for the current database,
+    or by earlier versions of tangos"""
+    states = dict(read_legacy_states())
+    for path in journal_files(folder or journal_folder()):
+        try:
+            states.update(read_journal(path))
+        except (OSError, KeyError):
+            log.logger.warning(f"Error reading resume journal {str(path):s}. Skipped.")
+    return states
+
+def clear_journals():
+    """Delete all the resume journals for the current database"""
+    folder = journal_folder()
+    journal = _journals.pop(folder, None)
+    if journal is not None:
+        journal.close()
+    for path in folder.iterdir():
+        if path.is_file():
+            path.unlink()
+
+def clear_legacy_states():
+    """Delete the resume state stored by earlier versions of tangos"""
+    global _legacy_states
+    for path in legacy_files():
+        path.unlink()
+    _legacy_states = None
+
+
+class ResumeJournal:
+    """The journal to which one process records the jobs it has seen completed"""
+
+    min_compaction_bytes = 1 << 16 # journals smaller than this are never compacted
+
+    def __init__(self, folder):
+        self._folder = folder
+        self._path = None
+        self._file = None
+        self._keys = {} # context -> integer key used in records, for unfinished iterations only
+        self._next_key = 0
+        self._jobs_complete = {} # context -> list of job completion flags, shared with the IterationState
+        self._finished = {} # context -> number of jobs, for iterations that finished while this journal was open
+        self._state_bytes = 0 # size of the state records, i.e. of the journal when freshly compacted
+
+    @property
+    def path(self):
+        return self._path
+
+    def _create_file(self):
+        existing = journal_files(self._folder)
+        i = int(existing[-1].stem.split("_")[-1]) + 1 if len(existing) > 0 else 0
+        while True:
+            path = self._folder / f"tangos_resume_journal_{i:06d}.journal"
+            try:
+                self._file = open(path, 'xb')  # exclusive creation, in case another run is choosing a name too
+            except FileExistsError:
+                i += 1
+            else:
+                self._path = path
+                return
+
+    def _append(self, record):
+        if self._file is None:
+            self._create_file()
+        start = self._file.tell()
+        pickle.dump(record, self._file)
+        self._file.flush()
+        return self._file.tell() - start
+
+    def record_complete(self, context, jobs_complete, jobs):
+        """Record that the specified jobs have been completed in the iteration with the given context.
+
+        jobs_complete is the iteration's list of completion flags, to which the jobs must already have been
+        marked complete. It is retained so that the journal can be compacted later."""
+        key = self._keys.get(context, None)
+        if key is None or self._jobs_complete[context] is not jobs_complete:
+            # the first completion in this iteration (or in a fresh iteration with the same context as an earlier one)
+            if key is None:
+                key = self._keys[context] = self._next_key
+                self._next_key += 1
+            self._finished.pop(context, None)
+            self._jobs_complete[context] = jobs_complete
+            self._state_bytes += self._append((STATE, key, context, jobs_complete))
+        else:
+            self._append((COMPLETE, key, list(jobs)))
+            if self._file.tell() > max(2*self._state_bytes, self.min_compaction_bytes):
+                self.compact()
+
+    def record_finished(self, context, jobs_complete):
+        """Record that the iteration with the given context has finished, after which the journal no longer retains
+        its completion flags"""
+        if self._jobs_complete.get(context, None) is not jobs_complete:
+            return # nothing was recorded by this iteration
+        del self._keys[context]
+        del self._jobs_complete[context]
+        self._finished[context] = len(jobs_complete)
+        self._state_bytes += self._append((FINISHED, context, len(jobs_complete)))
+
+    def compact(self):
+        """Rewrite the journal with a single state record for each unfinished iteration"""
+        if self._file is None:
+            return
+        temporary_path = self._path.with_suffix(".tmp")
+        with open(temporary_path, 'wb') as f:
+            for context, num_jobs in self._finished.items():
+                pickle.dump((FINISHED, context, num_jobs), f)
+            for context, key in self._keys.items():
+                pickle.dump((STATE, key, context, self._jobs_complete[context]), f)
+        self._file.close()
+        os.replace(temporary_path, self._path)
+        self._file = open(self._path, 'ab')
+        self._state_bytes = self._file.tell()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
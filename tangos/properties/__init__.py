@@ -41,6 +41,11 @@ class PropertyCalculation(metaclass=PropertyCalculationMetaClass):
     # False, only existing PropertyCalculation are required by this calculation (see requires_property below).
     requires_particle_data = False
 
+    # Optionally, a tuple of the names of particle arrays that calculate() will use. When particles are being
+    # supplied by a remote server (--load-mode=server), all of these arrays are then fetched in one request, rather than
+    # one request per array and family as they are accessed.
+    required_arrays = ()
+
     # Specifies a tuple of names of properties that will be calculated by this class.
     names = None
 
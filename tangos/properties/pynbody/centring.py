@@ -10,6 +10,7 @@ from .spherical_region import SphericalRegionPropertyCalculation
 
 class CentreAndRadius(PynbodyPropertyCalculation):
     names = "shrink_center", "max_radius"
+    required_arrays = ("pos", "mass")
 
     def calculate(self, halo, existing_properties):
         dm_center, dm_max_radius = self._get_centre_and_max_radius(halo.dm)
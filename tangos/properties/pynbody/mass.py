@@ -3,6 +3,7 @@ from . import PynbodyPropertyCalculation
 
 class Masses(PynbodyPropertyCalculation):
     names = "finder_mass"
+    required_arrays = ("mass",)
 
     def calculate(self, halo, existing_properties):
         return halo['mass'].sum()
@@ -10,6 +11,7 @@ class Masses(PynbodyPropertyCalculation):
 
 class MassBreakdown(PynbodyPropertyCalculation):
     names = "finder_dm_mass", "finder_star_mass", "finder_gas_mass"
+    required_arrays = ("mass",)
 
     def calculate(self, halo, existing_properties):
         return halo.dm['mass'].sum(), halo.star['mass'].sum(), halo.gas['mass'].sum()
@@ -0,0 +1,187 @@
+"""An in-memory index of all the links between objects in a simulation, used by the 'in_memory' multihop engine
+
+The halolink rows originating from a simulation are loaded once into compressed sparse row (CSR) form, i.e. numpy
+arrays sorted by the halo the link comes from, along with the timestep, time and halo number of every object in the
+simulation. Relation finding can then step through the graph without issuing any SQL for each hop.
+
+Graphs are cached per process (see get_link_graph). Each time a graph is requested, the highest link id is checked,
+so that any links committed since the graph was loaded (by any process) cause it to be rebuilt. Deleting links or
+objects within this process also discards the cache."""
+
+import weakref
+
+import numpy as np
+import sqlalchemy.orm
+from sqlalchemy import event, func, select
+
+from .. import core
+
+_graphs = weakref.WeakKeyDictionary() # engine -> {simulation_id: (fingerprint, LinkGraph)}
+
+
+class _ArrayNamespace:
+    """Exposes numpy arrays as attributes, standing in for ORM aliases when link filters are evaluated in memory"""
+    def __init__(self, **arrays):
+        self.__dict__.update(arrays)
+
+
+class LinkGraph:
+    """All the links from objects in one simulation, in compressed sparse row form"""
+
+    def __init__(self, session, simulation_id):
+        self.simulation_id = simulation_id
+        self._load_objects(session)
+        self._load_links(session)
+
+    def _load_objects(self, session):
+        halo = core.halo.SimulationObjectBase
+        timestep = core.timestep.TimeStep
+        rows = session.connection().execute(
+            select(halo.id, halo.halo_number, halo.timestep_id, timestep.time_gyr).
+            join(timestep, halo.timestep_id == timestep.id).
+            where(timestep.simulation_id == self.simulation_id).
+            order_by(halo.id)).all()
+
+        halo_id, halo_number, timestep_id, time_gyr = zip(*rows) if len(rows)>0 else ((),)*4
+        self.halo_id = np.array(halo_id, dtype=np.int64)
+        self.halo_number = np.array(halo_number, dtype=np.int64)
+        self.timestep_id = np.array(timestep_id, dtype=np.int64)
+        self.time_gyr = np.array([np.nan if t is None else t for t in time_gyr], dtype=np.float64)
+        self.n_objects = len(self.halo_id)
+
+    def _load_links(self, session):
+        link = core.halo_data.HaloLink
+        halo = core.halo.SimulationObjectBase
+        timestep = core.timestep.TimeStep
+        rows = session.connection().execute(
+            select(link.id, link.halo_from_id, link.halo_to_id, link.weight, link.relation_id).
+            join(halo, link.halo_from_id == halo.id).
+            join(timestep, halo.timestep_id == timestep.id).
+            where(timestep.simulation_id == self.simulation_id)).all()
+
+        link_id, halo_from_id, halo_to_id, weight, relation_id = zip(*rows) if len(rows)>0 else ((),)*5
+        link_id = np.array(link_id, dtype=np.int64)
+        from_index = self.index_of(np.array(halo_from_id, dtype=np.int64))
+        to_index = self.index_of(np.array(halo_to_id, dtype=np.int64))
+        weight = np.array([np.nan if w is None else w for w in weight], dtype=np.float64)
+        relation_id = np.array([-1 if r is None else r for r in relation_id], dtype=np.int64)
+
+        # Only links between objects in this simulation are retained; the engine is only used for searches
+        # restricted to one simulation
+        keep = to_index >= 0
+        order = np.lexsort((link_id[keep], from_index[keep]))
+
+        self.link_id = link_id[keep][order]
+        self.link_from = from_index[keep][order]
+        self.link_to = to_index[keep][order]
+        self.link_weight = weight[keep][order]
+        self.link_relation_id = relation_id[keep][order]
+        self.indptr = np.searchsorted(self.link_from, np.arange(self.n_objects + 1))
+
+        # sorted (from, to) keys allow the reverse of any link to be found by binary search
+        self._pair_key = self.link_from * self.n_objects + self.link_to
+        self._pair_order = np.argsort(self._pair_key, kind='stable')
+        self._sorted_pair_key = self._pair_key[self._pair_order]
+
+    def index_of(self, halo_ids):
+        """Return the position of each of the given object ids in this graph, or -1 if not in the simulation"""
+        halo_ids = np.asarray(halo_ids, dtype=np.int64)
+        if self.n_objects == 0:
+            return np.full(len(halo_ids), -1, dtype=np.int64)
+        index = np.minimum(np.searchsorted(self.halo_id, halo_ids), self.n_objects - 1)
+        return np.where(self.halo_id[index] == halo_ids, index, -1)
+
+    def links_from(self, halo_indices):
+        """Return the positions of all links leaving the given objects, and which of the objects each one leaves"""
+        halo_indices = np.asarray(halo_indices, dtype=np.int64)
+        valid = halo_indices >= 0
+        starts = np.where(valid, self.indptr[np.maximum(halo_indices, 0)], 0)
+        ends = np.where(valid, self.indptr[np.maximum(halo_indices, 0) + 1], 0)
+        return _expand_ranges(starts, ends)
+
+    def reverse_links(self, from_indices, to_indices):
+        """Return the positions of all links running from to_indices back to from_indices, and which pair each is for"""
+        keys = np.asarray(to_indices, dtype=np.int64) * self.n_objects + np.asarray(from_indices, dtype=np.int64)
+        starts = np.searchsorted(self._sorted_pair_key, keys, side='left')
+        ends = np.searchsorted(self._sorted_pair_key, keys, side='right')
+        positions, pair = _expand_ranges(starts, ends)
+        return self._pair_order[positions], pair
+
+    def timestep_namespace(self, halo_indices):
+        return _ArrayNamespace(id=self.timestep_id[halo_indices], time_gyr=self.time_gyr[halo_indices],
+                               simulation_id=np.full(len(halo_indices), self.simulation_id))
+
+    def halo_namespace(self, halo_indices):
+        return _ArrayNamespace(id=self.halo_id[halo_indices], halo_number=self.halo_number[halo_indices],
+                               timestep_id=self.timestep_id[halo_indices])
+
+    def in_target(self, halo_indices, target):
+        """Return a boolean array indicating which of the given objects are within target (see HopStrategy)"""
+        halo_indices = np.asarray(halo_indices, dtype=np.int64)
+        if target is None:
+            return np.ones(len(halo_indices), dtype=bool)
+        elif isinstance(target, core.timestep.TimeStep):
+            return self.timestep_id[halo_indices] == target.id
+        elif isinstance(target, core.simulation.Simulation):
+            return np.full(len(halo_indices), target.id == self.simulation_id)
+        else:
+            raise ValueError("Unsupported target type %r" % type(target))
+
+
+def _expand_ranges(starts, ends):
+    """Given arrays of range starts and ends, return the concatenation of all the ranges, and for each element the
+    index of the range it came from"""
+    lengths = ends - starts
+    owner = np.repeat(np.arange(len(starts)), lengths)
+    offsets = np.arange(len(owner)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return starts[owner] + offsets, owner
+
+
+def _fingerprint(session):
+    # NB counting the links as well would catch deletions by other processes, but is far slower than finding the max id
+    return session.execute(select(func.max(core.halo_data.HaloLink.id))).scalar()
+
+
+def get_link_graph(session, simulation_id):
+    """Return the LinkGraph for the specified simulation, loading it only if it is not already cached and up to date"""
+    graphs_for_engine = _graphs.setdefault(session.get_bind(), {})
+    fingerprint = _fingerprint(session)
+    cached = graphs_for_engine.get(simulation_id, None)
+    if cached is not None and cached[0] == fingerprint:
+        return cached[1]
+
+    graph = LinkGraph(session, simulation_id)
+    graphs_for_engine[simulation_id] = (fingerprint, graph)
+    return graph
+
+
+def clear_cache():
+    """Discard all cached link graphs"""
+    _graphs.clear()
+
+
+@event.listens_for(sqlalchemy.orm.Session, 'do_orm_execute')
+def _clear_cache_on_bulk_delete(orm_execute_state):
+    if orm_execute_state.is_delete and getattr(orm_execute_state.statement.table, 'name', None) in \
+            (core.HaloLink.__tablename__, core.SimulationObjectBase.__tablename__, core.TimeStep.__tablename__):
+        clear_cache()
+
+@event.listens_for(core.halo_data.HaloLink, 'after_delete')
+def _clear_cache_on_link_delete(mapper, connection, target):
+    clear_cache()
+
+
+class Hops:
+    """A set of hops through a LinkGraph, equivalent to rows in the temp tables used by MultiHopStrategy"""
+
+    def __init__(self, halo_from, halo_to, weight, source_id):
+        self.halo_from = np.asarray(halo_from, dtype=np.int64)
+        self.halo_to = np.asarray(halo_to, dtype=np.int64)
+        self.weight = np.asarray(weight, dtype=np.float64)
+        self.source_id = np.asarray(source_id, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.weight)
+
+    def take(self, index):
+        return Hops(self.halo_from[index], self.halo_to[index], self.weight[index], self.source_id[index])
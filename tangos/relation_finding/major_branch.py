@@ -0,0 +1,189 @@
+"""Building and reading the precomputed major progenitor and major descendant branches (see core.major_branch)
+
+The branches are built by taking one step of MultiHopMajorProgenitorsStrategy (or MultiHopMajorDescendantsStrategy)
+from every object in a simulation simultaneously, in memory, which gives the unique next object along the branch
+from each one. The resulting tree is then divided into branches that do not overlap, so that every object is stored
+only once: where several objects share the same next object, the branch continues through the one with the most
+objects behind it and the others end in a junction. Following a chain from any object therefore crosses at most
+logarithmically many junctions.
+
+Once built, the strategies read their results from the table with a few indexed queries per branch crossed, provided
+that no links from the simulation's objects have been added or removed since the branches were built and the
+strategy parameters are the defaults."""
+
+import numpy as np
+import sqlalchemy
+from sqlalchemy import delete, func, select
+
+from .. import core
+from ..log import logger
+from .link_graph import Hops, get_link_graph
+
+PROGENITORS = -1
+DESCENDANTS = +1
+
+_INSERT_BATCH_SIZE = 10000
+
+
+def _strategy_class(direction):
+    from .multi_hop_variants import MultiHopMajorDescendantsStrategy, MultiHopMajorProgenitorsStrategy
+    return MultiHopMajorProgenitorsStrategy if direction == PROGENITORS else MultiHopMajorDescendantsStrategy
+
+def _simulation_halo_ids(simulation_id):
+    return select(core.SimulationObjectBase.id).join(core.TimeStep).\
+        where(core.TimeStep.simulation_id == simulation_id)
+
+def _simulation_link_state(session, simulation_id):
+    """Return the highest id and the number of HaloLinks from objects in the given simulation, which together change
+    whenever such links are added or removed"""
+    link = core.HaloLink
+    return tuple(session.execute(select(func.max(link.id), func.count(link.id)).
+                                 where(link.halo_from_id.in_(_simulation_halo_ids(simulation_id)))).one())
+
+def _chain_sizes(next_object):
+    """Return, for each object, the number of objects whose chain of next objects passes through it (including
+    itself)"""
+    size = np.ones(len(next_object), dtype=np.int64)
+    num_waiting = np.bincount(next_object[next_object >= 0], minlength=len(next_object))
+    ready = np.where(num_waiting == 0)[0]
+    while len(ready) > 0:
+        ready = ready[next_object[ready] >= 0]
+        targets = next_object[ready]
+        np.add.at(size, targets, size[ready])
+        np.subtract.at(num_waiting, targets, 1)
+        targets = np.unique(targets)
+        ready = targets[num_waiting[targets] == 0]
+    return size
+
+def _continues_branch(next_object):
+    """Return a boolean array that is True for each object lying on the same branch as its next object"""
+    continues = np.zeros(len(next_object), dtype=bool)
+    has_next = np.where(next_object >= 0)[0]
+    if len(has_next) == 0:
+        return continues
+    has_next = has_next[np.lexsort((_chain_sizes(next_object)[has_next], next_object[has_next]))]
+    largest_for_next = np.append(next_object[has_next][1:] != next_object[has_next][:-1], True)
+    continues[has_next[largest_for_next]] = True
+    return continues
+
+def _insert_in_batches(session, rows):
+    """Insert rows given as columns of equal length, converting only one batch at a time to dictionaries"""
+    names = list(rows.keys())
+    for start in range(0, len(rows[names[0]]), _INSERT_BATCH_SIZE):
+        batch = [column[start:start + _INSERT_BATCH_SIZE] for column in rows.values()]
+        session.execute(core.MajorBranch.__table__.insert(), [dict(zip(names, values)) for values in zip(*batch)])
+
+def build_major_branches(session, simulation, direction):
+    """Build (or rebuild) the major branches for the given simulation and direction, returning the number of rows"""
+    max_link_id, num_links = _simulation_link_state(session, simulation.id)
+    graph = get_link_graph(session, simulation.id)
+
+    clear_major_branches(session, simulation, direction)
+    if graph.n_objects == 0:
+        return 0
+
+    any_object = session.get(core.SimulationObjectBase, int(graph.halo_id[0]))
+    strategy = _strategy_class(direction)(any_object)
+
+    all_objects = np.arange(graph.n_objects)
+    first_steps = Hops(all_objects, all_objects, np.ones(graph.n_objects), all_objects)
+    first_steps = strategy._generate_next_level_in_memory(graph, first_steps)
+    first_steps = strategy._filter_hops_in_memory(graph, first_steps)
+
+    next_object = np.full(graph.n_objects, -1, dtype=np.int64)
+    next_object[first_steps.source_id] = first_steps.halo_to
+    next_weight = np.ones(graph.n_objects)
+    next_weight[first_steps.source_id] = first_steps.weight
+    continues = _continues_branch(next_object)
+
+    is_next_for_another = np.zeros(graph.n_objects, dtype=bool)
+    is_next_for_another[next_object[next_object >= 0]] = True
+    current = np.where(~is_next_for_another)[0]
+    branch, weight = current, np.ones(len(current))
+
+    levels = []
+    for depth in range(graph.n_objects):
+        if len(current) == 0:
+            break
+        levels.append((current, branch, np.full(len(current), depth), weight))
+        continuing = continues[current]
+        branch, previous = branch[continuing], current[continuing]
+        weight = weight[continuing] * next_weight[previous]
+        current = next_object[previous]
+
+    objects, branches, depths, weights = (np.concatenate(columns) for columns in zip(*levels))
+    has_next = next_object[objects] >= 0
+    _insert_in_batches(session, {
+        'halo_id': graph.halo_id[objects].tolist(),
+        'next_halo_id': [h if n else None for h, n in zip(graph.halo_id[next_object[objects]].tolist(),
+                                                          has_next.tolist())],
+        'branch_id': graph.halo_id[branches].tolist(),
+        'depth': depths.tolist(),
+        'direction': [direction] * len(objects),
+        'weight': weights.tolist(),
+        'next_weight': [w if n else None for w, n in zip(next_weight[objects].tolist(), has_next.tolist())]})
+    session.add(core.MajorBranchStatus(simulation_id=simulation.id, direction=direction, max_link_id=max_link_id,
+                                       num_links=num_links))
+    session.commit()
+    logger.info("Built %d major branch rows for %s (direction %+d)", len(objects), simulation.basename, direction)
+    return len(objects)
+
+def clear_major_branches(session, simulation, direction=None):
+    """Remove the major branches for the given simulation (and direction, or both if None)"""
+    branch_delete = delete(core.MajorBranch).where(core.MajorBranch.halo_id.in_(_simulation_halo_ids(simulation.id)))
+    status_delete = delete(core.MajorBranchStatus).where(core.MajorBranchStatus.simulation_id == simulation.id)
+    if direction is not None:
+        branch_delete = branch_delete.where(core.MajorBranch.direction == direction)
+        status_delete = status_delete.where(core.MajorBranchStatus.direction == direction)
+    session.execute(branch_delete, execution_options={'synchronize_session': False})
+    session.execute(status_delete, execution_options={'synchronize_session': False})
+    session.commit()
+
+def major_branches_are_current(session, simulation_id, direction):
+    """Return True if the major branches for the given simulation and direction have been built since links from
+    its objects were last added or removed"""
+    status = session.execute(select(core.MajorBranchStatus.max_link_id, core.MajorBranchStatus.num_links).
+                             where(core.MajorBranchStatus.simulation_id == simulation_id,
+                                   core.MajorBranchStatus.direction == direction)).all()
+    return len(status) == 1 and tuple(status[0]) == _simulation_link_state(session, simulation_id)
+
+def find_position_on_branch(session, halo_id, direction):
+    """Return (branch_id, depth) for the branch on which the given object lies, or None if it is not present"""
+    return session.execute(select(core.MajorBranch.branch_id, core.MajorBranch.depth).
+                           where(core.MajorBranch.halo_id == halo_id,
+                                 core.MajorBranch.direction == direction)).first()
+
+def _ratio(numerator, denominator):
+    # follows SQL, in which missing weights (and division by zero) propagate as NULL
+    if numerator is None or denominator is None or denominator == 0:
+        return None
+    return numerator / denominator
+
+def select_along_branch(session, branch_id, depth, direction, nhops_max):
+    """Yield selects of the hops along the branch beyond the given position, in the form of MultiHopStrategy's temp
+    table (halo_from_id, halo_to_id, weight, nhops)
+
+    One select is generated for each branch that is crossed, following junctions until nhops_max hops have been
+    made or the chain ends."""
+    branch = core.MajorBranch
+    nhops, weight = 0, 1.0
+    while True:
+        on_branch = (branch.branch_id == branch_id, branch.direction == direction)
+        weight_at_start = session.execute(select(branch.weight).where(*on_branch, branch.depth == depth)).scalar_one()
+        last_depth, junction_id, weight_at_junction = session.execute(
+            select(branch.depth, branch.next_halo_id, branch.weight * branch.next_weight).where(*on_branch).
+            order_by(branch.depth.desc()).limit(1)).one()
+
+        num_hops_available = last_depth - depth + (0 if junction_id is None else 1)
+        num_hops = min(num_hops_available, nhops_max - nhops)
+        if num_hops > 0:
+            weight_factor = sqlalchemy.literal(_ratio(weight, weight_at_start), branch.weight.type)
+            yield select(branch.halo_id, branch.next_halo_id, branch.weight * branch.next_weight * weight_factor,
+                         branch.depth - depth + nhops + 1).\
+                where(*on_branch, branch.depth >= depth, branch.depth < depth + num_hops)
+
+        nhops += num_hops
+        if junction_id is None or nhops >= nhops_max:
+            return
+        weight = _ratio(None if None in (weight, weight_at_junction) else weight * weight_at_junction, weight_at_start)
+        branch_id, depth = find_position_on_branch(session, junction_id, direction)
@@ -3,6 +3,7 @@ import random
 import string
 import sys
 
+import numpy as np
 import sqlalchemy
 import sqlalchemy.exc
 import sqlalchemy.orm
@@ -15,6 +16,8 @@ from .. import config, core, temporary_halolist
 from ..config import DOUBLE_PRECISION
 from ..log import logger
 from ..util.timing_monitor import TimingMonitor
+from . import major_branch
+from .link_graph import Hops, get_link_graph
 from .one_hop import HopStrategy
 
 
@@ -92,6 +95,12 @@ class MultiHopStrategy(HopStrategy):
         self._debug_output = False # set to True to see information about discovered links as hops progress
 
         self.timing_monitor = TimingMonitor()
+
+    _recursive_cte_supported = True # set to False in subclasses that customise the hop-by-hop process
+    _in_memory_supported = True # set to False in subclasses that customise the hop-by-hop process in SQL only
+    _major_branch_direction = None # set in subclasses whose results can be read from precomputed major branches
+    _major_branch_default_parameters = None # the _major_branch_parameters() with which those branches were built
+
     def temp_table(self):
         """Execute the strategy and return results as a temp_table (see temporary_halolist module)"""
         if self._all is None:
@@ -144,17 +153,28 @@ class MultiHopStrategy(HopStrategy):
                 join(self.timestep_old, self.halo_old.timestep). \
                 join(self.timestep_new, self.halo_new.timestep)
 
-        filter = self._generate_link_filter(self.timestep_old, self.timestep_new, table)
+        filter = self._generate_link_filter(self.timestep_old, self.timestep_new, table.c.weight)
         query = query.filter(filter)
 
+        ranking = self._generate_per_hop_ranking(self.timestep_new, self.halo_new, table.c.weight)
+        if ranking is not None:
+            query = query.order_by(*[column.desc() if descending else column for column, descending in ranking]).\
+                limit(1)
+
         return query
 
     def _needs_join_for_link_filter(self):
         return self.directed is not None
 
-    def _generate_link_filter(self, timestep_old, timestep_new, table):
+    def _generate_link_filter(self, timestep_old, timestep_new, weight):
+        """Return the condition for a hop to be accepted
 
-        recursion_filter = table.c.weight > self._min_aggregated_weight
+        :param timestep_old: the timestep from which the hop is being made
+        :param timestep_new: the timestep to which the hop is being made
+        :param weight: the aggregated weight of the route, including the hop
+        """
+
+        recursion_filter = weight > self._min_aggregated_weight
 
         if self.directed is not None:
             directed = self.directed.lower()
@@ -175,6 +195,18 @@ class MultiHopStrategy(HopStrategy):
 
         return recursion_filter
 
+    def _generate_per_hop_ranking(self, timestep_new, halo_new, weight):
+        """Return a ranking for the accepted hops at each step, or None.
+
+        If a ranking is returned, only the top-ranked hop is retained at each step. Otherwise all accepted hops are
+        retained. The ranking is a list of (column, descending) tuples, in order of precedence.
+
+        :param timestep_new: the timestep to which the hop is being made
+        :param halo_new: the halo to which the hop is being made
+        :param weight: the aggregated weight of the route, including the hop
+        """
+        return None
+
     def _delete_temp_table(self):
         self._table_index.drop(bind=self._connection)
         self._table.drop(checkfirst=True, bind=self._connection)
@@ -258,6 +290,273 @@ class MultiHopStrategy(HopStrategy):
         self._connection.execute(insert_statement)
 
     def _make_hops(self):
+        if self._make_hops_from_major_branches():
+            return
+        elif self._use_in_memory_graph():
+            self._make_hops_in_memory()
+        elif self._use_recursive_cte():
+            self._make_hops_with_recursive_cte()
+        else:
+            self._make_hops_with_temp_tables()
+
+    def _use_recursive_cte(self):
+        engine = config.multihop_engine
+        if engine not in ('auto', 'recursive_cte', 'temp_table', 'in_memory'):
+            raise ValueError("Unknown multihop_engine %r" % engine)
+
+        if engine == 'temp_table' or not self._recursive_cte_supported:
+            return False
+
+        if self.directed is not None and self.directed.lower() == 'across':
+            # the 'across' filter depends on all timesteps reached so far, which can't be expressed in a recursive CTE
+            return False
+
+        if self._keeps_one_hop_per_step() and self._min_aggregated_weight > 0:
+            # the recursive CTE selects the top-ranked hop from each halo independently of the route taken to
+            # reach it, which is only correct if there is no threshold on the aggregated weight
+            return False
+
+        if self._combine_routes and not self._keeps_one_hop_per_step():
+            # combining routes has to be emulated by enumerating all routes then keeping the strongest, which is
+            # only safe for directed searches (and is only done if explicitly requested, see config.py)
+            if engine != 'recursive_cte' or self.directed is None:
+                return False
+
+        return self._database_supports_recursive_cte()
+
+    def _make_hops_from_major_branches(self):
+        """Fill the temp table from the precomputed major branches, if possible, and return True if successful"""
+        if self._major_branch_direction is None or config.multihop_engine == 'temp_table':
+            return False
+
+        if self._major_branch_parameters() != self._major_branch_default_parameters:
+            # the precomputed branches are only valid for the default parameters
+            return False
+
+        with self.timing_monitor(self):
+            self.timing_monitor.mark('major-branch-check')
+            if not major_branch.major_branches_are_current(self.session, self.halo_from.timestep.simulation_id,
+                                                           self._major_branch_direction):
+                return False
+
+            position = major_branch.find_position_on_branch(self.session, self.halo_from.id,
+                                                            self._major_branch_direction)
+            if position is None:
+                return False
+
+            self.timing_monitor.mark('major-branch-insert')
+            for branch_query in major_branch.select_along_branch(self.session, *position,
+                                                                 self._major_branch_direction, self.nhops_max):
+                self._connection.execute(
+                    self._table.insert().from_select(['halo_from_id', 'halo_to_id', 'weight', 'nhops', 'source_id'],
+                                                     branch_query.add_columns(sqlalchemy.literal(0))))
+        return True
+
+    def _major_branch_parameters(self):
+        return (self.directed, self._min_aggregated_weight, self._min_onehop_weight, self._min_onehop_reverse_weight,
+                self._one_simulation)
+
+    def _use_in_memory_graph(self):
+        if config.multihop_engine != 'in_memory' or not self._in_memory_supported:
+            return False
+        # the graph only holds links within one simulation, so can only be used for searches restricted to one
+        return self._one_simulation and self.directed is not None \
+            and self.directed.lower() in ('backwards', 'forwards')
+
+    def _keeps_one_hop_per_step(self):
+        return self._generate_per_hop_ranking(self.timestep_new, self.halo_new, self._table.c.weight) is not None
+
+    def _database_supports_recursive_cte(self):
+        dialect = self._connection.dialect
+        if dialect.name == 'sqlite':
+            return dialect.dbapi.sqlite_version_info >= (3, 8, 3)
+        elif dialect.name == 'mysql':
+            if getattr(dialect, 'is_mariadb', False):
+                return dialect.server_version_info >= (10, 2)
+            else:
+                return dialect.server_version_info >= (8, 0)
+        else:
+            return dialect.name == 'postgresql'
+
+    def _make_hops_with_recursive_cte(self):
+        with self.timing_monitor(self):
+            self.timing_monitor.mark('recursive-cte')
+            recursion = self._generate_recursive_cte()
+            results = sqlalchemy.select(recursion.c.halo_from_id, recursion.c.halo_to_id, recursion.c.weight,
+                                        recursion.c.nhops, recursion.c.source_id).where(recursion.c.nhops > 0)
+            self._connection.execute(
+                self._table.insert().from_select(['halo_from_id', 'halo_to_id', 'weight', 'nhops', 'source_id'],
+                                                 results))
+
+            if self._combine_routes and not self._keeps_one_hop_per_step():
+                self.timing_monitor.mark('combine-routes')
+                from ..util.sql_argmax import delete_non_maximal_rows
+                delete_non_maximal_rows(self._connection, self._table, self._table.c.weight,
+                                        [self._table.c.halo_to_id, self._table.c.source_id, self._table.c.nhops])
+
+    def _generate_recursive_cte(self):
+        """Generate a recursive CTE that follows all hops from the seeds in the temp table, in one SQL statement
+
+        The rows returned by the CTE have the same meaning as the rows inserted into the temp table by the step-by-step
+        temp table implementation (see _generate_next_level_prelim_links and _filter_prelim_links_into_final)"""
+        seeds = sqlalchemy.select(self._table.c.halo_from_id, self._table.c.halo_to_id, self._table.c.weight,
+                                  self._table.c.nhops, self._table.c.source_id)
+        recursion = seeds.cte("multihop_recursion", recursive=True)
+
+        link = core.halo_data.HaloLink.__table__.alias("hop_link")
+        hops = sqlalchemy.select(link.c.halo_from_id, link.c.halo_to_id, recursion.c.weight * link.c.weight,
+                                 recursion.c.nhops + 1, recursion.c.source_id).\
+            select_from(recursion).join(link, link.c.halo_from_id == recursion.c.halo_to_id).\
+            where(recursion.c.nhops < self.nhops_max)
+        hops, ranking = self._supplement_recursive_cte_hop(hops, link, recursion.c.weight)
+
+        if ranking is not None:
+            # Only the top-ranked hop from each halo is to be taken. Within a recursive CTE, neither aggregates nor
+            # subqueries referring to the recursive table are allowed, so express this as there being no better-ranked
+            # hop from the same halo. The aggregated weight is then irrelevant, since the weight of the route leading
+            # to the halo is the same for all hops from it.
+            rival_link = core.halo_data.HaloLink.__table__.alias("rival_link")
+            rivals, rival_ranking = self._supplement_recursive_cte_hop(
+                sqlalchemy.select(rival_link.c.id).select_from(rival_link), rival_link)
+            ranking = ranking + [(link.c.id, False)]
+            rival_ranking = rival_ranking + [(rival_link.c.id, False)]
+            rivals = rivals.where(rival_link.c.halo_from_id == link.c.halo_from_id,
+                                  self._generate_ranked_higher_condition(rival_ranking, ranking))
+            hops = hops.where(~rivals.exists())
+
+        return recursion.union_all(hops)
+
+    @staticmethod
+    def _generate_ranked_higher_condition(ranking_a, ranking_b):
+        """Return an SQL condition that is true if a is ranked higher than b, given rankings of the form returned by
+        _generate_per_hop_ranking"""
+        (column_a, descending), *rest_a = ranking_a
+        (column_b, _), *rest_b = ranking_b
+        if descending:
+            higher = column_a > column_b
+        else:
+            higher = column_a < column_b
+        if len(rest_a)==0:
+            return higher
+        else:
+            return higher | ((column_a == column_b) &
+                             MultiHopStrategy._generate_ranked_higher_condition(rest_a, rest_b))
+
+    def _supplement_recursive_cte_hop(self, query, link, route_weight=None):
+        """Add the joins and filters to a select on link, such that only hops that would be accepted are returned
+
+        :param query: the select to be supplemented
+        :param link: the (aliased) halolink table being selected from
+        :param route_weight: the aggregated weight of the route leading to the hop, or None to consider the hop alone
+
+        Returns the modified select, and the ranking of hops (or None), see _generate_per_hop_ranking. The ranking
+        only refers to link and the tables joined to it, so that it can be used in correlated subqueries."""
+        query = query.where(link.c.weight > self._min_onehop_weight)
+        if route_weight is None:
+            weight = link.c.weight
+        else:
+            weight = route_weight * link.c.weight
+
+        halo_old = sqlalchemy.orm.aliased(core.halo.SimulationObjectBase)
+        halo_new = sqlalchemy.orm.aliased(core.halo.SimulationObjectBase)
+        timestep_old = sqlalchemy.orm.aliased(core.timestep.TimeStep)
+        timestep_new = sqlalchemy.orm.aliased(core.timestep.TimeStep)
+        if self._needs_join_for_link_filter():
+            query = query.join(halo_old, link.c.halo_from_id == halo_old.id). \
+                join(halo_new, link.c.halo_to_id == halo_new.id). \
+                join(timestep_old, halo_old.timestep_id == timestep_old.id). \
+                join(timestep_new, halo_new.timestep_id == timestep_new.id)
+
+        if self._min_onehop_reverse_weight is not None:
+            reverse_link = core.halo_data.HaloLink.__table__.alias()
+            query = query.join(reverse_link, and_(reverse_link.c.halo_from_id == link.c.halo_to_id,
+                                                  reverse_link.c.halo_to_id == link.c.halo_from_id)).\
+                where(reverse_link.c.weight > self._min_onehop_reverse_weight)
+
+        query = query.where(self._generate_link_filter(timestep_old, timestep_new, weight))
+
+        return query, self._generate_per_hop_ranking(timestep_new, halo_new, link.c.weight)
+
+    def _make_hops_in_memory(self):
+        with self.timing_monitor(self):
+            self.timing_monitor.mark('load-graph')
+            graph = get_link_graph(self.session, self.halo_from.timestep.simulation_id)
+
+            self.timing_monitor.mark('seed')
+            seeds = self._connection.execute(
+                sqlalchemy.select(self._table.c.halo_to_id, self._table.c.weight, self._table.c.source_id).
+                where(self._table.c.nhops == 0).order_by(self._table.c.id)).all()
+            seed_halo_id, seed_weight, seed_source_id = zip(*seeds)
+            seed_halo_index = graph.index_of(seed_halo_id)
+            hops = Hops(seed_halo_index, seed_halo_index, seed_weight, seed_source_id)
+
+        self._in_memory_hops = []
+        for i in range(0, self.nhops_max):
+            with self.timing_monitor(self):
+                self._nhops_taken = i
+                hops = self._generate_next_level_in_memory(graph, hops)
+                if len(hops) != 0:
+                    hops = self._filter_hops_in_memory(graph, hops)
+                self._in_memory_hops.append(hops)
+
+            if self._hopping_finished(len(hops)):
+                break
+
+        with self.timing_monitor(self):
+            self.timing_monitor.mark('final-insert')
+            rows = [{'halo_from_id': halo_from_id, 'halo_to_id': halo_to_id, 'weight': weight, 'nhops': nhops,
+                     'source_id': source_id}
+                    for nhops, level in enumerate(self._in_memory_hops, 1)
+                    for halo_from_id, halo_to_id, weight, source_id in
+                    zip(graph.halo_id[level.halo_from].tolist(), graph.halo_id[level.halo_to].tolist(),
+                        level.weight.tolist(), level.source_id.tolist())]
+            if len(rows) > 0:
+                self._connection.execute(self._table.insert(), rows)
+
+    def _generate_next_level_in_memory(self, graph, hops):
+        """In-memory equivalent of _generate_next_level_prelim_links, taking all hops onwards from the given ones"""
+        links, previous = graph.links_from(hops.halo_to)
+        keep = graph.link_weight[links] > self._min_onehop_weight
+        links, previous = links[keep], previous[keep]
+
+        next_hops = Hops(graph.link_from[links], graph.link_to[links],
+                         hops.weight[previous] * graph.link_weight[links], hops.source_id[previous])
+
+        if self._combine_routes and len(next_hops) > 0:
+            # keep only the strongest route to each halo from each source (including any ties, as for
+            # delete_non_maximal_rows)
+            _, group = np.unique(next_hops.source_id * graph.n_objects + next_hops.halo_to, return_inverse=True)
+            max_weight = np.full(group.max() + 1, -np.inf)
+            np.maximum.at(max_weight, group, next_hops.weight)
+            next_hops = next_hops.take(next_hops.weight >= max_weight[group])
+
+        return next_hops
+
+    def _filter_hops_in_memory(self, graph, hops):
+        """In-memory equivalent of _filter_prelim_links_into_final, returning the hops that are accepted"""
+        if self._min_onehop_reverse_weight is not None:
+            # as for the SQL join, a hop is repeated if there is more than one qualifying reverse link
+            reverse, hop_index = graph.reverse_links(hops.halo_from, hops.halo_to)
+            hops = hops.take(hop_index[graph.link_weight[reverse] > self._min_onehop_reverse_weight])
+
+        accept = self._generate_link_filter(graph.timestep_namespace(hops.halo_from),
+                                            graph.timestep_namespace(hops.halo_to), hops.weight)
+        hops = hops.take(np.asarray(accept, dtype=bool))
+
+        ranking = self._generate_per_hop_ranking(graph.timestep_namespace(hops.halo_to),
+                                                 graph.halo_namespace(hops.halo_to), hops.weight)
+        if ranking is not None and len(hops) > 0:
+            # keep the top-ranked hop for each source (for strategies with a single source, this is the same as the
+            # SQL implementation's limit(1))
+            keys = [-column if descending else column for column, descending in reversed(ranking)]
+            order = np.lexsort(keys + [hops.source_id])
+            sorted_source_id = hops.source_id[order]
+            first_in_source = np.append(True, sorted_source_id[1:] != sorted_source_id[:-1])
+            hops = hops.take(order[first_in_source])
+
+        return hops
+
+    def _make_hops_with_temp_tables(self):
         for i in range(0, self.nhops_max):
             with self.timing_monitor(self):
                 self._nhops_taken = i
@@ -1,4 +1,5 @@
 from ..config import num_multihops_max_default as NHOPS_MAX_DEFAULT
+from .major_branch import DESCENDANTS, PROGENITORS
 from .multi_hop import MultiHopStrategy
 
 
@@ -20,25 +21,28 @@ class MultiHopAllProgenitorsStrategy(MultiHopStrategy):
                                                              min_onehop_reverse_weight=0.1,
                                                              one_simulation=one_simulation)
 
-    def _supplement_halolink_query_with_filter(self, query, table):
-        query = super()._supplement_halolink_query_with_filter(query, table)
+    def _generate_link_filter(self, timestep_old, timestep_new, weight):
+        recursion_filter = super()._generate_link_filter(timestep_old, timestep_new, weight)
         if self._target is None:
-            return query
+            return recursion_filter
         else:
-            return query.filter(self.timestep_new.simulation_id == self.sim_id)
+            return recursion_filter & (timestep_new.simulation_id == self.sim_id)
 
 
 class MultiHopMajorProgenitorsStrategy(MultiHopAllProgenitorsStrategy):
     """Finds the major progenitor for a halo at every step"""
 
-    def _supplement_halolink_query_with_filter(self, query, table):
-        query = super()._supplement_halolink_query_with_filter(query, table)
-        return query.order_by(self.timestep_new.time_gyr.desc(), table.c.weight.desc(), self.halo_new.halo_number). \
-            limit(1)
+    _major_branch_direction = PROGENITORS
+    _major_branch_default_parameters = ('backwards', 0.0, 0.0, 0.1, True)
+
+    def _generate_per_hop_ranking(self, timestep_new, halo_new, weight):
+        return [(timestep_new.time_gyr, True), (weight, True), (halo_new.halo_number, False)]
 
 class MultiHopMostRecentMergerStrategy(MultiHopAllProgenitorsStrategy):
     """Finds the halos involved in the most recent merger into the major progenitor branch of the halo"""
 
+    _recursive_cte_supported = False
+
     def _hopping_finished(self, filtered_count):
         self._last_filtered_count = filtered_count
         return filtered_count != 1
@@ -57,6 +61,9 @@ class MultiHopMostRecentMergerStrategy(MultiHopAllProgenitorsStrategy):
 class MultiHopMajorDescendantsStrategy(MultiHopStrategy):
     """Suggests the major descendant for a halo at every step"""
 
+    _major_branch_direction = DESCENDANTS
+    _major_branch_default_parameters = ('forwards', 0.0, 0.0, None, True)
+
     def __init__(self, halo_from, nhops_max=NHOPS_MAX_DEFAULT, include_startpoint=False, **kwargs):
         self.sim_id = halo_from.timestep.simulation_id
         super().__init__(halo_from, nhops_max,
@@ -65,8 +72,9 @@ class MultiHopMajorDescendantsStrategy(MultiHopStrategy):
                                                                target=halo_from.timestep.simulation,
                                                                **kwargs)
 
-    def _supplement_halolink_query_with_filter(self, query, table):
-        query = super()._supplement_halolink_query_with_filter(query, table)
-        return query.filter(self.timestep_new.simulation_id == self.sim_id). \
-            order_by(self.timestep_new.time_gyr, table.c.weight.desc(), self.halo_new.halo_number). \
-            limit(1)
+    def _generate_link_filter(self, timestep_old, timestep_new, weight):
+        recursion_filter = super()._generate_link_filter(timestep_old, timestep_new, weight)
+        return recursion_filter & (timestep_new.simulation_id == self.sim_id)
+
+    def _generate_per_hop_ranking(self, timestep_new, halo_new, weight):
+        return [(timestep_new.time_gyr, False), (weight, True), (halo_new.halo_number, False)]
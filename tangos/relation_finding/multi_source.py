@@ -1,3 +1,4 @@
+import numpy as np
 import sqlalchemy
 from sqlalchemy import orm
 
@@ -17,6 +18,8 @@ class MultiSourceMultiHopStrategy(MultiHopStrategy):
     Additionally, as soon as any halo is "matched" in the target, the entire query is stopped. In other words,
     this class assumes that the number of hops is the same to reach all target halos."""
 
+    _recursive_cte_supported = False
+
     def __init__(self, halos_from, target, **kwargs):
         """Construct a strategy for finding Halos via multiple "hops" along HaloLinks from multiple start-points
 
@@ -77,6 +80,12 @@ class MultiSourceMultiHopStrategy(MultiHopStrategy):
         else:
             return super()._generate_next_level_prelim_links(from_nhops)
 
+    def _generate_next_level_in_memory(self, graph, hops):
+        if self._should_halt_in_memory(graph):
+            return hops.take(slice(0, 0))
+        else:
+            return super()._generate_next_level_in_memory(graph, hops)
+
     def _supplement_halolink_query_with_filter(self, query, table=None):
         query = super()._supplement_halolink_query_with_filter(query,table)
 
@@ -85,6 +94,18 @@ class MultiSourceMultiHopStrategy(MultiHopStrategy):
 
         return query
 
+    def _filter_hops_in_memory(self, graph, hops):
+        hops = super()._filter_hops_in_memory(graph, hops)
+
+        if self._keep_only_highest_weights_per_hop and len(hops)>0:
+            # as for sql_argmax.argmax, ties are resolved in favour of the last row
+            order = np.lexsort((np.arange(len(hops)), hops.weight, hops.source_id))
+            sorted_source_id = hops.source_id[order]
+            last_in_source = np.append(sorted_source_id[1:] != sorted_source_id[:-1], True)
+            hops = hops.take(np.sort(order[last_in_source]))
+
+        return hops
+
     def _extract_max_weight_rows_from_query(self, query, table):
         from ..util.sql_argmax import argmax
         return argmax(query, table.c.weight, [table.c.source_id])
@@ -95,6 +116,10 @@ class MultiSourceMultiHopStrategy(MultiHopStrategy):
         # _generate_query. (Our own _generate_query always returns one result per source_id.)
         return super()._generate_query(True).count()>0
 
+    def _should_halt_in_memory(self, graph):
+        # equivalent of _should_halt, used when hops are being made in memory (and so the temp table is not yet filled)
+        return any(graph.in_target(hops.halo_to, self._target).any() for hops in self._in_memory_hops)
+
     def _order_by_clause(self, halo_alias, timestep_alias):
         if self._return_only_highest_weights:
             return [] # _return_only_highest weights is already ordered
@@ -167,16 +192,22 @@ class MultiSourceAllMajorProgenitorsStrategy(MultiSourceMultiHopStrategy):
 
     def __init__(self, halos_from, **kwargs):
         super().__init__(halos_from, None, one_match_per_input=False, directed='backwards',
-                         include_startpoint=True)
+                         include_startpoint=True, **kwargs)
 
     def _should_halt(self):
         return False
 
+    def _should_halt_in_memory(self, graph):
+        return False
+
 class MultiSourceAllMajorDescendantsStrategy(MultiSourceMultiHopStrategy):
 
     def __init__(self, halos_from, **kwargs):
         super().__init__(halos_from, None, one_match_per_input=False, directed='forwards',
-                         include_startpoint=True)
+                         include_startpoint=True, **kwargs)
 
     def _should_halt(self):
         return False
+
+    def _should_halt_in_memory(self, graph):
+        return False
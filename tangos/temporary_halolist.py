@@ -42,6 +42,10 @@ def _insert_into_temp_halolist(table, ids):
             [{'halo_id': id} for id in ids]
         )
 
+def _clear_temp_halolist(table):
+    connection = _get_connection_for(table)
+    connection.execute(table.delete())
+
 def _get_session_for(table):
     global _temp_sessions
     return _temp_sessions[id(table)]
@@ -50,13 +54,17 @@ def _get_connection_for(table):
     global _temp_sessions
     return _temp_sessions[id(table)].connection()
 
-def halo_query(table):
+def halo_query(table, session=None):
     """Query that returns all halos referred to from the temporary table.
 
     Note that due to SQLALchemy's de-dup behaviour, the return is not guaranteed to be in
     1-1 correspondence with the rows in the temporary table. For this, you need to use
-    enumerated_halo_query"""
-    session = _get_session_for(table)
+    enumerated_halo_query.
+
+    If session is specified, the query is made through it rather than the session the table was created in. It
+    must be bound to the same connection."""
+    if session is None:
+        session = _get_session_for(table)
     return session.query(core.halo.SimulationObjectBase).select_from(table).join(core.halo.SimulationObjectBase, table.c.halo_id == core.halo.SimulationObjectBase.id).order_by(table.c.id)
 
 def enumerated_halo_query(table):
@@ -73,6 +81,11 @@ def halolink_query(table):
     session = _get_session_for(table)
     return session.query(core.halo_data.HaloLink).select_from(table).join(core.halo_data.HaloLink, core.halo_data.HaloLink.halo_from_id == table.c.halo_id).order_by(table.c.id)
 
+def replace_halo_ids(table, ids):
+    """Replace the contents of an existing temporary table with the specified ids"""
+    _clear_temp_halolist(table)
+    _insert_into_temp_halolist(table, ids)
+
 @contextlib.contextmanager
 def temporary_halolist_table(session, ids=None, callback=None):
 
@@ -212,6 +212,10 @@ def init_blank_db_for_testing(**init_kwargs):
                     db_is_blank = True
         core.init_db(f"{db_url}/{testing_db_name}", **init_kwargs)
 
+    if erase_if_exists:
+        from ..parallel_tasks import resume_journal
+        resume_journal.clear_journals()
+
     return db_is_blank
 
 @contextlib.contextmanager
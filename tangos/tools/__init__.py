@@ -70,6 +70,7 @@ from . import (
     consistent_trees_importer,
     crosslink,
     db_importer,
+    major_branch_builder,
     merger_tree_patcher,
     property_deleter,
     property_importer,
@@ -37,6 +37,12 @@ class GenericLinker(GenericTangosTool):
                             help='Process in reverse order (low-z first)')
         parser.add_argument('--dmonly', action='store_true',
                             help='only match halos based on DM particles. Much more memory efficient, but currently only works for Rockstar halos')
+        parser.add_argument('--single-pass', action='store_true', dest='single_pass',
+                            help='Derive the links in both directions from one count of the particles shared by each '
+                                 'pair of objects, rather than matching each direction separately')
+        parser.add_argument('--contiguous', action='store_true',
+                            help='Give each process runs of consecutive timestep pairs, and keep the snapshot shared '
+                                 'between one pair and the next in memory rather than loading it twice')
 
     def run_calculation_loop(self):
         parallel_tasks.database.synchronize_creator_object()
@@ -46,14 +52,24 @@ class GenericLinker(GenericTangosTool):
             logger.error("No timesteps found to link")
             return
 
-        pair_list = parallel_tasks.distributed(pair_list, allow_resume=True)
+        contiguous = getattr(self.args, 'contiguous', False)
+        pair_list = parallel_tasks.distributed(pair_list, allow_resume=True, contiguous=contiguous)
 
         object_type = core.halo.SimulationObjectBase.object_typecode_from_tag(self.args.type_)
 
+        retained_snapshots = {}
         for s_x, s in pair_list:
             logger.info("Linking %r and %r",s_x,s)
+            if contiguous:
+                # drop any snapshot not needed for this pair before loading new ones, so at most two are held
+                retained_snapshots = {ts_id: snapshot for ts_id, snapshot in retained_snapshots.items()
+                                      if ts_id in (s_x.id, s.id)}
             if self.args.force or self.need_crosslink_ts(s_x, s, object_type):
-                self.crosslink_ts(s_x, s, 0, self.args.hmax, self.args.dmonly, object_typecode=object_type)
+                if contiguous:
+                    # the input handler's cache returns the same snapshot for as long as it is referenced here
+                    retained_snapshots = {ts.id: ts.load() for ts in (s_x, s)}
+                self.crosslink_ts(s_x, s, 0, self.args.hmax, self.args.dmonly, object_typecode=object_type,
+                                  single_pass=getattr(self.args, 'single_pass', False))
 
     def _generate_timestep_pairs(self):
         raise NotImplementedError("No implementation found for generating the timestep pairs")
@@ -107,9 +123,13 @@ class GenericLinker(GenericTangosTool):
         halos_map = {h.finder_id: h for h in halos}
         return halos_map
 
-    def crosslink_ts(self, ts1, ts2, halo_min=0, halo_max=None, dmonly=False, threshold=config.default_linking_threshold, object_typecode=0):
+    def crosslink_ts(self, ts1, ts2, halo_min=0, halo_max=None, dmonly=False, threshold=config.default_linking_threshold, object_typecode=0,
+                     single_pass=False):
         """Link the halos of two timesteps together
 
+        If single_pass is True, the links in both directions are derived together (see
+        HandlerBase.match_objects_bidirectional)
+
         :type ts1 tangos.core.TimeStep
         :type ts2 tangos.core.TimeStep"""
         logger.info("Gathering halo information for %r and %r", ts1, ts2)
@@ -129,13 +149,18 @@ class GenericLinker(GenericTangosTool):
         snap1 = ts1.load()
         snap2 = ts2.load()
 
+        object_typetag = core.halo.SimulationObjectBase.object_typetag_from_code(object_typecode)
         try:
-            cat = output_handler_1.match_objects(ts1.extension, ts2.extension, halo_min, halo_max, dmonly, threshold,
-                                                 core.halo.SimulationObjectBase.object_typetag_from_code(object_typecode),
-                                                 output_handler_for_ts2=output_handler_2)
-            back_cat = output_handler_2.match_objects(ts2.extension, ts1.extension, halo_min, halo_max, dmonly, threshold,
-                                                      core.halo.SimulationObjectBase.object_typetag_from_code(object_typecode),
-                                                      output_handler_for_ts2= output_handler_1)
+            if single_pass:
+                cat, back_cat = output_handler_1.match_objects_bidirectional(ts1.extension, ts2.extension, halo_min,
+                                                                             halo_max, dmonly, threshold, object_typetag,
+                                                                             output_handler_for_ts2=output_handler_2)
+            else:
+                cat = output_handler_1.match_objects(ts1.extension, ts2.extension, halo_min, halo_max, dmonly,
+                                                     threshold, object_typetag, output_handler_for_ts2=output_handler_2)
+                back_cat = output_handler_2.match_objects(ts2.extension, ts1.extension, halo_min, halo_max, dmonly,
+                                                          threshold, object_typetag,
+                                                          output_handler_for_ts2=output_handler_1)
         except Exception as e:
             if isinstance(e, KeyboardInterrupt):
                 raise
@@ -0,0 +1,41 @@
+from .. import core, query
+from ..relation_finding import major_branch
+from . import GenericTangosTool
+
+
+class MajorBranchBuilder(GenericTangosTool):
+    tool_name = 'build-major-branches'
+    tool_description = 'Precompute the major progenitor and descendant branches of every object, to speed up ' \
+                       'subsequent queries (re-run after adding or removing links)'
+    parallel = False
+
+    @classmethod
+    def add_parser_arguments(self, parser):
+        parser.add_argument('--for', '--sims', action='store', nargs='*',
+                            metavar='name',
+                            help='Specify one or more simulations to run on',
+                            dest="for_")
+
+        parser.add_argument('--clear', action='store_true',
+                            help='Remove the precomputed branches instead of building them')
+
+    def process_options(self, options):
+        self.options = options
+
+    def run_calculation_loop(self):
+        session = core.get_default_session()
+        if self.options.for_ is not None:
+            sims = [query.get_simulation(s) for s in self.options.for_]
+        else:
+            sims = session.query(core.Simulation).all()
+
+        for s in sims:
+            if self.options.clear:
+                print(f"Removing major branches for {s.basename:s}")
+                major_branch.clear_major_branches(session, s)
+            else:
+                print(f"Building major branches for {s.basename:s}")
+                for direction, name in ((major_branch.PROGENITORS, "progenitor"),
+                                        (major_branch.DESCENDANTS, "descendant")):
+                    nrows = major_branch.build_major_branches(session, s, direction)
+                    print(f"  Stored {nrows} rows for major {name} branches")
@@ -11,7 +11,7 @@ import sqlalchemy.exc
 import sqlalchemy.orm
 
 from .. import config, core, live_calculation, parallel_tasks, properties
-from ..cached_writer import insert_list
+from ..cached_writer import BulkInserter, insert_list
 from ..log import logger
 from ..parallel_tasks import accumulative_statistics
 from ..util import proxy_object, terminalcontroller, timing_monitor
@@ -86,6 +86,12 @@ class PropertyWriter(GenericTangosTool):
                             help="Specify a filter that describes which objects the calculation should be executed for. Multiple filters may be specified, in which case they must all evaluate to true for the object to be included.")
         parser.add_argument('--explain-classes', action='store_true',
                             help="Log some explanation for why property classes are selected (when there is any ambiguity)")
+        parser.add_argument('--bulk-insert', action='store_true', default=config.PROPERTY_WRITER_BULK_INSERT,
+                            help="Commit results using Core-level bulk inserts rather than creating ORM objects. "
+                                 "This is considerably faster when many objects are being written.")
+        parser.add_argument('--dedicated-writer', action='store_true',
+                            help="When running in parallel, stream results to the server process which commits them "
+                                 "to the database asynchronously, so that other processes do not wait for database locks")
 
     def _create_parser_obj(self):
         parser = argparse.ArgumentParser()
@@ -161,7 +167,7 @@ class PropertyWriter(GenericTangosTool):
             # before all nodes have generated their local work lists
             parallel_tasks.barrier()
 
-            return parallel_tasks.distributed(items, allow_resume=False)
+            return parallel_tasks.distributed(items, allow_resume=False, chunked=True)
         else:
             return items
 
@@ -268,11 +274,26 @@ class PropertyWriter(GenericTangosTool):
         return [self._build_existing_properties(h) for h in halos]
 
 
+    def _use_dedicated_writer(self):
+        return self._dedicated_writer_enabled
+
+    def _dedicated_writer_available(self):
+        if not (self.options.dedicated_writer and parallel_tasks.parallelism_is_active()):
+            return False
+        if not parallel_tasks.async_message.backend_supports_threads():
+            logger.warning("The parallel backend cannot send messages from background threads; "
+                           "ignoring --dedicated-writer")
+            return False
+        return True
+
     def _is_commit_needed(self, end_of_timestep, end_of_simulation):
         if len(self._pending_properties)==0:
             return False
         if end_of_simulation:
             return True
+        elif self._use_dedicated_writer() and \
+                len(self._pending_properties) >= config.PROPERTY_WRITER_DEDICATED_WRITER_BATCH_SIZE:
+            return True
         elif end_of_timestep and (time.time() - self._last_commit_time > self._writer_minimum):
             return True
         elif time.time() - self._last_commit_time > self._writer_timeout:
@@ -293,7 +314,13 @@ class PropertyWriter(GenericTangosTool):
             message.update_performance_stats()
 
     def _commit_results(self):
-        insert_list(self._pending_properties)
+        if self._use_dedicated_writer():
+            parallel_tasks.database.queue_for_dedicated_writer(self._pending_properties)
+        elif self.options.bulk_insert:
+            with self.timing_monitor(self._bulk_inserter):
+                insert_list(self._pending_properties, self._bulk_inserter)
+        else:
+            insert_list(self._pending_properties)
         self._pending_properties = []
         self._last_commit_time = time.time()
 
@@ -363,7 +390,7 @@ class PropertyWriter(GenericTangosTool):
             self._current_timestep_id = db_timestep.id
 
 
-    def _set_current_halo(self, db_halo):
+    def _set_current_halo(self, db_halo, existing_properties):
         self._set_current_timestep(db_halo.timestep)
 
         if self._loaded_halo_id==db_halo.id:
@@ -374,6 +401,8 @@ class PropertyWriter(GenericTangosTool):
 
         if self._should_load_halo_particles():
             self._loaded_halo  = db_halo.load(mode=self.options.load_mode)
+            self._prefetch_required_arrays(self._loaded_halo,
+                                           self._calculators_using_halo_particles(db_halo, existing_properties))
 
         if self.options.load_mode is not None:
             self._run_preloop(self._loaded_halo, db_halo.timestep,
@@ -384,15 +413,34 @@ class PropertyWriter(GenericTangosTool):
         return db_halo.timestep.load_region(region_spec, self.options.load_mode,
                                             self._estimate_num_region_calculations_this_timestep())
 
-    def _get_halo_snapshot_data_if_appropriate(self, db_halo, db_data, property_calculator):
+    def _calculators_using_halo_particles(self, db_halo, existing_properties):
+        """Return the calculators that will be applied to the particles of the halo itself, rather than to a region"""
+        return [c for c in self._property_calculator_instances
+                if c.requires_particle_data and c.accept(existing_properties) and
+                c.region_specification(self._get_db_data(db_halo, c, existing_properties)) is None]
+
+    def _get_halo_snapshot_data_if_appropriate(self, db_halo, db_data, property_calculator, existing_properties):
 
-        self._set_current_halo(db_halo)
+        self._set_current_halo(db_halo, existing_properties)
 
         if property_calculator.region_specification(db_data) is not None:
-            return self._get_current_halo_specified_region_particles(db_halo, property_calculator.region_specification(db_data))
+            region = self._get_current_halo_specified_region_particles(db_halo, property_calculator.region_specification(db_data))
+            self._prefetch_required_arrays(region, [property_calculator])
+            return region
         else:
             return self._loaded_halo
 
+    @staticmethod
+    def _prefetch_required_arrays(particle_data, property_calculators):
+        """If the particle data is held remotely, fetch all the arrays that the calculations declare they need at once"""
+        if not hasattr(particle_data, 'prefetch_arrays'):
+            return
+        required_arrays = []
+        for calculator in property_calculators:
+            required_arrays += [a for a in calculator.required_arrays if a not in required_arrays]
+        if len(required_arrays)>0:
+            particle_data.prefetch_arrays(required_arrays)
+
 
     def _get_standin_property_value(self, property_calculator):
         if isinstance(property_calculator.names,str):
@@ -400,16 +448,21 @@ class PropertyWriter(GenericTangosTool):
         num = len(property_calculator.names)
         return [None]*num
 
-    def _get_property_value(self, db_halo, property_calculator, existing_properties):
+    @staticmethod
+    def _get_db_data(db_halo, property_calculator, existing_properties):
         if property_calculator.no_proxies():
-            db_data = db_halo
+            return db_halo
         else:
-            db_data = existing_properties
+            return existing_properties
+
+    def _get_property_value(self, db_halo, property_calculator, existing_properties):
+        db_data = self._get_db_data(db_halo, property_calculator, existing_properties)
 
         result = self._get_standin_property_value(property_calculator)
 
         try:
-            snapshot_data = self._get_halo_snapshot_data_if_appropriate(db_halo, db_data, property_calculator)
+            snapshot_data = self._get_halo_snapshot_data_if_appropriate(db_halo, db_data, property_calculator,
+                                                                        existing_properties)
         except OSError:
             logger.warning("Failed to load snapshot data for %r; skipping",db_halo)
             self.tracker.register_loading_error()
@@ -567,14 +620,19 @@ class PropertyWriter(GenericTangosTool):
 
         parallel_tasks.database.synchronize_creator_object()
 
+        self._dedicated_writer_enabled = self._dedicated_writer_available()
         self._last_commit_time = time.time()
         self._pending_properties = []
+        self._bulk_inserter = BulkInserter()
 
         for f_obj in self._get_parallel_timestep_iterator():
             self.run_timestep_calculation(f_obj)
 
         self._commit_results_if_needed(True,True)
 
+        if self._use_dedicated_writer():
+            parallel_tasks.database.flush_dedicated_writer()
+
 
 class CalculationSuccessTracker(accumulative_statistics.StatisticsAccumulatorBase):
     def __init__(self, allow_parallel=False):
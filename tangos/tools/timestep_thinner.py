@@ -3,6 +3,7 @@ import sqlalchemy
 from sqlalchemy import delete, select
 
 from .. import core, query
+from ..relation_finding import major_branch
 from . import GenericTangosTool
 
 
@@ -86,6 +87,8 @@ class TimestepThinner(GenericTangosTool):
 
             if ok:
                 session = core.get_default_session()
+                # the precomputed branches may pass through the removed timesteps
+                major_branch.clear_major_branches(session, sim)
                 for ts in to_remove:
                     session.execute(
                        sqlalchemy.delete(core.TimeStep).filter(core.TimeStep.id == ts.id)
@@ -0,0 +1,94 @@
+"""Saving pynbody KDTrees to disk, so that they can be memory-mapped rather than rebuilt (see config.kdtree_cache_directory)
+
+A tree is identified by the absolute path, modification time and particle count of the snapshot it was built for,
+along with the units of the positions (since the node boundaries are stored in those units), the leaf size and the
+pynbody version. Files are written under temporary names and then moved into place, so that concurrent processes
+never see a partially-written tree."""
+
+import hashlib
+import os
+import pathlib
+import pickle
+
+import numpy as np
+
+from .. import config
+from ..log import logger
+
+
+def _tree_key(snapshot):
+    import pynbody
+    from pynbody.configuration import config as pynbody_config
+
+    filename = os.path.abspath(str(snapshot.filename))
+    stat = os.stat(filename)
+    key = (filename, stat.st_mtime_ns, len(snapshot), str(snapshot['pos'].units),
+           pynbody_config['sph']['tree-leafsize'], pynbody.__version__)
+    return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+
+def cache_files(snapshot):
+    """Return the (metadata, nodes, offsets) paths in which the tree for the snapshot is saved, or None if trees are
+    not being cached or the snapshot is not associated with a file on disk"""
+    if config.kdtree_cache_directory is None:
+        return None
+    try:
+        key = _tree_key(snapshot)
+    except (OSError, TypeError, AttributeError):
+        return None
+    base = pathlib.Path(config.kdtree_cache_directory).expanduser() / key
+    return base.with_suffix(".meta"), base.with_suffix(".kdnodes.npy"), base.with_suffix(".offsets.npy")
+
+def load_tree_arrays(files):
+    """Memory-map a saved tree, returning its serialized form (see pynbody.kdtree.KDTree.serialize)"""
+    meta_file, nodes_file, offsets_file = files
+    with open(meta_file, 'rb') as f:
+        leafsize, boxsize, kernel_id = pickle.load(f)
+    kdnodes = np.load(nodes_file, mmap_mode='r')
+    offsets = np.load(offsets_file, mmap_mode='r')
+    return leafsize, boxsize, kdnodes, offsets, kernel_id
+
+def _load_cached_tree(snapshot, files, num_threads):
+    if not files[0].exists():
+        return False
+    try:
+        snapshot.import_tree(load_tree_arrays(files), num_threads=num_threads)
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError) as e:
+        logger.warning("Unable to use the saved KDTree for %r (%s); rebuilding it", snapshot.filename, e)
+        return False
+    logger.info("Memory-mapped saved KDTree for %r", snapshot.filename)
+    snapshot._tangos_kdtree_cache_files = files
+    return True
+
+def _save_tree(snapshot, files):
+    meta_file, nodes_file, offsets_file = files
+    leafsize, boxsize, kdnodes, offsets, kernel_id = snapshot.kdtree.serialize()
+    meta_file.parent.mkdir(parents=True, exist_ok=True)
+    suffix = ".%d.tmp" % os.getpid()
+    try:
+        for path, array in ((nodes_file, kdnodes), (offsets_file, offsets)):
+            with open(str(path)+suffix, 'wb') as f:
+                np.save(f, np.asarray(array))
+            os.replace(str(path)+suffix, path)
+        with open(str(meta_file)+suffix, 'wb') as f:
+            pickle.dump((leafsize, boxsize, kernel_id), f)
+        # the metadata is moved into place last, since its presence indicates that the tree is complete
+        os.replace(str(meta_file)+suffix, meta_file)
+    except OSError as e:
+        logger.warning("Unable to save KDTree for %r: %s", snapshot.filename, e)
+        return
+    logger.info("Saved KDTree for %r", snapshot.filename)
+
+def build_tree(snapshot, num_threads=None, shared_mem=None):
+    """Give the snapshot a KDTree, memory-mapping a saved tree if one exists and otherwise building and saving it"""
+    if hasattr(snapshot, 'kdtree'):
+        return
+    files = cache_files(snapshot)
+    if files is not None and _load_cached_tree(snapshot, files, num_threads):
+        return
+    snapshot.build_tree(num_threads=num_threads, shared_mem=shared_mem)
+    if files is not None:
+        _save_tree(snapshot, files)
+
+def saved_tree_files(snapshot):
+    """Return the files from which the snapshot's KDTree was memory-mapped, or None if it was built in memory"""
+    return getattr(snapshot, '_tangos_kdtree_cache_files', None)
@@ -0,0 +1,171 @@
+"""Saving the particle membership of halo catalogues to disk (see config.halo_membership_index_directory)
+
+For each timestep and object type, the index stores the catalogue's halo number mapper along with the particle
+indices of every object, concatenated, and the start and end of each object within them. Partial loads can then take
+an object's particles straight from a memory-mapped copy, without the halo finder's files being read again in every
+process.
+
+An index is identified by the absolute path of the snapshot, the modification times of the snapshot and of any files
+alongside it whose names begin with the snapshot's name (which is where most halo finders write their catalogues),
+the input handler, the object type and the pynbody version. Files are written under temporary names and then moved
+into place, so that concurrent processes never see a partially-written index. While one process builds an index, it
+holds a lock file alongside it, and other processes wait for the index rather than building it too."""
+
+import hashlib
+import os
+import pathlib
+import pickle
+import time
+
+import numpy as np
+
+from .. import config
+from ..log import logger
+
+_loaded_indices = {} # metadata path -> MembershipIndex, so that each index is only opened once per process
+_BUILD_WAIT_SECONDS = 600 # how long to wait for another process to build an index before using the catalogue
+
+
+class MembershipIndex:
+    """The particles belonging to each object in a halo catalogue"""
+
+    def __init__(self, number_mapper, particle_index_list, boundaries):
+        self.number_mapper = number_mapper
+        self.particle_index_list = particle_index_list
+        self.boundaries = boundaries
+
+    def particle_indices(self, halo_number):
+        """Return the snapshot indices of the particles in the specified object"""
+        start, stop = self.boundaries[self.number_mapper.number_to_index(halo_number)]
+        return np.asarray(self.particle_index_list[start:stop])
+
+
+def _catalogue_file_mtimes(filename):
+    directory, name = os.path.split(filename)
+    mtimes = []
+    with os.scandir(directory or ".") as entries:
+        for entry in entries:
+            if entry.name.startswith(name):
+                mtimes.append((entry.name, entry.stat().st_mtime_ns))
+    return sorted(mtimes)
+
+def _index_key(filename, handler_name, object_typetag):
+    import pynbody
+
+    filename = os.path.abspath(str(filename))
+    key = (filename, os.stat(filename).st_mtime_ns, _catalogue_file_mtimes(filename), handler_name, object_typetag,
+           pynbody.__version__)
+    return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+
+def index_files(filename, handler_name, object_typetag):
+    """Return the (metadata, particle indices, boundaries) paths in which the membership of the given objects is
+    saved, or None if membership is not being indexed or the snapshot file cannot be found"""
+    if config.halo_membership_index_directory is None:
+        return None
+    try:
+        key = _index_key(filename, handler_name, object_typetag)
+    except OSError:
+        return None
+    base = pathlib.Path(config.halo_membership_index_directory).expanduser() / key
+    return base.with_suffix(".meta"), base.with_suffix(".indices.npy"), base.with_suffix(".boundaries.npy")
+
+def load_index(files):
+    """Memory-map a saved index, returning a MembershipIndex, or None if the index has not been saved"""
+    meta_file, indices_file, boundaries_file = files
+    index = _loaded_indices.get(meta_file, None)
+    if index is not None or not meta_file.exists():
+        return index
+    try:
+        with open(meta_file, 'rb') as f:
+            number_mapper = pickle.load(f)
+        index = MembershipIndex(number_mapper, np.load(indices_file, mmap_mode='r'),
+                                np.load(boundaries_file, mmap_mode='r'))
+    except (OSError, ValueError, EOFError, pickle.UnpicklingError) as e:
+        logger.warning("Unable to use the saved membership index %r (%s); using the halo catalogue", meta_file.stem, e)
+        return None
+    _loaded_indices[meta_file] = index
+    return index
+
+def build_index(get_catalogue, files):
+    """Save the membership of all objects in the catalogue returned by get_catalogue(), returning the
+    MembershipIndex, or None if the catalogue does not expose the particles belonging to all its objects
+
+    Only one process builds a given index at a time: the others wait for it to finish and then memory-map the result,
+    without calling get_catalogue."""
+    meta_file = files[0]
+    lock_file = pathlib.Path(str(meta_file)+".lock")
+    try:
+        meta_file.parent.mkdir(parents=True, exist_ok=True)
+        os.close(os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return _wait_for_index(files, lock_file)
+    except OSError as e:
+        logger.warning("Unable to save membership index for %r: %s", meta_file.stem, e)
+        return None
+
+    try:
+        # another process may have finished building the index since this one last looked
+        index = load_index(files)
+        if index is None:
+            index = _build_index(get_catalogue(), files)
+        return index
+    finally:
+        try:
+            os.remove(lock_file)
+        except OSError:
+            pass
+
+def _wait_for_index(files, lock_file):
+    logger.info("Waiting for another process to save membership index %r", files[0].stem)
+    deadline = time.time() + _BUILD_WAIT_SECONDS
+    while lock_file.exists():
+        if time.time() > deadline:
+            logger.warning("Gave up waiting for membership index %r to be saved; if no other process is building "
+                           "it, remove %s", files[0].stem, lock_file)
+            return None
+        time.sleep(0.1)
+    return load_index(files)
+
+def _build_index(halo_catalogue, files):
+    try:
+        halo_catalogue.load_all()
+    except NotImplementedError:
+        return None
+    if halo_catalogue.number_mapper is None:
+        return None
+    try:
+        # NB pynbody does not provide public access to the complete index lists, so these may change between versions
+        index_lists = halo_catalogue._index_lists
+        if index_lists is None:
+            return None
+        particle_index_list = index_lists.particle_index_list
+        boundaries = index_lists.particle_index_list_boundaries
+        num_missing_particles = index_lists.num_missing_particles
+    except AttributeError:
+        logger.warning("Unable to index the membership of %r with this version of pynbody",
+                       halo_catalogue.base.filename)
+        return None
+    if num_missing_particles is not None and np.any(num_missing_particles > 0):
+        # an incomplete catalogue (e.g. of a partially loaded snapshot) must not stand in for the whole one
+        return None
+
+    meta_file, indices_file, boundaries_file = files
+    suffix = ".%d.tmp" % os.getpid()
+    try:
+        for path, array in ((indices_file, particle_index_list), (boundaries_file, boundaries)):
+            with open(str(path)+suffix, 'wb') as f:
+                np.save(f, np.asarray(array))
+            os.replace(str(path)+suffix, path)
+        with open(str(meta_file)+suffix, 'wb') as f:
+            pickle.dump(halo_catalogue.number_mapper, f)
+        # the metadata is moved into place last, since its presence indicates that the index is complete
+        os.replace(str(meta_file)+suffix, meta_file)
+    except OSError as e:
+        logger.warning("Unable to save membership index for %r: %s", halo_catalogue.base.filename, e)
+        return None
+    logger.info("Saved membership index for %r", halo_catalogue.base.filename)
+    return load_index(files)
+
+def clear_loaded_indices():
+    """Forget the indices opened by this process (the files are unaffected)"""
+    _loaded_indices.clear()
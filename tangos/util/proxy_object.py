@@ -50,6 +50,11 @@ class ProxyObjectFromDatabaseId(ProxyObjectBase):
     def resolve(self, session):
         return session.query(core.SimulationObjectBase).filter_by(id=self._dbid).first()
 
+    @property
+    def id(self):
+        """The database ID of the object, available without resolving it"""
+        return self._dbid
+
 class ProxyObjectFromFinderIdAndTimestep(ProxyObjectBase):
     """A proxy object that resolves into the object with given finder ID in the specified timestep"""
     def __init__(self, finder_id, typetag, timestep_id):
@@ -30,6 +30,7 @@ class TimingMonitor(accumulative_statistics.StatisticsAccumulatorBase):
     def reset(self):
         self.timings_by_class = {}
         self.labels_by_class = {}
+        self.counts_by_class = {}
 
     def check_compatible_object(self, object):
         if not hasattr(object, 'timing_monitor'):
@@ -56,6 +57,7 @@ class TimingMonitor(accumulative_statistics.StatisticsAccumulatorBase):
         self._set_as_monitor_for(object)
         self._time_marks_info = ["start"]
         self._time_marks = [time.time()]
+        self._count = None
 
     def _end(self):
         """End a timer for the specified object."""
@@ -68,6 +70,12 @@ class TimingMonitor(accumulative_statistics.StatisticsAccumulatorBase):
         self._time_marks.append(time.time())
 
         self._add_run_to_running_totals(cl, self._time_marks, self._time_marks_info)
+        if self._count is not None:
+            self._add_count_to_running_totals(cl, *self._count)
+
+    def _add_count_to_running_totals(self, cl, number, unit):
+        previous_number, _ = self.counts_by_class.get(cl, (0, unit))
+        self.counts_by_class[cl] = (previous_number + number, unit)
 
     def _add_run_to_running_totals(self, cl, latest_run_time_marks, latest_run_time_marks_labels):
         previous_timings = self.timings_by_class.get(cl, None)
@@ -94,6 +102,13 @@ class TimingMonitor(accumulative_statistics.StatisticsAccumulatorBase):
         else:
             self._time_marks_info.append(label)
 
+    def count(self, number, unit="items"):
+        """Record that a number of items (e.g. database rows) were processed, so that a rate can be given"""
+        if self._count is None:
+            self._count = (number, unit)
+        else:
+            self._count = (self._count[0] + number, unit)
+
     def add(self, other):
         """Add the time taken by another TimingMonitor to this one"""
         if self._monitoring is not None:
@@ -104,6 +119,9 @@ class TimingMonitor(accumulative_statistics.StatisticsAccumulatorBase):
             timings = other.timings_by_class[c]
             self._add_run_to_running_totals(c, np.cumsum(np.concatenate(([0.0],timings))), labels)
 
+        for c, (number, unit) in other.counts_by_class.items():
+            self._add_count_to_running_totals(c, number, unit)
+
     def report_to_log(self, logger):
         if len(self.timings_by_class) == 0:
             return
@@ -121,6 +139,9 @@ class TimingMonitor(accumulative_statistics.StatisticsAccumulatorBase):
                 logger.info(" " + name + f"{self.format_time(sum(v)):>12} | {100 * sum(v) / v_tot:4.1f}%")
             else:
                 logger.info(" " + name + f"{self.format_time(sum(v)):>12}")
+            if k in self.counts_by_class:
+                number, unit = self.counts_by_class[k]
+                logger.info(f"  {number} {unit} processed; {number/(sum(v)+1e-10):.1f} {unit}/s")
             if len(v)>1:
                 marks_info = self.labels_by_class[k]
                 logger.info("  ------------ INTERNAL BREAKDOWN ------------" )
@@ -162,4 +183,7 @@ class TimingMonitor(accumulative_statistics.StatisticsAccumulatorBase):
             if not np.all(self.timings_by_class[k] == other.timings_by_class[k]):
                 return False
 
+        if self.counts_by_class != other.counts_by_class:
+            return False
+
         return True
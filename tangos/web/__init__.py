@@ -13,6 +13,10 @@ def main(global_config, **settings):
     from . import crumbs
     config.add_request_method(crumbs.breadcrumbs, 'breadcrumbs', reify=True)
 
+    from .. import config as tangos_config
+    from ..live_calculation import parser
+    parser.prewarm(tangos_config.webview_prewarm_expressions)
+
 
     app = config.make_wsgi_app()
 
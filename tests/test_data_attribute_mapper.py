@@ -5,8 +5,10 @@ import zlib
 
 import numpy as np
 import pynbody
+import pytest
 from pytest import raises as assert_raises
 
+import tangos.config
 import tangos.core.data_attribute_mapper as dam
 
 
@@ -175,3 +177,97 @@ def test_empty_container():
 
     target.data_array = ""
     assert target.data is None
+
+def test_pack_data_of_unknown_type():
+    for typename, testval in test_values.items():
+        attribute_name, packed = dam.pack_data_of_unknown_type(testval)
+        assert attribute_name == "data_"+typename
+
+        target = _TestTarget()
+        setattr(target, attribute_name, packed)
+        assert_data_value(target.data, testval)
+
+    assert dam.pack_data_of_unknown_type(None) == (None, None)
+
+@pytest.fixture
+def binary_array_format(monkeypatch):
+    monkeypatch.setattr(tangos.config, "use_binary_array_format", True)
+
+def test_binary_array_pack_format(binary_array_format):
+    target = _TestTarget()
+    test_data = np.array([[1, 2, 3], [4, 5, 6]], dtype=np.int32)
+    target.data = test_data
+    assert target.data_array.startswith(b"B1")
+    assert b"pickle" not in target.data_array
+    assert target.data_array.endswith(test_data.tobytes())
+    assert target.data.dtype == np.int32
+    assert target.data.shape == (2, 3)
+    assert (target.data == test_data).all()
+
+def test_binary_array_compressed(binary_array_format):
+    target = _TestTarget()
+    test_data = np.arange(2000, dtype=np.float32)
+    target.data = test_data
+    assert target.data_array.startswith(b"B1")
+    assert len(target.data_array) < test_data.nbytes
+    assert target.data.dtype == np.float32
+    assert (target.data == test_data).all()
+
+def test_binary_array_non_contiguous(binary_array_format):
+    target = _TestTarget()
+    test_data = np.arange(20.0).reshape(4, 5)[:, ::2]
+    target.data = test_data
+    assert target.data_array.startswith(b"B1")
+    assert (target.data == test_data).all()
+
+def test_binary_simarray_units(binary_array_format):
+    target = _TestTarget()
+    target.data = pynbody.array.SimArray([1.0, 2.0, 3.0], "Msol kpc**-3")
+    assert target.data_array.startswith(b"B1")
+    assert isinstance(target.data, pynbody.array.SimArray)
+    assert target.data.units == "Msol kpc**-3"
+    assert_data_value(target.data, [1.0, 2.0, 3.0])
+
+def test_non_numeric_arrays_still_pickled(binary_array_format):
+    target = _TestTarget()
+    target.data = np.array(["a", "b"])
+    assert target.data_array.startswith(b"PX")
+    assert list(target.data) == ["a", "b"]
+
+    target.data = [1, 2, 3]
+    assert target.data_array.startswith(b"PX")
+    assert target.data == [1, 2, 3]
+
+def test_pickled_arrays_still_readable(binary_array_format):
+    target = _TestTarget()
+    test_data = np.arange(2000)
+    target.data_array = b"ZX" + zlib.compress(pickle.dumps(test_data))
+    assert target.data_array.startswith(b"ZX")
+    assert (target.data == test_data).all()
+
+@pytest.mark.parametrize("compression", ["zlib", "zstd", "lz4"])
+def test_binary_array_compression_option(binary_array_format, monkeypatch, compression):
+    if compression == "zstd":
+        pytest.importorskip("zstandard")
+    elif compression == "lz4":
+        pytest.importorskip("lz4.frame")
+    monkeypatch.setattr(tangos.config, "binary_array_compression", compression)
+    target = _TestTarget()
+    test_data = np.zeros(2000)
+    target.data = test_data
+    compression_code = target.data_array[2]
+    assert compression_code == {"zlib": 1, "zstd": 2, "lz4": 3}[compression]
+    assert (target.data == test_data).all()
+
+def test_binary_array_zlib_by_default(binary_array_format):
+    target = _TestTarget()
+    target.data = np.zeros(2000)
+    assert target.data_array[2] == 1
+
+@pytest.mark.parametrize("size", [10, 2000])
+def test_binary_array_writable(binary_array_format, size):
+    target = _TestTarget()
+    target.data = np.zeros(size)
+    data = target.data
+    data += 1
+    assert (data == 1).all()
@@ -1,6 +1,8 @@
 import os
 import time
+from types import SimpleNamespace
 
+import numpy as np
 import pytest
 from numpy import testing as npt
 from pytest import fixture
@@ -214,6 +216,41 @@ def test_region_property(fresh_database):
     _assert_properties_as_expected()
     assert db.get_halo("dummy_sim_1/step.2/1")['dummy_region_property']==100.0
 
+class _RemoteParticleDataStandIn:
+    def __init__(self):
+        self.prefetch_requests = []
+
+    def prefetch_arrays(self, array_names):
+        self.prefetch_requests.append(array_names)
+
+def test_prefetch_required_arrays():
+    calculators = [SimpleNamespace(required_arrays=("pos", "mass")), SimpleNamespace(required_arrays=()),
+                   SimpleNamespace(required_arrays=("mass", "rho"))]
+    remote_data = _RemoteParticleDataStandIn()
+    property_writer.PropertyWriter._prefetch_required_arrays(remote_data, calculators)
+    property_writer.PropertyWriter._prefetch_required_arrays(remote_data, calculators[1:2])
+    assert remote_data.prefetch_requests == [["pos", "mass", "rho"]]
+
+    # local data (without a prefetch_arrays method) is left alone
+    property_writer.PropertyWriter._prefetch_required_arrays(output_testing.DummyTimestepData("", 0, 0), calculators)
+
+class DummyRegionPropertyWithParticles(DummyRegionProperty):
+    names = "dummy_region_property_with_particles",
+    requires_particle_data = True
+    required_arrays = ("rho",)
+
+def test_prefetch_only_for_halo_particles(fresh_database):
+    sim = db.get_simulation("dummy_sim_1")
+    writer = property_writer.PropertyWriter()
+    writer._property_calculator_instances = [DummyProperty(sim), DummyPropertyAccessingSimulationProperty(sim),
+                                             DummyRegionPropertyWithParticles(sim)]
+    halo = db.get_halo("dummy_sim_1/step.1/1")
+
+    # calculations on a region, or not using particles at all, have nothing to gain from the halo's arrays
+    for existing_properties in ({}, {'dummy_property': 1.0}):
+        calculators = writer._calculators_using_halo_particles(halo, existing_properties)
+        assert [type(c) for c in calculators] == [DummyProperty]
+
 def test_no_duplication(fresh_database):
     run_writer_with_args("dummy_property")
     assert db.get_default_session().query(db.core.HaloProperty).count()==15
@@ -410,3 +447,117 @@ def test_writer_with_property_accessing_timestep(fresh_database):
     run_writer_with_args("dummy_property_accessing_timestep")
 
     assert db.get_halo("%/step.1/halo_1")['dummy_property_accessing_timestep'] == -1.0
+
+class DummyArrayProperty(DummyProperty):
+    names = "dummy_array_property",
+
+    def calculate(self, data, entry):
+        return np.arange(data.halo, dtype=float)*data.time,
+
+def test_bulk_insert(fresh_database):
+    res = run_writer_with_args("dummy_property", "dummy_link", "dummy_array_property", "--bulk-insert")
+    _assert_properties_as_expected()
+    assert db.get_default_session().query(db.core.HaloProperty).count() == 30
+    assert db.get_default_session().query(db.core.HaloLink).count() == 15
+    db.testing.assert_halolists_equal([db.get_halo(2)['dummy_link']], [db.get_halo(1)])
+    npt.assert_equal(db.get_halo("dummy_sim_1/step.2/3")['dummy_array_property'], [0.0, 2.0, 4.0])
+
+    assert "BulkInserter" in res
+    assert "45 rows processed" in res
+
+    run_writer_with_args("dummy_property", "--bulk-insert")  # should not create duplicates
+    assert db.get_default_session().query(db.core.HaloProperty).count() == 30
+
+def test_parallel_bulk_insert(fresh_database):
+    parallel_tasks.use('multiprocessing-3')
+    try:
+        run_writer_with_args("dummy_property", "--bulk-insert", parallel=True)
+    finally:
+        parallel_tasks.use('null')
+    _assert_properties_as_expected()
+    assert db.get_default_session().query(db.core.HaloProperty).count() == 15
+
+@pytest.mark.parametrize('load_mode', [None, 'server'])
+def test_dedicated_writer(fresh_database, load_mode):
+    parallel_tasks.use('multiprocessing-3')
+    args = ["dummy_property", "dummy_link", "--dedicated-writer"]
+    if load_mode is not None:
+        args.append("--load-mode="+load_mode)
+    try:
+        res = run_writer_with_args(*args, parallel=True)
+    finally:
+        parallel_tasks.use('null')
+
+    _assert_properties_as_expected()
+    assert db.get_default_session().query(db.core.HaloProperty).count() == 15
+    assert db.get_default_session().query(db.core.HaloLink).count() == 15
+    db.testing.assert_halolists_equal([db.get_halo(2)['dummy_link']], [db.get_halo(1)])
+    assert "CUMULATIVE DEDICATED WRITER" in res
+    assert "30 rows processed" in res
+
+def test_dedicated_writer_needs_threaded_sends(fresh_database, monkeypatch):
+    from tangos.parallel_tasks.backends import multiprocessing as multiprocessing_backend
+    monkeypatch.setattr(multiprocessing_backend, 'supports_threaded_sends', False, raising=False)
+    parallel_tasks.use('multiprocessing-3')
+    try:
+        res = run_writer_with_args("dummy_property", "--dedicated-writer", parallel=True)
+    finally:
+        parallel_tasks.use('null')
+
+    _assert_properties_as_expected()
+    assert db.get_default_session().query(db.core.HaloProperty).count() == 15
+    assert "ignoring --dedicated-writer" in res
+    assert "CUMULATIVE DEDICATED WRITER" not in res
+
+class _DedicatedWriterMessageStandIn:
+    def __init__(self, contents):
+        self.contents = contents
+        self.source = 1
+        self.responses = []
+
+    def respond(self, response):
+        self.responses.append(response)
+
+class _DedicatedWriterFlushStandIn(_DedicatedWriterMessageStandIn, parallel_tasks.database.MessageFlushDedicatedWriter):
+    pass
+
+def test_dedicated_writer_reports_error_on_enqueue(fresh_database, monkeypatch):
+    from tangos import cached_writer
+    def failing_insert_list(*args, **kwargs):
+        raise RuntimeError("Test of dedicated writer failure")
+    monkeypatch.setattr(cached_writer, 'insert_list', failing_insert_list)
+
+    writer = parallel_tasks.database.DedicatedWriter()
+    halo_id = db.get_halo("dummy_sim_1/step.1/1").id
+    try:
+        first = _DedicatedWriterMessageStandIn([(halo_id, "dummy_property", 1.0)])
+        writer.enqueue_rows(first)
+        flush = _DedicatedWriterFlushStandIn(None)
+        writer.enqueue_flush(flush)
+        while len(flush.responses)==0:
+            time.sleep(0.01)
+        assert first.responses == [None]
+        assert isinstance(flush.responses[0], RuntimeError)
+
+        # once the writer has failed, further rows are refused straight away
+        second = _DedicatedWriterMessageStandIn([(halo_id, "dummy_property", 2.0)])
+        writer.enqueue_rows(second)
+        assert isinstance(second.responses[0], RuntimeError)
+    finally:
+        writer.stop()
+
+def test_dedicated_writer_backpressure(fresh_database):
+    parallel_tasks.use('multiprocessing-3')
+    old_batch_size = tangos.config.PROPERTY_WRITER_DEDICATED_WRITER_BATCH_SIZE
+    old_max_queued = tangos.config.PROPERTY_WRITER_DEDICATED_WRITER_MAX_QUEUED_ROWS
+    tangos.config.PROPERTY_WRITER_DEDICATED_WRITER_BATCH_SIZE = 1
+    tangos.config.PROPERTY_WRITER_DEDICATED_WRITER_MAX_QUEUED_ROWS = 0
+    try:
+        run_writer_with_args("dummy_property", "--dedicated-writer", parallel=True)
+    finally:
+        parallel_tasks.use('null')
+        tangos.config.PROPERTY_WRITER_DEDICATED_WRITER_BATCH_SIZE = old_batch_size
+        tangos.config.PROPERTY_WRITER_DEDICATED_WRITER_MAX_QUEUED_ROWS = old_max_queued
+
+    _assert_properties_as_expected()
+    assert db.get_default_session().query(db.core.HaloProperty).count() == 15
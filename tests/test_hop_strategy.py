@@ -10,6 +10,7 @@ import tangos.testing.simulation_generator
 
 __author__ = 'app'
 
+import pytest
 from pytest import raises as assert_raises
 
 import tangos
@@ -406,3 +407,169 @@ def test_single_match_from_multiple_routes():
     # The multiple routes here are sim3/ts1/1 -> sim2/ts1/1, sim2/ts1/2 -> sim/ts1/1
     h = tangos.get_halo("sim3/ts1/1")
     testing.assert_halolists_equal([h.calculate("match('sim')")], [tangos.get_halo("sim/ts1/1")])
+
+def _all_and_weights_with_engine(monkeypatch, engine, strategy_class, *args, **kwargs):
+    with monkeypatch.context() as m:
+        m.setattr(tangos.config, "multihop_engine", engine)
+        strategy = strategy_class(*args, **kwargs)
+        with testing.SqlExecutionTracker() as track:
+            results, weights = strategy.all_and_weights()
+        return [r.path for r in results], list(weights), "recursive" in track
+
+@pytest.mark.parametrize("strategy_class, halo, args, kwargs, uses_cte_when_auto", [
+    (halo_finding.MultiHopMajorProgenitorsStrategy, "sim/ts3/1", (), {'include_startpoint': True}, True),
+    (halo_finding.MultiHopMajorDescendantsStrategy, "sim/ts1/2", (), {'include_startpoint': True}, True),
+    (halo_finding.MultiHopAllProgenitorsStrategy, "sim/ts3/1", (), {}, False),
+    (halo_finding.MultiHopStrategy, "sim/ts3/1", (2, 'backwards'), {'order_by': ["time_asc", "weight"]}, False),
+    (halo_finding.MultiHopStrategy, "sim/ts3/1", (2, 'backwards'), {'order_by': ["time_asc", "weight"],
+                                                                     'combine_routes': False}, True),
+    (halo_finding.MultiHopStrategy, "sim/ts1/1", (5, 'forwards'), {'order_by': ["time_asc", "weight"]}, False),
+    (halo_finding.MultiHopStrategy, "sim/ts2/2", (), {'directed': 'across'}, False),
+    (halo_finding.MultiHopMostRecentMergerStrategy, "sim/ts3/1", (), {}, False)
+])
+def test_recursive_cte_engine(monkeypatch, strategy_class, halo, args, kwargs, uses_cte_when_auto):
+    halo = tangos.get_item(halo)
+    temp_table_results = _all_and_weights_with_engine(monkeypatch, 'temp_table', strategy_class, halo, *args, **kwargs)
+    auto_results = _all_and_weights_with_engine(monkeypatch, 'auto', strategy_class, halo, *args, **kwargs)
+    assert not temp_table_results[2]
+    assert auto_results[2] == uses_cte_when_auto
+    assert auto_results[:2] == temp_table_results[:2]
+
+    if strategy_class is not halo_finding.MultiHopMostRecentMergerStrategy and kwargs.get('directed')!='across':
+        cte_results = _all_and_weights_with_engine(monkeypatch, 'recursive_cte', strategy_class, halo, *args, **kwargs)
+        assert cte_results[2]
+        assert cte_results[:2] == temp_table_results[:2]
+
+def test_unknown_multihop_engine(monkeypatch):
+    monkeypatch.setattr(tangos.config, "multihop_engine", "not_an_engine")
+    with assert_raises(ValueError):
+        halo_finding.MultiHopMajorProgenitorsStrategy(tangos.get_item("sim/ts3/1")).all()
+
+@pytest.mark.parametrize("strategy_class, halo, args, kwargs", [
+    (halo_finding.MultiHopMajorProgenitorsStrategy, "sim/ts3/1", (), {'include_startpoint': True}),
+    (halo_finding.MultiHopMajorDescendantsStrategy, "sim/ts1/2", (), {'include_startpoint': True}),
+    (halo_finding.MultiHopAllProgenitorsStrategy, "sim/ts3/1", (), {}),
+    (halo_finding.MultiHopAllProgenitorsStrategy, "sim/ts3/1", (), {'combine_routes': False}),
+    (halo_finding.MultiHopStrategy, "sim/ts1/1", (5, 'forwards'), {'order_by': ["time_asc", "weight"]}),
+    (halo_finding.MultiHopMostRecentMergerStrategy, "sim/ts3/1", (), {})
+])
+def test_in_memory_engine(monkeypatch, strategy_class, halo, args, kwargs):
+    halo = tangos.get_item(halo)
+    temp_table_results = _all_and_weights_with_engine(monkeypatch, 'temp_table', strategy_class, halo, *args, **kwargs)
+    with testing.SqlExecutionTracker() as track:
+        in_memory_results = _all_and_weights_with_engine(monkeypatch, 'in_memory', strategy_class, halo,
+                                                         *args, **kwargs)
+    assert "insert into multihoplink_prelim" not in track
+    assert in_memory_results[:2] == temp_table_results[:2]
+
+@pytest.mark.parametrize("sources, target", [
+    (["sim/ts1/1", "sim/ts1/2", "sim/ts1/3", "sim/ts1/5"], "sim/ts3"),
+    (["sim/ts3/1", "sim/ts3/2", "sim/ts3/3"], "sim/ts1")
+])
+def test_in_memory_engine_multisource(monkeypatch, sources, target):
+    sources = tangos.get_items(sources)
+    target = tangos.get_item(target)
+    monkeypatch.setattr(tangos.config, "multihop_engine", "temp_table")
+    temp_table_strategy = halo_finding.MultiSourceMultiHopStrategy(sources, target)
+    temp_table_results = temp_table_strategy.all()
+
+    monkeypatch.setattr(tangos.config, "multihop_engine", "in_memory")
+    in_memory_strategy = halo_finding.MultiSourceMultiHopStrategy(sources, target)
+    testing.assert_halolists_equal(in_memory_strategy.all(), temp_table_results)
+    assert in_memory_strategy._nhops_taken == temp_table_strategy._nhops_taken
+
+def test_link_graph_cache():
+    from tangos.relation_finding import link_graph
+    session = tangos.get_default_session()
+    sim_id = tangos.get_simulation("sim").id
+    graph = link_graph.get_link_graph(session, sim_id)
+    assert link_graph.get_link_graph(session, sim_id) is graph
+
+    new_link = tangos.core.HaloLink(tangos.get_halo("sim/ts1/1"), tangos.get_halo("sim/ts3/3"),
+                                    tangos.core.get_or_create_dictionary_item(session, "test_link"), 0.5)
+    session.add(new_link)
+    session.commit()
+    try:
+        updated_graph = link_graph.get_link_graph(session, sim_id)
+        assert updated_graph is not graph
+        assert len(updated_graph.link_id) == len(graph.link_id) + 1
+    finally:
+        session.delete(new_link)
+        session.commit()
+
+    assert len(link_graph.get_link_graph(session, sim_id).link_id) == len(graph.link_id)
+
+def _all_and_weights_using_major_branches(strategy_class, halo, **kwargs):
+    with testing.SqlExecutionTracker() as track:
+        results, weights = strategy_class(halo, **kwargs).all_and_weights()
+    return [r.path for r in results], list(weights), "majorbranches" in track
+
+def test_major_branches():
+    from tangos.relation_finding import major_branch
+    session = tangos.get_default_session()
+    sim = tangos.get_simulation("sim")
+    halos = tangos.get_timestep("sim/ts1").halos.all() + tangos.get_timestep("sim/ts2").halos.all() + \
+            tangos.get_timestep("sim/ts3").halos.all()
+    cases = [(halo_finding.MultiHopMajorProgenitorsStrategy, {'include_startpoint': True}),
+             (halo_finding.MultiHopMajorDescendantsStrategy, {'include_startpoint': True}),
+             (halo_finding.MultiHopMajorProgenitorsStrategy, {'target': tangos.get_timestep("sim/ts1")}),
+             (halo_finding.MultiHopMajorDescendantsStrategy, {'nhops_max': 1})]
+
+    expected = {(i, halo.id): _all_and_weights_using_major_branches(strategy_class, halo, **kwargs)
+                for i, (strategy_class, kwargs) in enumerate(cases) for halo in halos}
+    assert not any(result[2] for result in expected.values())
+
+    num_objects = sum(ts.objects.count() for ts in sim.timesteps)
+    # every object is stored once per direction, however many branches pass through it
+    assert major_branch.build_major_branches(session, sim, major_branch.PROGENITORS) == num_objects
+    assert major_branch.build_major_branches(session, sim, major_branch.DESCENDANTS) == num_objects
+    try:
+        for i, (strategy_class, kwargs) in enumerate(cases):
+            for halo in halos:
+                results = _all_and_weights_using_major_branches(strategy_class, halo, **kwargs)
+                assert results[2]
+                assert results[0] == expected[i, halo.id][0]
+                np.testing.assert_allclose(results[1], expected[i, halo.id][1])
+
+        # links within other simulations leave the branches valid
+        other_link = tangos.core.HaloLink(tangos.get_halo("sim2/ts1/1"), tangos.get_halo("sim2/ts2/2"),
+                                          tangos.core.get_or_create_dictionary_item(session, "test_link"), 0.5)
+        session.add(other_link)
+        session.commit()
+        try:
+            assert _all_and_weights_using_major_branches(halo_finding.MultiHopMajorDescendantsStrategy, halos[0])[2]
+        finally:
+            session.delete(other_link)
+            session.commit()
+
+        # non-default parameters can't be answered from the precomputed branches
+        assert not _all_and_weights_using_major_branches(halo_finding.MultiHopMajorDescendantsStrategy, halos[0],
+                                                         min_onehop_weight=0.5)[2]
+
+        # nor can anything once new links have been added
+        new_link = tangos.core.HaloLink(tangos.get_halo("sim/ts1/1"), tangos.get_halo("sim/ts3/3"),
+                                        tangos.core.get_or_create_dictionary_item(session, "test_link"), 0.5)
+        session.add(new_link)
+        session.commit()
+        try:
+            assert not _all_and_weights_using_major_branches(halo_finding.MultiHopMajorDescendantsStrategy,
+                                                             halos[0])[2]
+        finally:
+            session.delete(new_link)
+            session.commit()
+
+        # or removed, even if they were not the most recent
+        old_link = session.query(tangos.core.HaloLink).order_by(tangos.core.HaloLink.id).first()
+        old_link_args = (old_link.halo_from, old_link.halo_to, old_link.relation, old_link.weight)
+        session.delete(old_link)
+        session.commit()
+        try:
+            assert not _all_and_weights_using_major_branches(halo_finding.MultiHopMajorDescendantsStrategy,
+                                                             halos[0])[2]
+        finally:
+            session.add(tangos.core.HaloLink(*old_link_args))
+            session.commit()
+    finally:
+        major_branch.clear_major_branches(session, sim)
+
+    assert not _all_and_weights_using_major_branches(halo_finding.MultiHopMajorProgenitorsStrategy, halos[-1])[2]
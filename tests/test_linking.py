@@ -56,6 +56,39 @@ def test_crosslinking():
     with assert_raises(live_calculation.NoResultsError):
         result = db.get_halo('dummy_sim_2/step.3/1').calculate('match("dummy_sim_1").dbid()')
 
+def test_single_pass_linking():
+    # handlers without a single-pass implementation fall back to matching each direction separately
+    handler = output_testing.TestInputHandler("dummy_sim_1")
+    forward, backward = handler.match_objects_bidirectional("step.1", "step.2", 0, None)
+    assert forward == handler.match_objects("step.1", "step.2", 0, None)
+    assert backward == handler.match_objects("step.2", "step.1", 0, None)
+
+    cl = crosslink.CrossLinker()
+    cl.parse_command_line(["--single-pass", "--contiguous", "dummy_sim_1/step.1", "dummy_sim_2/step.2"])
+    assert cl.args.single_pass and cl.args.contiguous
+    with log.LogCapturer():
+        cl.run_calculation_loop()
+
+    h1, h2 = db.get_halo("dummy_sim_1/step.1/2"), db.get_halo("dummy_sim_2/step.2/2")
+    assert {l.halo_to for l in h1.links} >= {h2, db.get_halo("dummy_sim_2/step.2/3")}
+    assert h1 in {l.halo_to for l in h2.links}
+
+def test_contiguous_linking_reuses_snapshots(monkeypatch):
+    loaded = []
+    original_load = output_testing.TestInputHandler.load_timestep_without_caching
+    def load_timestep_without_caching(self, ts_extension, mode=None):
+        loaded.append(ts_extension)
+        return original_load(self, ts_extension, mode)
+    monkeypatch.setattr(output_testing.TestInputHandler, "load_timestep_without_caching",
+                        load_timestep_without_caching)
+
+    tl = crosslink.TimeLinker()
+    tl.parse_command_line(["--contiguous", "--force", "--sims", "dummy_sim_2"])
+    with log.LogCapturer():
+        tl.run_calculation_loop()
+    assert sorted(loaded) == ["step.1", "step.2", "step.3"] # step.2 is shared between the two pairs
+    assert db.get_halo("dummy_sim_2/step.2/1").next == db.get_halo("dummy_sim_2/step.3/1")
+
 
 def test_link_repr():
     h1 = db.get_halo('dummy_sim_1/step.1/1')
@@ -279,3 +279,109 @@ def test_non_existent_redirection_multihalo():
     vals1, vals2 = tangos.get_timestep("sim/ts3").calculate_all("BH_mass","later(1).BH_mass")
     assert len(vals1)==0
     assert len(vals2)==0
+
+def test_cache_index_sees_new_properties():
+    h = tangos.get_halo("sim/ts2/1")
+    getter = extraction_patterns.HaloPropertyValueGetter()
+    name = tangos.core.dictionary.get_or_create_dictionary_item(tangos.get_default_session(),
+                                                                "dummy_property_index_test")
+    tangos.get_default_session().commit()
+    assert not getter.cache_contains(h, name.id)
+    h["dummy_property_index_test"] = 5.0
+    assert getter.cache_contains(h, name.id)
+    assert getter.get_from_cache(h, name.id) == [5.0]
+
+def _supplemented_halos(calculation, timestep):
+    # use a fresh session, so that the supplemented query populates the properties of the halos
+    session = tangos.core.Session()
+    query = session.query(tangos.core.halo.SimulationObjectBase).filter_by(timestep_id=timestep.id)
+    return calculation.supplement_halo_query(query).all()
+
+def test_scalar_column_extraction():
+    ts = tangos.get_timestep("sim/ts1")
+    calculation = lc.parser.parse_property_names("BH_mass")
+    halos = _supplemented_halos(calculation, ts)
+
+    (values, present), _ = calculation.calculations[0].scalar_column_and_description(halos)
+    assert values.dtype == np.float64
+    assert (present == [False, False, True, True]).all()
+    assert (values == [1000.0, 900.0]).all()
+
+    typed = calculation.values_sanitized(halos)
+    generic = lc.Calculation.values_sanitized(calculation, halos)
+    assert len(typed) == len(generic) == 1
+    assert typed[0].dtype == generic[0].dtype
+    assert (typed[0] == generic[0]).all()
+
+def test_scalar_column_not_used_for_arrays():
+    ts = tangos.get_timestep("sim/ts1")
+    calculation = lc.parser.parse_property_names("dummy_property_3", "dummy_property_1")
+    halos = _supplemented_halos(calculation, ts)
+    assert calculation.calculations[1].scalar_column_and_description(halos) == (None, None)
+    dp3, dp1 = calculation.values_sanitized(halos)
+    assert (dp3 == [-2.5]).all()
+    assert (dp1 == np.arange(0,100.0)).all()
+
+def test_columnar_arithmetic():
+    ts = tangos.get_timestep("sim/ts1")
+    calculation = lc.parser.parse_property_names("BH_mass*2", "BH_mass>950")
+    halos = _supplemented_halos(calculation, ts)
+
+    column, _ = calculation.calculations[0].masked_column_and_description(halos)
+    assert (column.mask == [True, True, False, False]).all()
+    assert (column.compressed() == [2000.0, 1800.0]).all()
+
+    per_halo_values, _ = lc.LiveProperty.values_and_description(calculation.calculations[0], halos)
+    columnar_values, _ = calculation.calculations[0].values_and_description(halos)
+    assert list(per_halo_values[0]) == list(columnar_values[0])
+    assert [type(x) for x in per_halo_values[0]] == [type(x) for x in columnar_values[0]]
+
+    doubled, greater = calculation.values_sanitized(halos)
+    assert doubled.dtype == np.float64 and (doubled == [2000.0, 1800.0]).all()
+    assert greater.dtype == np.bool_ and (greater == [True, False]).all()
+
+def test_columnar_arithmetic_fallback():
+    ts = tangos.get_timestep("sim/ts1")
+    calculation = lc.parser.parse_property_names("dummy_property_1*2")
+    halos = _supplemented_halos(calculation, ts)
+    assert calculation.calculations[0].masked_column_and_description(halos) == (None, None)
+    values, = calculation.values_sanitized(halos)
+    assert (values[0] == np.arange(0,200.0,2.0)).all()
+
+def test_parse_cache_returns_independent_copies():
+    lc.parser.clear_cache()
+    first = lc.parser.parse_property_name("raw(dummy_property_1)")
+    second = lc.parser.parse_property_name("raw(dummy_property_1)")
+    assert lc.parser._cache.misses == 1 and lc.parser._cache.hits == 1
+    assert first is not second and first._inputs[0] is not second._inputs[0]
+    assert str(first) == str(second)
+
+    first._inputs[0].set_extraction_pattern(extraction_patterns.HaloPropertyValueGetter())
+    assert isinstance(lc.parser.parse_property_name("raw(dummy_property_1)")._inputs[0]._extraction_pattern,
+                      extraction_patterns.HaloPropertyRawValueGetter)
+
+def test_parse_cache_regenerates_builtin_initialisation():
+    lc.parser.clear_cache()
+    first = lc.parser.parse_property_name("link(BH, BH_mass, 'min')")
+    second = lc.parser.parse_property_name("link(BH, BH_mass, 'min')")
+    assert first._func is not second._func
+
+    h = tangos.get_halo("sim/ts1/1")
+    for i in range(2):
+        assert h.calculate("link(BH, BH_mass, 'min').BH_mass") == 900.0
+
+def test_parse_cache_bounded():
+    cache = lc.parser.ParsedExpressionCache(2)
+    cache.get("dummy_property_1")
+    cache.get("dummy_property_2")
+    cache.get("dummy_property_1")
+    cache.get("dummy_property_3")
+    assert len(cache) == 2
+    assert "dummy_property_1" in cache and "dummy_property_3" in cache
+
+def test_parse_cache_prewarm():
+    lc.parser.clear_cache()
+    lc.parser.prewarm(["dummy_property_1/2", "dummy_property_1("])
+    assert "dummy_property_1/2" in lc.parser._cache
+    assert len(lc.parser._cache) == 1
+    assert tangos.get_halo("sim/ts1/1").calculate("dummy_property_1/2")[4] == 2.0
@@ -2,6 +2,7 @@ import warnings
 
 import numpy as np
 import numpy.testing as npt
+import sqlalchemy
 from pytest import raises as assert_raises
 
 import tangos as db
@@ -110,6 +111,34 @@ def test_multi_calculation_link_returned_halo_is_usable():
     all_links = db.get_halo("sim/ts1/1").calculate_for_progenitors('link(testlink)')
     assert all_links[0][0]['testval'] == 1.0
 
+def test_link_returned_halos_loaded_into_session(monkeypatch):
+    monkeypatch.setattr(lc.Calculation, "_refetch_chunk_size", 1)
+    halo = db.get_halo("sim/ts1/1")
+    session = db.core.Session()
+    try:
+        links, values = lc.parser.parse_property_names("link(testlink)", "link(testlink,testval)").\
+            values_sanitized([halo, halo], load_into_session=session)
+        assert [h.path for h in links] == ["sim/ts1/halo_2"]*2
+        assert [h.path for h in values] == ["sim/ts1/halo_4"]*2
+        assert links[0] is links[1]
+        assert all(sqlalchemy.orm.object_session(h) is session for h in (links[0], values[0]))
+    finally:
+        session.close()
+
+def test_nested_link_uses_one_temporary_table():
+    statements = []
+    def record_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+    engine = db.core.get_default_engine()
+    sqlalchemy.event.listen(engine, "before_cursor_execute", record_statement)
+    try:
+        assert db.get_halo("sim/ts1/1").calculate("testlink_univalued.ptcls_in_common.testval") == 2.0
+        assert db.get_timestep("sim/ts1").calculate_all("testlink_univalued.testval",
+                                                        "testlink_univalued.ptcls_in_common.testval") == [[1.0], [2.0]]
+    finally:
+        sqlalchemy.event.remove(engine, "before_cursor_execute", record_statement)
+    assert sum("CREATE TEMPORARY TABLE" in s for s in statements) == 2
+
 def test_unambiguous_link():
     with warnings.catch_warnings(record=True) as w:
         assert db.get_halo("sim/ts1/1").calculate('testlink_univalued.testval')==1.0
@@ -1,6 +1,10 @@
 import os
+import pathlib
+import pickle
 import time
+import weakref
 
+import numpy as np
 import pytest
 
 import tangos
@@ -387,6 +391,120 @@ def test_shared_locks_in_queue():
         else:
             assert False, "Unexpected line in log: "+line
 
+def _test_lock_timeout():
+    if pt.backend.rank()==1:
+        with pt.lock.ExclusiveLock("lock"):
+            pt.barrier()
+            pt.barrier()
+    else:
+        pt.barrier()
+        with pytest.raises(pt.lock.LockTimeout):
+            with pt.lock.ExclusiveLock("lock", timeout=0.1):
+                pass
+        pt_testing.log("timed out")
+        pt.barrier()
+        with pt.lock.ExclusiveLock("lock", timeout=5.0):
+            pt_testing.log("acquired after release")
+
+def test_lock_timeout():
+    pt_testing.initialise_log()
+    pt.use("multiprocessing-3")
+    pt.launch(_test_lock_timeout)
+    assert pt_testing.get_log() == ["[2] timed out", "[2] acquired after release"]
+
+def _test_lock_upgrade(conflict):
+    lock = pt.lock.SharedLock("lock")
+    with lock:
+        pt.barrier() # both processes now share the lock
+        if pt.backend.rank()==1 or conflict:
+            if pt.backend.rank()==2:
+                time.sleep(0.1) # make sure rank 1's upgrade is queued first
+            try:
+                lock.upgrade()
+                pt_testing.log("upgraded")
+            except pt.lock.LockUpgradeConflict:
+                pt_testing.log("upgrade conflict")
+        else:
+            time.sleep(0.1)
+            pt_testing.log("releasing shared lock")
+
+@pytest.mark.parametrize("conflict", (False, True))
+def test_lock_upgrade(conflict):
+    pt_testing.initialise_log()
+    pt.use("multiprocessing-3")
+    pt.launch(_test_lock_upgrade, args=(conflict,))
+    if conflict:
+        assert pt_testing.get_log() == ["[2] upgrade conflict", "[1] upgraded"]
+    else:
+        assert pt_testing.get_log() == ["[2] releasing shared lock", "[1] upgraded"]
+
+def _test_exclusive_lock_not_starved():
+    rank = pt.backend.rank()
+    if rank==1:
+        time.sleep(0.1) # let the sharers get going
+        with pt.lock.ExclusiveLock("lock"):
+            pt_testing.log("exclusive lock acquired")
+    else:
+        # the sharers overlap so that, without fairness, the lock would always be held in shared mode
+        time.sleep(0.01*rank)
+        for i in range(10):
+            with pt.lock.SharedLock("lock"):
+                time.sleep(0.03)
+        pt_testing.log("sharing finished")
+
+def test_exclusive_lock_not_starved():
+    pt_testing.initialise_log()
+    pt.use("multiprocessing-4")
+    pt.launch(_test_exclusive_lock_not_starved)
+    assert pt_testing.get_log()[0] == "[1] exclusive lock acquired"
+
+def _test_sharers_do_not_overtake_exclusive():
+    rank = pt.backend.rank()
+    if rank==1:
+        with pt.lock.ExclusiveLock("lock", 0):
+            pt.barrier()
+            time.sleep(0.3) # the others queue up in the order shared, exclusive, shared
+    else:
+        pt.barrier()
+        time.sleep(0.05*rank)
+        if rank==3:
+            with pt.lock.ExclusiveLock("lock", 0):
+                pt_testing.log("exclusive lock acquired")
+                time.sleep(0.1)
+                pt_testing.log("exclusive lock about to be released")
+        else:
+            with pt.lock.SharedLock("lock", 0):
+                pt_testing.log("shared lock acquired")
+                time.sleep(0.2)
+
+def test_sharers_do_not_overtake_exclusive():
+    pt_testing.initialise_log()
+    pt.use("multiprocessing-5")
+    pt.launch(_test_sharers_do_not_overtake_exclusive)
+    assert pt_testing.get_log() == ["[2] shared lock acquired", "[3] exclusive lock acquired",
+                                    "[3] exclusive lock about to be released", "[4] shared lock acquired"]
+
+def test_lock_wait_statistics():
+    stats = pt.lock.LockWaitStatistics()
+    stats.record("insert_list", 0.0005)
+    stats.record("insert_list", 0.5)
+    stats.record_timeout("insert_list")
+    other = pt.lock.LockWaitStatistics()
+    other.record("insert_list", 20.0)
+    other.record("bh", 0.05)
+    stats.add(other)
+
+    assert stats.counts == {"insert_list": [1, 0, 0, 1, 0, 1, 0], "bh": [0, 0, 1, 0, 0, 0, 0]}
+    assert stats.max_wait["insert_list"] == 20.0
+
+    with tangos.log.LogCapturer() as capturer:
+        stats.report_to_log(logger)
+    report = capturer.get_output_without_timestamps()
+    assert "LOCK WAIT TIMES" in report
+    insert_list_line = [line for line in report.split("\n") if "insert_list" in line][0]
+    assert insert_list_line.split() == ["insert_list", "3", "6.833s", "20.000s", "|", "1", "0", "0", "1", "0", "1", "0",
+                                        "|", "1", "timed", "out"]
+
 class ErrorOnServer(pt.message.Message):
     def process(self):
         raise RuntimeError("Error on server")
@@ -432,6 +550,40 @@ def test_remote_set():
     pt.use("multiprocessing-3")
     pt.launch(_test_remote_set)
 
+def _test_numpy_array_transfer():
+    from tangos.parallel_tasks.backends import multiprocessing as mp_backend
+    small = np.arange(10.0)
+    large = np.arange(200000.0).reshape((-1, 2))[::2] # not contiguous
+    # rank 2 must have received all messages from the server before it is sent arrays, which Message.receive would
+    # not be expecting; the handshake below uses only numpy array messages, which are not received by Message.receive
+    pt.barrier()
+    if pt.backend.rank()==1:
+        mp_backend.receive_numpy_array(2)
+        mp_backend.send_numpy_array(small, 2)
+        mp_backend.send_numpy_array(large, 2)
+        pt.barrier()
+    elif pt.backend.rank()==2:
+        mp_backend.send_numpy_array(small, 1)
+        received_small = mp_backend.receive_numpy_array(1)
+        received_large = mp_backend.receive_numpy_array(1)
+        assert (received_small == small).all()
+        assert (received_large == large).all()
+        # only the large array goes through shared memory, which is closed once no array refers to it
+        assert isinstance(received_large.base, mp_backend._SegmentArray)
+        assert not isinstance(received_small.base, mp_backend._SegmentArray)
+        segment = weakref.ref(received_large.base.segment)
+        view = received_large[10:]
+        del received_large
+        assert (view == large[10:]).all()
+        assert segment() is not None
+        del view
+        assert segment() is None
+        pt.barrier()
+
+def test_numpy_array_transfer():
+    pt.use("multiprocessing-3")
+    pt.launch(_test_numpy_array_transfer)
+
 def test_local_set():
     set = pt.shared_set.SharedSet("test_local_set")
     assert not set.add_if_not_exists("foo")
@@ -483,3 +635,171 @@ def test_iteration_state_from_string():
     assert iteration_state2.next_job(0) == 1
     assert iteration_state2.next_job(0) == 3
     assert iteration_state2.next_job(0) == 4
+
+def test_resume_journal(tmp_path):
+    from tangos.parallel_tasks import resume_journal
+    from tangos.parallel_tasks.jobs import IterationState
+
+    journal = resume_journal.ResumeJournal(tmp_path)
+    journal.min_compaction_bytes = 0
+    state_a = IterationState(("a", 0, 300), [False]*300, backend_size=2)
+    state_b = IterationState(("b", 0, 5), [False]*5, backend_size=2)
+
+    def complete(state, job):
+        state._jobs_complete[job] = True
+        journal.record_complete(state._context, state._jobs_complete, [job])
+
+    # interleaved completions from concurrent iterations
+    for job in range(3):
+        complete(state_a, job)
+        complete(state_b, job)
+    assert resume_journal.read_all_journals(tmp_path) == {state_a._context: state_a._jobs_complete,
+                                                          state_b._context: state_b._jobs_complete}
+
+    # the journal is compacted once the completion records outgrow the state records
+    for job in range(3, 300):
+        complete(state_a, job)
+    with open(journal.path, 'rb') as f:
+        num_records = 0
+        while f.read(1):
+            f.seek(-1, os.SEEK_CUR)
+            pickle.load(f)
+            num_records += 1
+    assert num_records < 100
+    assert resume_journal.read_all_journals(tmp_path)[state_a._context] == [True]*300
+
+    # a record truncated by the process being killed is ignored
+    complete(state_b, 3)
+    journal.close()
+    with open(journal.path, 'r+b') as f:
+        f.truncate(journal.path.stat().st_size - 2)
+    assert resume_journal.read_all_journals(tmp_path)[state_b._context] == [True]*3 + [False]*2
+
+    # a later journal takes precedence over an earlier one
+    later_journal = resume_journal.ResumeJournal(tmp_path)
+    later_journal.record_complete(state_b._context, [True]*5, [4])
+    assert later_journal.path.name > journal.path.name
+    assert resume_journal.read_all_journals(tmp_path)[state_b._context] == [True]*5
+
+    # a finished iteration is forgotten by the journal, even once compacted, but remains complete on replay
+    later_journal.record_finished(state_b._context, later_journal._jobs_complete[state_b._context])
+    later_journal.compact()
+    assert state_b._context not in later_journal._jobs_complete
+    assert resume_journal.read_all_journals(tmp_path)[state_b._context] == [True]*5
+    later_journal.close()
+
+def test_resume_journal_folder_and_legacy_state(tmp_path, monkeypatch):
+    from tangos.parallel_tasks import resume_journal
+    from tangos.parallel_tasks.jobs import IterationState
+    monkeypatch.setenv("HOME", str(tmp_path))
+    monkeypatch.setattr(resume_journal, "_legacy_states", None)
+
+    # journals are kept in the home folder for every backend, including sqlite
+    folder = resume_journal.journal_folder()
+    assert folder.parent == tmp_path / ".tangos_resume_state"
+    assert not pathlib.Path(tangos.core.get_default_session().bind.url.database + ".resume").exists()
+
+    # state written by earlier versions is still found
+    legacy_state = IterationState(("legacy", 0, 3), [True, False, True], backend_size=2)
+    with open(folder.parent / "tangos_resume_state_000000.pickle", "wb") as f:
+        pickle.dump({legacy_state._context: legacy_state.to_string()}, f)
+    assert resume_journal.read_all_journals()[legacy_state._context] == [True, False, True]
+
+    IterationState.clear_resume_state()
+    assert resume_journal.legacy_files() == []
+    assert legacy_state._context not in resume_journal.read_all_journals()
+
+def test_chunked_iteration_state():
+    from tangos.parallel_tasks.jobs import ChunkedIterationState
+
+    iteration_state = ChunkedIterationState.from_context(100, backend_size=3)
+    assert iteration_state.next_jobs(1) == [0] # no timing information yet
+    assert iteration_state.next_jobs(2) == [1]
+
+    # jobs are so long that one per chunk is appropriate
+    assert iteration_state.next_jobs(1, mean_job_duration=10.0) == [2]
+    # chunk is capped at the rank's share of half the remaining jobs (97 // 4)
+    assert iteration_state.next_jobs(2, mean_job_duration=1e-6) == list(range(3, 27))
+    assert iteration_state.count_complete() == 2
+    # chunk is sized to take about config.parallel_job_chunk_seconds
+    assert len(iteration_state.next_jobs(1, mean_job_duration=tangos.config.parallel_job_chunk_seconds/10)) == 10
+    assert iteration_state.count_complete() == 3
+
+    # as the loop nears its end, chunks shrink to single jobs
+    chunk_lengths = []
+    while (jobs := iteration_state.next_jobs(2, mean_job_duration=1e-6)) is not None:
+        chunk_lengths.append(len(jobs))
+    assert chunk_lengths[-1] == 1
+    assert chunk_lengths == sorted(chunk_lengths, reverse=True)
+    assert sum(chunk_lengths) == 63
+    assert not iteration_state.finished()
+    assert iteration_state.next_jobs(1) is None
+    assert iteration_state.count_complete() == 100
+    assert iteration_state.finished()
+
+def test_chunked_iteration_state_resumes():
+    from tangos.parallel_tasks.jobs import ChunkedIterationState
+
+    iteration_state = ChunkedIterationState.from_context(50, backend_size=2)
+    assert iteration_state.next_jobs(1) == [0]
+    assert iteration_state.next_jobs(1, mean_job_duration=1e-6) == list(range(1, 25)) # never completed
+
+    iteration_state2 = ChunkedIterationState.from_string(iteration_state.to_string(), backend_size=2)
+    assert iteration_state2.count_complete() == 1
+    assert iteration_state2.next_jobs(1) == [1]
+
+def _add_property_chunked():
+    for i in pt.distributed(list(range(1,10)), chunked=True):
+        with pt.ExclusiveLock('insert', 0.05):
+            tangos.get_halo(i)['my_test_property_chunked']=i
+            tangos.core.get_default_session().commit()
+
+def test_add_property_chunked():
+    pt.use("multiprocessing-3")
+    pt.launch(_add_property_chunked)
+    for i in range(1,10):
+        assert tangos.get_halo(i)['my_test_property_chunked']==i
+
+def _add_property_contiguous():
+    for i in pt.distributed(list(range(1,10)), contiguous=True):
+        with pt.ExclusiveLock('insert', 0.05):
+            tangos.get_halo(i)['my_test_property_contiguous']=i
+            tangos.core.get_default_session().commit()
+
+def test_add_property_contiguous():
+    pt.use("multiprocessing-3")
+    pt.launch(_add_property_contiguous)
+    for i in range(1,10):
+        assert tangos.get_halo(i)['my_test_property_contiguous']==i
+
+def test_contiguous_iteration_state():
+    from tangos.parallel_tasks.jobs import ContiguousIterationState
+
+    iteration_state = ContiguousIterationState.from_context(10, backend_size=3)
+    assert iteration_state.next_job(1) == 0
+    assert iteration_state.next_job(2) == 5 # starts in the middle of the remaining jobs
+    assert iteration_state.next_job(1) == 1
+    assert iteration_state.next_job(2) == 6
+    assert iteration_state.next_job(2) == 7
+    assert iteration_state.next_job(2) == 8
+    assert iteration_state.next_job(2) == 9
+    assert iteration_state.next_job(2) == 3 # splits the remaining jobs 2,3,4 with rank 1, which continues to 2
+    assert iteration_state.next_job(1) == 2
+    assert iteration_state.next_job(1) == 4 # job 3 is running on rank 2
+    assert iteration_state.next_job(2) is None
+    assert iteration_state.next_job(1) is None
+    assert iteration_state.count_complete() == 10
+    assert iteration_state.finished()
+
+def test_contiguous_iteration_state_resumes():
+    from tangos.parallel_tasks.jobs import ContiguousIterationState
+
+    iteration_state = ContiguousIterationState.from_context(6, backend_size=2)
+    assert iteration_state.next_job(1) == 0
+    assert iteration_state.next_job(1) == 1
+    assert iteration_state.next_job(1) == 2 # never completed
+
+    iteration_state2 = ContiguousIterationState.from_string(iteration_state.to_string(), backend_size=2)
+    assert iteration_state2.count_complete() == 2
+    assert iteration_state2.next_job(1) == 2
+    assert [iteration_state2.next_job(1) for i in range(4)] == [3, 4, 5, None]
@@ -2,10 +2,16 @@ import time
 
 import pytest
 
+import tangos.config
 from tangos import parallel_tasks as pt
 from tangos.parallel_tasks import async_message, message, testing
 
 
+@pytest.fixture(autouse=True)
+def async_processing(monkeypatch):
+    monkeypatch.setattr(tangos.config, 'enable_async_message_processing', True)
+
+
 class Response(message.Message):
     pass
 
@@ -15,10 +21,24 @@ class SlowProcessingMessage(async_message.AsyncProcessedMessage):
         time.sleep(0.1)
         Response("slow").send(self.source)
 
+class FastAsyncProcessingMessage(async_message.AsyncProcessedMessage):
+    def process_async(self):
+        Response("fast async").send(self.source)
+
+class FastProcessingOnOtherQueueMessage(FastAsyncProcessingMessage):
+    processing_queue = 'other'
+
 class FastProcessingMessage(message.Message):
     def process(self):
         Response("fast").send(self.source)
 
+class FailingAsyncMessage(async_message.AsyncProcessedMessage):
+    def process_async(self):
+        raise ValueError("Failure in async message")
+
+class FailingAsyncMessageWithoutResponse(FailingAsyncMessage):
+    expects_response = False
+
 def _test_async_message():
     SlowProcessingMessage().send(0)
     FastProcessingMessage().send(0)
@@ -30,7 +50,47 @@ def _test_async_message():
     assert msg.contents == "slow"
 
 
-@pytest.mark.skip("Async processing is currently switched off")
 def test_async_message():
     pt.use('multiprocessing-2')
     pt.launch(_test_async_message)
+
+def _test_async_message_ordering():
+    SlowProcessingMessage().send(0)
+    FastAsyncProcessingMessage().send(0)
+    FastProcessingOnOtherQueueMessage().send(0)
+    # messages on the same queue are processed in order, but those on another queue need not wait
+    assert [Response.receive(0).contents for i in range(3)] == ["fast async", "slow", "fast async"]
+
+def test_async_message_ordering():
+    pt.use('multiprocessing-2')
+    pt.launch(_test_async_message_ordering)
+
+def _test_lock_not_held_up():
+    SlowProcessingMessage().send(0)
+    # the grant must arrive before the slow response, which would otherwise be received in its place
+    with pt.ExclusiveLock("lock"):
+        pass
+    assert Response.receive(0).contents == "slow"
+
+def test_lock_not_held_up():
+    pt.use('multiprocessing-2')
+    pt.launch(_test_lock_not_held_up)
+
+def _test_async_message_exception():
+    FailingAsyncMessage().send(0)
+    with pytest.raises(ValueError, match="Failure in async message"):
+        Response.receive(0)
+
+def test_async_message_exception():
+    pt.use('multiprocessing-2')
+    pt.launch(_test_async_message_exception)
+
+def _test_async_message_exception_without_response():
+    FailingAsyncMessageWithoutResponse().send(0)
+    # the exception must not be delivered in place of an unrelated message
+    FastAsyncProcessingMessage().send(0)
+    assert Response.receive(0).contents == "fast async"
+
+def test_async_message_exception_without_response():
+    pt.use('multiprocessing-2')
+    pt.launch(_test_async_message_exception_without_response)
@@ -193,6 +193,28 @@ def test_calculate_for_progenitors_bh():
     objs, = h.calculate_for_progenitors("dbid()")
     testing.assert_halolists_equal(objs, ['sim/ts3/BH_1', 'sim/ts2/BH_1', 'sim/ts1/BH_1'])
 
+def test_calculate_for_progenitors_all():
+    ts = tangos.get_timestep("sim/ts3")
+    mvir, objs = ts.calculate_for_progenitors_all("Mvir", "dbid()", object_type='halo')
+    assert mvir.shape == objs.shape == (3, 3)
+    for halo, mvir_row, objs_row in zip(ts.halos, mvir, objs):
+        npt.assert_equal(mvir_row.compressed(), halo.calculate_for_progenitors("Mvir")[0])
+        testing.assert_halolists_equal(objs_row.compressed(), halo.calculate_for_progenitors("dbid()")[0])
+
+def test_calculate_for_descendants_all_is_padded():
+    mvir, = tangos.get_timestep("sim/ts1").calculate_for_descendants_all("Mvir", object_type='halo')
+    assert mvir.dtype == np.int64
+    npt.assert_equal(mvir.filled(-1), [[1, 5, 9, -1, -1],
+                                       [2, 6, 10, -1, -1],
+                                       [3, 7, 11, -1, -1],
+                                       [4, 8, -1, -1, -1]])
+
+def test_calculate_for_progenitors_all_arrays():
+    test_array, = tangos.get_timestep("sim/ts3").calculate_for_progenitors_all("test_array", object_type='BH')
+    assert test_array.shape == (4, 3)
+    assert test_array.mask.tolist() == [[False, False, False]] + [[False, True, True]]*3
+    npt.assert_equal(test_array[0, 2], [1.0, 2.0, 3.0])
+
 def test_match_gather():
     ts1_halos, ts3_halos = tangos.get_timestep("sim/ts1").calculate_all('dbid()', 'match("sim/ts3").dbid()')
     testing.assert_halolists_equal(ts1_halos, ['sim/ts1/1','sim/ts1/2','sim/ts1/3', 'sim/ts1/1.1'])
@@ -270,3 +292,48 @@ def test_missing_or_broken_class():
         brokenclass, = ts.calculate_all("brokenproperty")
     npt.assert_allclose(noclass, [0., 10., 20., 30.])
     assert len(w)>0
+
+def _calculate_all_without_scalar_query(monkeypatch, ts, *args, **kwargs):
+    with monkeypatch.context() as m:
+        m.setattr(tangos.live_calculation.query_scalar_columns.QueryScalarColumns, "calculate",
+                  lambda *args, **kwargs: None)
+        return ts.calculate_all(*args, **kwargs)
+
+def test_calculate_all_scalar_query(monkeypatch):
+    ts = tangos.get_timestep("sim/ts2")
+    for kwargs in ({}, {'limit': 2}, {'order_by_halo_number': True}, {'object_typetag': 'BH'}):
+        for names in (("Mvir", "Rvir"), ("hole_mass",), ("hole_mass", "Mvir")):
+            query = tangos.live_calculation.parser.parse_property_names(*names)
+            scalar_query = tangos.live_calculation.query_scalar_columns.QueryScalarColumns(
+                query, ts, tangos.get_default_session())
+            assert scalar_query.calculate() is not None or names==("hole_mass", "Mvir")
+
+            fast_results = ts.calculate_all(*names, **kwargs)
+            general_results = _calculate_all_without_scalar_query(monkeypatch, ts, *names, **kwargs)
+            assert len(fast_results) == len(general_results)
+            for fast, general in zip(fast_results, general_results):
+                assert len(fast) == len(general)
+                if len(fast)>0:
+                    assert fast.dtype == general.dtype
+                npt.assert_equal(fast, general)
+
+def test_calculate_all_scalar_query_fallback():
+    ts = tangos.get_timestep("sim/ts1")
+    query = tangos.live_calculation.parser.parse_property_names("hole_mass", "test_array")
+    assert tangos.live_calculation.query_scalar_columns.QueryScalarColumns(
+        query, ts, tangos.get_default_session()).calculate() is None
+    query = tangos.live_calculation.parser.parse_property_names("Mvir", "RvirPlusMvir()")
+    assert tangos.live_calculation.query_scalar_columns.QueryScalarColumns(
+        query, ts, tangos.get_default_session()).calculate() is None
+
+    hole_mass, test_array = ts.calculate_all("hole_mass", "test_array")
+    npt.assert_allclose(hole_mass, [100., 200., 300., 400.])
+    assert test_array.shape == (4,3)
+
+def test_calculate_all_scalar_query_does_not_load_halos():
+    ts = tangos.get_timestep("sim/ts1")
+    with testing.SqlExecutionTracker(db.core.get_default_engine()) as track:
+        Mvir, Rvir = ts.calculate_all("Mvir", "Rvir")
+    npt.assert_allclose(Mvir, [1, 2, 3, 4])
+    npt.assert_allclose(Rvir, [0.1, 0.2, 0.3, 0.4])
+    assert "outer join" not in track # the supplemented halo query should not have been made
@@ -199,6 +199,25 @@ def test_no_repeat_failing_queries(mode):
     assert "processing 3 array fetches" in log
     # = 1 attempt to get on the simulation, 1 attempt to get at family level, then a final request for pos
 
+@using_parallel_tasks
+def _test_prefetch_arrays():
+    ts = handler.load_timestep("tiny.000640", mode='server')
+    f = handler.load_object("tiny.000640", 0, 0, 'halo', mode='server')
+    f.prefetch_arrays(['pos', 'vel', 'mass', 'iord', 'rho', 'nonexistent', 'r'])
+    assert all(name in f.keys() for name in ('pos', 'vel', 'mass', 'iord'))
+    assert 'rho' in f.gas.keys()
+
+    f_local = handler.load_object("tiny.000640", 0, 0, 'halo', mode=None)
+    for name in ('pos', 'vel', 'mass', 'iord'):
+        npt.assert_almost_equal(f[name], f_local[name], decimal=4)
+    npt.assert_almost_equal(f.gas['rho'], f_local.gas['rho'], decimal=4)
+    f.prefetch_arrays(['pos', 'vel']) # already present, so no further request is made
+    ts.disconnect()
+
+def test_prefetch_arrays():
+    log = _test_prefetch_arrays()
+    assert "processing 1 array fetches" in log
+
 @pynbody.snapshot.tipsy.TipsySnap.derived_quantity
 def tipsy_specific_derived_array(sim):
     """Test derived array to ensure format-specific derived arrays are available"""
@@ -259,6 +278,19 @@ def test_region_loading(mode, expected_number_of_queries):
     else:
         assert "Building KDTree" not in log
 
+def test_region_loading_with_saved_kdtree(tmp_path):
+    old_directory = tangos.config.kdtree_cache_directory
+    tangos.config.kdtree_cache_directory = str(tmp_path)
+    try:
+        log = _test_region_loading('server-shared-mem', 100000)
+        assert "Saved KDTree" in log
+        # a new server should memory-map the tree, and pass the files rather than shared memory to its clients
+        log = _test_region_loading('server-shared-mem', 100000)
+        assert "Memory-mapped saved KDTree" in log
+        assert "Saved KDTree" not in log
+    finally:
+        tangos.config.kdtree_cache_directory = old_directory
+
 @using_parallel_tasks
 def test_oserror_on_nonexistent_file():
     with npt.assert_raises(OSError):
@@ -427,3 +459,110 @@ def test_server_generates_portable_catalogue():
 def test_portable_catalogue_generated_only_once():
     log = test_server_generates_portable_catalogue() # runs on two processes, should only get one cat
     assert log.count("Generating a shared object catalogue for 'halo's") == 1
+
+
+class _QueueRecordingNotifications(ps.snapshot_queue.PynbodySnapshotQueue):
+    def __init__(self):
+        super().__init__()
+        self.notifications = []
+
+    def _notify_available(self, node):
+        self.notifications.append((node, self.current_timestep))
+
+    def _notify_unavailable(self, node):
+        self.notifications.append((node, None))
+
+@pytest.fixture
+def prefetch_enabled(monkeypatch):
+    monkeypatch.setattr(tangos.config, 'pynbody_server_prefetch_depth', 1)
+    monkeypatch.setattr(tangos.config, 'pynbody_server_memory_budget', 8*1024**3)
+
+def test_snapshot_queue_prefetch_and_retain(prefetch_enabled):
+    queue = _QueueRecordingNotifications()
+    queue.add(1, handler, "tiny.000640")
+    queue.current_snapshot['pos']
+
+    queue.add(2, handler, "tiny.000832")
+    assert queue.notifications == [(1, "tiny.000640")]
+    assert len(queue.prefetched) == 1 # read in the background while client 1 is still working
+    list(queue.prefetched.values())[0].result()
+
+    first_snapshot = queue.current_snapshot
+    queue.free(1)
+    assert queue.notifications[-1] == (2, "tiny.000832")
+    assert len(queue.prefetched) == 0
+    assert 'pos' in queue.current_snapshot.keys() # arrays used in the previous snapshot are also read in advance
+    assert list(queue.retained.values()) == [first_snapshot]
+
+    queue.add(1, handler, "tiny.000640")
+    queue.free(2)
+    assert queue.notifications[-1] == (1, "tiny.000640")
+    assert queue.current_snapshot is first_snapshot
+
+def test_snapshot_queue_prefetch_leaves_cached_timestep_alone(prefetch_enabled):
+    cached_snapshot = handler.load_timestep("tiny.000832")
+    queue = _QueueRecordingNotifications()
+    queue.add(1, handler, "tiny.000640")
+    queue.add(2, handler, "tiny.000832", shared_mem=True)
+    prefetched_snapshot = list(queue.prefetched.values())[0].result()
+
+    # the prefetch reads its own copy in shared memory mode, rather than modifying the copy in use elsewhere
+    assert prefetched_snapshot is not cached_snapshot
+    assert not getattr(cached_snapshot, '_shared_arrays', False)
+
+    queue.free(1)
+    assert queue.current_snapshot is prefetched_snapshot
+    assert handler.load_timestep("tiny.000832") is prefetched_snapshot
+
+def test_snapshot_queue_off_by_default():
+    queue = _QueueRecordingNotifications()
+    queue.add(1, handler, "tiny.000640")
+    queue.add(2, handler, "tiny.000832")
+    assert len(queue.prefetched) == 0
+    queue.free(1)
+    assert len(queue.retained) == 0
+    assert queue.notifications == [(1, "tiny.000640"), (2, "tiny.000832")]
+
+def test_snapshot_queue_memory_budget(prefetch_enabled, monkeypatch):
+    queue = _QueueRecordingNotifications()
+    queue.add(1, handler, "tiny.000640")
+    queue.current_snapshot['pos']
+    snapshot_nbytes = ps.snapshot_queue._snapshot_nbytes(queue.current_snapshot)
+
+    # a prefetch is expected to occupy as much memory as the current snapshot, so is not started if that would exceed
+    # the budget
+    monkeypatch.setattr(tangos.config, 'pynbody_server_memory_budget', snapshot_nbytes-1)
+    queue.add(2, handler, "tiny.000832")
+    assert len(queue.prefetched) == 0
+
+    queue.free(1)
+    assert queue.notifications == [(1, "tiny.000640"), (2, "tiny.000832")]
+
+def test_snapshot_queue_prefetch_failure(prefetch_enabled):
+    queue = _QueueRecordingNotifications()
+    queue.add(1, handler, "tiny.000640")
+    queue.add(2, handler, "nonexistent")
+    queue.free(1)
+    assert queue.notifications == [(1, "tiny.000640"), (2, None)]
+
+def test_subsnap_cache():
+    f = handler.load_timestep("tiny.000640")
+    spheres = [pynbody.filt.Sphere('%d kpc'%r) for r in (3000, 4000, 5000)]
+    sizes = [len(f[s])*np.dtype(np.int64).itemsize for s in spheres]
+
+    cache = ps.snapshot_queue.SubsnapCache(max_bytes=sizes[0]+sizes[2])
+    assert cache.get(spheres[0], lambda: f[spheres[0]]) is cache.get(spheres[0], lambda: None)
+    cache.get(spheres[1], lambda: f[spheres[1]])
+    assert cache.nbytes == sizes[0]+sizes[1]
+    cache.get(spheres[0], lambda: None) # now the most recently used
+    cache.get(spheres[2], lambda: f[spheres[2]])
+
+    assert spheres[0] in cache and spheres[2] in cache and spheres[1] not in cache
+    assert cache.nbytes == sizes[0]+sizes[2]
+    assert (cache.hits, cache.misses, cache.evictions) == (2, 3, 1)
+    assert "2 subsnap cache hits, 3 misses, 1 evictions" in cache.statistics_summary()
+
+    # a subsnap is always retained while it is the most recently used, even if it alone exceeds the budget
+    cache = ps.snapshot_queue.SubsnapCache(max_bytes=0)
+    subsnap = cache.get(spheres[0], lambda: f[spheres[0]])
+    assert len(cache) == 1 and cache.get(spheres[0], lambda: None) is subsnap
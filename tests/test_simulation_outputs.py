@@ -1,5 +1,8 @@
 import gc
 import os
+import pathlib
+import threading
+import time
 
 import numpy as np
 import numpy.testing as npt
@@ -98,6 +101,60 @@ def test_partial_load_halo():
     assert len(pynbody_h) == 200
     assert pynbody_h.ancestor is pynbody_h
 
+def test_partial_load_halo_with_membership_index(tmp_path):
+    from tangos.util import membership_index
+    old_directory = config.halo_membership_index_directory
+    expected = output_manager.load_object("tiny.000640", 0, 0, mode='partial')
+    config.halo_membership_index_directory = str(tmp_path)
+    try:
+        pynbody_h = output_manager.load_object("tiny.000640", 0, 0, mode='partial')
+        assert (pynbody_h['iord'] == expected['iord']).all()
+        assert len(list(tmp_path.glob("*.meta"))) == 1
+
+        # a fresh process should take the membership from the index, without the halo catalogue
+        membership_index.clear_loaded_indices()
+        get_catalogue = output_manager.get_catalogue
+        output_manager.get_catalogue = None
+        try:
+            pynbody_h = output_manager.load_object("tiny.000640", 0, 0, mode='partial')
+        finally:
+            output_manager.get_catalogue = get_catalogue
+        assert (pynbody_h['iord'] == expected['iord']).all()
+        assert pynbody_h.ancestor is pynbody_h
+    finally:
+        config.halo_membership_index_directory = old_directory
+        membership_index.clear_loaded_indices()
+
+def test_membership_index_built_by_one_process(tmp_path):
+    from tangos.util import membership_index
+    old_directory = config.halo_membership_index_directory
+    config.halo_membership_index_directory = str(tmp_path)
+    try:
+        files = membership_index.index_files(output_manager._extension_to_filename("tiny.000640"),
+                                             type(output_manager).__name__, 'halo')
+        lock_file = pathlib.Path(str(files[0])+".lock")
+        lock_file.touch() # another process is building the index
+
+        def finish_building():
+            time.sleep(0.2)
+            membership_index._build_index(output_manager.get_catalogue("tiny.000640", 'halo'), files)
+            lock_file.unlink()
+        builder = threading.Thread(target=finish_building)
+        builder.start()
+        membership_index.clear_loaded_indices()
+
+        def get_catalogue():
+            raise AssertionError("A process waiting for the index should not load the catalogue")
+        index = membership_index.build_index(get_catalogue, files)
+        builder.join()
+
+        assert index is not None
+        assert not lock_file.exists()
+        assert len(index.particle_indices(0)) == 200
+    finally:
+        config.halo_membership_index_directory = old_directory
+        membership_index.clear_loaded_indices()
+
 def test_load_tracker_halo():
     add_test_simulation_to_db()
     pynbody_h = db.get_halo("test_tipsy/tiny.000640/tracker_1").load()
@@ -136,6 +193,27 @@ def test_load_tracker_iord_halo():
     h_iord = db.get_halo("test_tipsy/tiny.000640/tracker_2").load(mode='partial')
     assert (h_direct['iord']==h_iord['iord']).all()
 
+def test_load_tracked_regions_batch():
+    add_test_simulation_to_db()
+    trackers = list(db.get_simulation("test_tipsy").trackers)
+    extra = db.core.tracking.TrackData(db.get_simulation("test_tipsy"), halo_num=100)
+    extra.particles = [80000, 40000, 40000, 12345] # out of order, duplicated, and not present in the snapshot
+    extra.use_iord = True
+    trackers.append(extra)
+
+    f = output_manager.load_timestep("tiny.000640")
+    regions = output_manager.load_tracked_regions("tiny.000640", trackers)
+    assert len(regions) == 3
+    for region, tracker in zip(regions[:2], trackers[:2]):
+        assert (region.get_index_list(f) == output_manager.load_tracked_region("tiny.000640", tracker)
+                .get_index_list(f)).all()
+    assert (regions[1]['iord'] == tracked_iord).all()
+    assert (regions[2]['iord'] == [40000, 80000]).all()
+
+    # the result must agree with a brute-force search
+    expected = np.where(np.isin(f['iord'], extra.particles))[0]
+    assert (regions[2].get_index_list(f) == expected).all()
+
 
 _added_to_db = False
 tracked_particles = [2, 4, 6, 8]
@@ -183,6 +261,42 @@ def test_load_region_uses_cache():
     assert id(region1a) == id(region1b)
     assert id(region1a) != id(region2)
 
+def test_kdtree_cache(tmp_path):
+    from tangos.util import kdtree_cache
+    old_directory = config.kdtree_cache_directory
+    config.kdtree_cache_directory = str(tmp_path)
+    filename = os.path.join(config.base, "test_tipsy", "tiny.000640")
+    sphere = pynbody.filt.Sphere(2000, [1000, 1000, 1000])
+    try:
+        f = pynbody.load(filename)
+        kdtree_cache.build_tree(f)
+        assert kdtree_cache.saved_tree_files(f) is None # built, then saved
+        expected_iord = f[sphere]['iord']
+
+        f = pynbody.load(filename)
+        kdtree_cache.build_tree(f)
+        assert kdtree_cache.saved_tree_files(f) is not None
+        assert (f[sphere]['iord'] == expected_iord).all()
+    finally:
+        config.kdtree_cache_directory = old_directory
+
+def _assert_catalogues_equal(cat, expected_cat):
+    assert cat.keys() == expected_cat.keys()
+    for k in cat:
+        assert sorted(n for n, _ in cat[k]) == sorted(n for n, _ in expected_cat[k])
+        npt.assert_allclose(sorted(w for _, w in cat[k]), sorted(w for _, w in expected_cat[k]))
+
+def test_match_objects_bidirectional():
+    for dm_only in (False, True):
+        cat, back_cat = output_manager.match_objects_bidirectional("tiny.000640", "tiny.000832", 0, None, dm_only,
+                                                                   threshold=0.005)
+        expected_cat = output_manager.match_objects("tiny.000640", "tiny.000832", 0, None, dm_only, threshold=0.005)
+        expected_back_cat = output_manager.match_objects("tiny.000832", "tiny.000640", 0, None, dm_only,
+                                                         threshold=0.005)
+        _assert_catalogues_equal(cat, expected_cat)
+        _assert_catalogues_equal(back_cat, expected_back_cat)
+        assert len(back_cat) > len(cat) > 0
+
 
 class DummyHaloClass(pynbody.halo.number_array.HaloNumberCatalogue):
     def __init__(self, sim):
@@ -163,3 +163,30 @@ def test_report_if_needed_no_limitless_recursion(sample_timing_monitor):
     sample_timing_monitor.report_to_log_if_needed(logger)
     assert sample_timing_monitor._state_at_last_report is not None
     assert sample_timing_monitor._state_at_last_report._state_at_last_report is None
+
+def test_count():
+    TM = tm.TimingMonitor()
+    x = Dummy()
+
+    for i in range(2):
+        with TM(x):
+            time.sleep(0.1)
+            TM.count(50, "rows")
+
+    TM2 = pickle_and_unpickle(TM)
+    TM.add(TM2)
+
+    lc = LogCapturer()
+    with lc:
+        TM.report_to_log(logger)
+
+    output = lc.get_output_without_timestamps()
+    assert "200 rows processed; " in output
+    rate = float(output.split("200 rows processed; ")[1].split(" ")[0])
+    assert 400 < rate < 500
+
+    assert TM != TM2
+
+def pickle_and_unpickle(obj):
+    import pickle
+    return pickle.loads(pickle.dumps(obj))